@@ -11,9 +11,10 @@ from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
 
 from rnnt.args import FLAGS
-from rnnt.dataset import seq_collate, MergedDataset, Librispeech, CommonVoice, TEDLIUM, YoutubeCaption
-from rnnt.models import Transducer
-from rnnt.tokenizer import HuggingFaceTokenizer, CharTokenizer
+from rnnt.dataset import SeqCollate, BucketBatchSampler, MergedDataset, Librispeech, CommonVoice, TEDLIUM, YoutubeCaption
+from rnnt.loss import build_loss
+from rnnt.models import Transducer, time_reduction_factor
+from rnnt.tokenizer import HuggingFaceTokenizer, CharTokenizer, NUL
 from rnnt.transforms import build_transform
 
 
@@ -56,57 +57,69 @@ class Trainer:
                 cache_dir='BPE-2048', vocab_size=FLAGS.bpe_size)
 
         # Dataloader
-        self.dataloader_train = DataLoader(
-            dataset=MergedDataset([
-                Librispeech(
-                    root=FLAGS.LibriSpeech_train_500,
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-                Librispeech(
-                    root=FLAGS.LibriSpeech_train_360,
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-                # Librispeech(
-                #     root=FLAGS.LibriSpeech_train_100,
-                #     tokenizer=self.tokenizer,
-                #     transform=transform_train,
-                #     audio_max_length=FLAGS.audio_max_length),
-                TEDLIUM(
-                    root=FLAGS.TEDLIUM_train,
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-                CommonVoice(
-                    root=FLAGS.CommonVoice, labels='train.tsv',
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-                YoutubeCaption(
-                    root='../speech_data/youtube-speech-text/', labels='bloomberg2_meta.csv',
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-                YoutubeCaption(
-                    root='../speech_data/youtube-speech-text/', labels='life_meta.csv',
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),                    
-                YoutubeCaption(
-                    root='../speech_data/youtube-speech-text/', labels='news_meta.csv',
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-                YoutubeCaption(
-                    root='../speech_data/youtube-speech-text/', labels='english2_meta.csv',
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-            ]),
-            batch_size=FLAGS.batch_size, shuffle=True,
-            num_workers=FLAGS.num_workers, collate_fn=seq_collate,
-            drop_last=True)
+        dataset_train = MergedDataset([
+            Librispeech(
+                root=FLAGS.LibriSpeech_train_500,
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+            Librispeech(
+                root=FLAGS.LibriSpeech_train_360,
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+            # Librispeech(
+            #     root=FLAGS.LibriSpeech_train_100,
+            #     tokenizer=self.tokenizer,
+            #     transform=transform_train,
+            #     audio_max_length=FLAGS.audio_max_length),
+            TEDLIUM(
+                root=FLAGS.TEDLIUM_train,
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+            CommonVoice(
+                root=FLAGS.CommonVoice, labels='train.tsv',
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+            YoutubeCaption(
+                root='../speech_data/youtube-speech-text/', labels='bloomberg2_meta.csv',
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+            YoutubeCaption(
+                root='../speech_data/youtube-speech-text/', labels='life_meta.csv',
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),                    
+            YoutubeCaption(
+                root='../speech_data/youtube-speech-text/', labels='news_meta.csv',
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+            YoutubeCaption(
+                root='../speech_data/youtube-speech-text/', labels='english2_meta.csv',
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+        ])
+        # padded to the time reduction once the model is built
+        self.collate = SeqCollate()
+        if FLAGS.max_batch_seconds > 0:
+            self.dataloader_train = DataLoader(
+                dataset=dataset_train,
+                batch_sampler=BucketBatchSampler(
+                    dataset_train.durations(), FLAGS.max_batch_seconds),
+                num_workers=FLAGS.num_workers, collate_fn=self.collate,
+                pin_memory=torch.cuda.is_available())
+        else:
+            self.dataloader_train = DataLoader(
+                dataset=dataset_train,
+                batch_size=FLAGS.batch_size, shuffle=True,
+                num_workers=FLAGS.num_workers, collate_fn=self.collate,
+                pin_memory=torch.cuda.is_available(),
+                drop_last=True)
 
         self.dataloader_val = DataLoader(
             dataset=MergedDataset([
@@ -116,9 +129,12 @@ class Trainer:
                     transform=transform_test,
                     reverse_sorted_by_length=True)]),
             batch_size=FLAGS.eval_batch_size, shuffle=False,
-            num_workers=FLAGS.num_workers, collate_fn=seq_collate)
+            num_workers=FLAGS.num_workers, collate_fn=self.collate,
+            pin_memory=torch.cuda.is_available())
 
         self.tokenizer.build(self.dataloader_train.dataset.texts())
+        self.dataloader_train.dataset.cache_tokens()
+        self.dataloader_val.dataset.cache_tokens()
         self.vocab_size = self.dataloader_train.dataset.tokenizer.vocab_size
 
         # Model
@@ -135,7 +151,16 @@ class Trainer:
             dec_dropout=FLAGS.dec_dropout,
             dec_proj_size=FLAGS.dec_proj_size,
             joint_size=FLAGS.joint_size,
+            dec_type=FLAGS.dec_type,
+            dec_context_size=FLAGS.dec_context_size,
+            output_loss=FLAGS.loss_chunk_size > 0,
+            loss_chunk_size=FLAGS.loss_chunk_size,
+            loss_type=FLAGS.loss,
+            packed_encoder=FLAGS.packed_encoder,
         ).to(device)
+        self.loss_fn = build_loss(FLAGS.loss, blank=NUL)
+        self.collate.pad_to_multiple = time_reduction_factor(
+            self.model.encoder)
 
         # Optimizer
         if FLAGS.optim == 'adam':
@@ -211,20 +236,30 @@ class Trainer:
                         'Epoch %d, step %d, loss: %.4f, WER: %.4f' % (
                             epoch, step, val_loss, wer))
 
+    def compute_loss(self, xs, ys, xlen, ylen):
+        if FLAGS.multi_gpu:
+            model = self.model.module
+        else:
+            model = self.model
+        if model.output_loss:
+            # chunked loss, the logits are never materialized
+            loss = self.model(xs, ys, xlen, ylen)
+            if FLAGS.multi_gpu:
+                loss = loss.mean()
+            return loss
+        alignment = self.model(xs, ys, xlen, ylen)
+        xlen = model.encoder.get_lengths(xlen).int()
+        return self.loss_fn(alignment, ys.int(), xlen, ylen)
+
     def train_step(self, batch):
         sub_losses = []
-        start_idxs = range(0, FLAGS.batch_size, FLAGS.sub_batch_size)
+        start_idxs = range(0, len(batch[0]), FLAGS.sub_batch_size)
         self.optim.zero_grad()
         for sub_batch_idx, start_idx in enumerate(start_idxs):
             sub_slice = slice(start_idx, start_idx + FLAGS.sub_batch_size)
             xs, ys, xlen, ylen = [x[sub_slice].to(device) for x in batch]
-            xs = xs[:, :xlen.max()].contiguous()
             ys = ys[:, :ylen.max()].contiguous()
-            loss = self.model(xs, ys, xlen, ylen)
-            if FLAGS.multi_gpu:
-                loss = loss.mean() / len(start_idxs)
-            else:
-                loss = loss / len(start_idxs)
+            loss = self.compute_loss(xs, ys, xlen, ylen) / len(start_idxs)
             if FLAGS.apex:
                 delay_unscale = sub_batch_idx < len(start_idxs) - 1
                 with amp.scale_loss(
@@ -270,11 +305,8 @@ class Trainer:
 
     def evaluate_step(self, batch):
         xs, ys, xlen, ylen = [x.to(device) for x in batch]
-        xs = xs[:, :xlen.max()]
         ys = ys[:, :ylen.max()].contiguous()
-        loss = self.model(xs, ys, xlen, ylen)
-        if FLAGS.multi_gpu:
-            loss = loss.mean()
+        loss = self.compute_loss(xs, ys, xlen, ylen)
         if FLAGS.multi_gpu:
             ys_hat, nll = self.model.module.greedy_decode(xs, xlen)
         else:
@@ -0,0 +1,166 @@
+import os
+
+import torch
+import torch.optim as optim
+from absl import app, flags
+from torch.utils.data import DataLoader
+from tqdm import trange
+
+from rnnt.args import FLAGS                             # define training FLAGS
+from rnnt.compress import (
+    compress_transducer, count_flops, count_parameters, encoder_latency,
+    factorize_transducer)
+from rnnt.dataset import seq_collate, MergedDataset, Librispeech
+from rnnt.models import Transducer
+from rnnt.tokenizer import HuggingFaceTokenizer
+from rnnt.transforms import build_transform
+
+
+flags.DEFINE_string('model_name', "last.pt", help='checkpoint name')
+flags.DEFINE_string('output_name', None,
+                    help='compressed checkpoint name, defaults to '
+                         '<model_name>.lowrank.pt')
+flags.DEFINE_integer('step_n_frame', 2, help='input frame(stacked)')
+flags.DEFINE_integer('rank', 0, help='rank of every factorized weight, 0 '
+                     'picks the rank from energy')
+flags.DEFINE_float('energy', 0.9, help='fraction of the squared singular '
+                   'values kept by each factorized weight')
+flags.DEFINE_bool('recurrent', False, help='also factorize the recurrent '
+                  'LSTM weights, steps the cell in python')
+flags.DEFINE_integer('finetune_steps', 0, help='training steps after the '
+                     'factorization, 0 skips fine-tuning')
+flags.DEFINE_integer('repeat', 100, help='encoder calls timed per model')
+
+if torch.cuda.is_available():
+    device = torch.device('cuda:0')
+else:
+    device = torch.device('cpu')
+
+
+def profile(transducer, input_size):
+    # one streaming chunk, like the stream decoders
+    encoder = transducer.encoder
+    xs = torch.rand(1, FLAGS.step_n_frame, input_size)
+    hidden = (
+        torch.zeros(FLAGS.enc_layers, 1, FLAGS.enc_hidden_size),
+        torch.zeros(FLAGS.enc_layers, 1, FLAGS.enc_hidden_size))
+    return {
+        'params': count_parameters(transducer),
+        'encoder_params': count_parameters(encoder),
+        'encoder_flops': count_flops(encoder, xs, hidden),
+        'encoder_ms': 1000 * encoder_latency(
+            encoder, xs, hidden, FLAGS.repeat),
+    }
+
+
+def finetune(transducer, transform, tokenizer):
+    """Short training loop, like cli/baseline.py without apex"""
+    dataloader = DataLoader(
+        dataset=MergedDataset([
+            Librispeech(
+                root=FLAGS.LibriSpeech_train_100,
+                tokenizer=tokenizer,
+                transform=transform,
+                audio_max_length=FLAGS.audio_max_length)]),
+        batch_size=FLAGS.sub_batch_size, shuffle=True,
+        num_workers=FLAGS.num_workers, collate_fn=seq_collate,
+        drop_last=True)
+    transducer.to(device).train()
+    optimizer = optim.Adam(transducer.parameters(), lr=FLAGS.lr)
+    looper = iter(dataloader)
+    with trange(FLAGS.finetune_steps, dynamic_ncols=True) as pbar:
+        for _ in pbar:
+            try:
+                batch = next(looper)
+            except StopIteration:
+                looper = iter(dataloader)
+                batch = next(looper)
+            xs, ys, xlen, ylen = [x.to(device) for x in batch]
+            loss = transducer(xs, ys, xlen, ylen).mean()
+            optimizer.zero_grad()
+            loss.backward()
+            if FLAGS.gradclip is not None:
+                torch.nn.utils.clip_grad_norm_(
+                    transducer.parameters(), FLAGS.gradclip)
+            optimizer.step()
+            pbar.set_description('loss: %.4f' % loss.item())
+    transducer.cpu().eval()
+
+
+def main(argv):
+    logdir = os.path.join('logs', FLAGS.name)
+
+    tokenizer = HuggingFaceTokenizer(
+        cache_dir=logdir, vocab_size=FLAGS.bpe_size)
+
+    transform_train, _, input_size = build_transform(
+        feature_type=FLAGS.feature, feature_size=FLAGS.feature_size,
+        n_fft=FLAGS.n_fft, win_length=FLAGS.win_length,
+        hop_length=FLAGS.hop_length, delta=FLAGS.delta, cmvn=FLAGS.cmvn,
+        downsample=FLAGS.downsample,
+        T_mask=FLAGS.T_mask, T_num_mask=FLAGS.T_num_mask,
+        F_mask=FLAGS.F_mask, F_num_mask=FLAGS.F_num_mask
+    )
+
+    model_path = os.path.join(logdir, 'models', FLAGS.model_name)
+    checkpoint = torch.load(model_path, lambda storage, loc: storage)
+    transducer = Transducer(
+        vocab_embed_size=FLAGS.vocab_embed_size,
+        vocab_size=tokenizer.vocab_size,
+        input_size=input_size,
+        enc_hidden_size=FLAGS.enc_hidden_size,
+        enc_layers=FLAGS.enc_layers,
+        enc_dropout=FLAGS.enc_dropout,
+        enc_proj_size=FLAGS.enc_proj_size,
+        dec_hidden_size=FLAGS.dec_hidden_size,
+        dec_layers=FLAGS.dec_layers,
+        dec_dropout=FLAGS.dec_dropout,
+        dec_proj_size=FLAGS.dec_proj_size,
+        joint_size=FLAGS.joint_size,
+        dec_type=FLAGS.dec_type,
+        dec_context_size=FLAGS.dec_context_size,
+        loss_type=FLAGS.loss,
+    )
+    ranks = checkpoint.get('ranks', {})
+    factorize_transducer(transducer, ranks)
+    transducer.load_state_dict(checkpoint['model'])
+    transducer.eval()
+
+    before = profile(transducer, input_size)
+    ranks.update(compress_transducer(
+        transducer, rank=FLAGS.rank or None, energy=FLAGS.energy,
+        recurrent=FLAGS.recurrent))
+    transducer.eval()
+    after = profile(transducer, input_size)
+
+    if FLAGS.finetune_steps > 0:
+        finetune(transducer, transform_train, tokenizer)
+
+    output_name = FLAGS.output_name
+    if output_name is None:
+        output_name = os.path.splitext(FLAGS.model_name)[0] + '.lowrank.pt'
+    output_path = os.path.join(logdir, 'models', output_name)
+    # loaded by rebuilding the factorized modules with `ranks` first
+    torch.save({
+        'model': transducer.state_dict(),
+        'ranks': ranks,
+    }, output_path)
+
+    print("Compressed model has been saved to %s" % output_path)
+    for name, module_ranks in ranks.items():
+        print("%-24s : rank %s" % (name, module_ranks))
+    print("%-24s : %10s -> %10s" % ('', 'before', 'after'))
+    print("%-24s : %10d -> %10d" % (
+        'parameters', before['params'], after['params']))
+    print("%-24s : %10d -> %10d" % (
+        'encoder parameters', before['encoder_params'],
+        after['encoder_params']))
+    print("%-24s : %10.2f -> %10.2f" % (
+        'encoder MFLOPs per chunk', before['encoder_flops'] / 1e6,
+        after['encoder_flops'] / 1e6))
+    print("%-24s : %10.3f -> %10.3f" % (
+        'encoder ms per chunk', before['encoder_ms'], after['encoder_ms']))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,126 @@
+import os
+import pickle
+
+import numpy as np
+import torch
+import torchaudio
+from absl import app, flags
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
+
+from rnnt.args import FLAGS                             # define training FLAGS
+from rnnt.dataset import CommonVoice, Librispeech, TEDLIUM, YoutubeCaption
+from rnnt.transforms import build_transform
+
+
+flags.DEFINE_list('sources', ['LibriSpeech_train_100'],
+                  help='dataset flags to dump, each into its own directory '
+                       'of feature_dir, YoutubeCaption_<channel> dumps '
+                       '<channel>_meta.csv of --YoutubeCaption')
+flags.DEFINE_integer('shard_mb', 1024, help='max size of a shard file')
+
+
+class TestFeatures(Dataset):
+    """Test transform features of an `AudioDataset`, in fp16"""
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        data, _ = torchaudio.load(
+            self.dataset.audio_path(idx), normalization=True)
+        with torch.no_grad():
+            return self.transform(data[:1])[0].T.half()
+
+
+def build_source(name):
+    # every utterance is dumped, FeatureShardDataset filters the lengths
+    if name.startswith('YoutubeCaption_'):
+        labels = name[len('YoutubeCaption_'):] + '_meta.csv'
+        return YoutubeCaption(
+            root=FLAGS.YoutubeCaption, labels=labels, tokenizer=None)
+    if not hasattr(FLAGS, name):
+        raise ValueError('Unsupported source %s' % name)
+    root = getattr(FLAGS, name)
+    if name.startswith('LibriSpeech'):
+        return Librispeech(root=root, tokenizer=None)
+    if name.startswith('TEDLIUM'):
+        return TEDLIUM(root=root, tokenizer=None)
+    if name == 'CommonVoice':
+        return CommonVoice(root=root, labels='train.tsv', tokenizer=None)
+    raise ValueError('Unsupported source %s' % name)
+
+
+def dump(dataset, transform, feature_size, output_dir, frame_seconds):
+    os.makedirs(output_dir, exist_ok=True)
+    loader = DataLoader(
+        TestFeatures(dataset, transform), batch_size=None, shuffle=False,
+        num_workers=FLAGS.num_workers)
+    shard_bytes = FLAGS.shard_mb * 2**20
+    shards = []
+    shard_ids = []
+    offsets = []
+    lengths = []
+    f = None
+    with tqdm(loader, dynamic_ncols=True, desc=output_dir) as pbar:
+        for feat in pbar:
+            data = feat.contiguous().numpy().tobytes()
+            if f is None or f.tell() + len(data) > shard_bytes:
+                if f is not None:
+                    f.close()
+                shards.append('shard_%05d.bin' % len(shards))
+                f = open(os.path.join(output_dir, shards[-1]), 'wb')
+                offset = 0
+            f.write(data)
+            shard_ids.append(len(shards) - 1)
+            offsets.append(offset)
+            lengths.append(feat.shape[0])
+            offset += feat.shape[0]
+    if f is not None:
+        f.close()
+
+    index = {
+        'feature_size': feature_size,
+        'frame_seconds': frame_seconds,
+        'transform': repr(transform),
+        'shards': shards,
+        'shard': np.array(shard_ids, dtype=np.int64),
+        'offset': np.array(offsets, dtype=np.int64),
+        'length': np.array(lengths, dtype=np.int64),
+        'texts': dataset.texts(),
+    }
+    # written last, a store without index is an interrupted dump
+    index_path = os.path.join(output_dir, 'index.pkl')
+    with open(index_path + '.tmp', 'wb') as f:
+        pickle.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+    return sum(lengths) * frame_seconds
+
+
+def main(argv):
+    if FLAGS.feature_dir is None:
+        raise ValueError('--feature_dir is required')
+    _, transform_test, input_size = build_transform(
+        feature_type=FLAGS.feature, feature_size=FLAGS.feature_size,
+        n_fft=FLAGS.n_fft, win_length=FLAGS.win_length,
+        hop_length=FLAGS.hop_length, delta=FLAGS.delta, cmvn=FLAGS.cmvn,
+        downsample=FLAGS.downsample,
+        T_mask=FLAGS.T_mask, T_num_mask=FLAGS.T_num_mask,
+        F_mask=FLAGS.F_mask, F_num_mask=FLAGS.F_num_mask
+    )
+    frame_seconds = FLAGS.hop_length * FLAGS.downsample / 16000
+
+    for name in FLAGS.sources:
+        dataset = build_source(name)
+        output_dir = os.path.join(FLAGS.feature_dir, name)
+        seconds = dump(
+            dataset, transform_test, input_size, output_dir, frame_seconds)
+        print("%s: %.2f hours of features in %s" % (
+            name, seconds / 3600, output_dir))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -2,13 +2,16 @@ import os
 
 import numpy as np
 import onnxruntime
+from onnxruntime.quantization import QuantType, quantize_dynamic
+import torch.nn as nn
 import torch.onnx
 from absl import app, flags
 
 from rnnt.args import FLAGS                             # define training FLAGS
 from rnnt.transforms import build_transform
-from rnnt.tokenizer import HuggingFaceTokenizer
-from rnnt.models import Transducer
+from rnnt.tokenizer import HuggingFaceTokenizer, NUL
+from rnnt.compress import factorize_transducer
+from rnnt.models import Transducer, time_reduction_factor
 
 
 flags.DEFINE_string('model_name', "last.pt", help='checkpoint name')
@@ -41,11 +44,13 @@ def export_encoder(transducer, input_size, vocab_size, logdir):
         example_outputs=(y, (y_h, y_c)),
         input_names=input_names,
         output_names=output_names,
+        # the time axis is dynamic, so the chunk size can change between
+        # calls, e.g. with an adaptive chunk controller
         dynamic_axes={
-            'input': {0: 'batch_size'},
+            'input': {0: 'batch_size', 1: 'time'},
             'input_hidden': {1: 'batch_size'},
             'input_cell': {1: 'batch_size'},
-            'output': {0: 'batch_size'},
+            'output': {0: 'batch_size', 1: 'time'},
             'output_hidden': {1: 'batch_size'},
             'output_cell': {1: 'batch_size'},
         },
@@ -67,6 +72,22 @@ def export_encoder(transducer, input_size, vocab_size, logdir):
     np.testing.assert_allclose(
         y_c.detach().numpy(), onnx_y_c, rtol=1e-03, atol=1e-05)
 
+    # a longer chunk than the traced one
+    x_long = torch.rand(1, 4 * FLAGS.step_n_frame, input_size)
+    with torch.no_grad():
+        y_long, (y_long_h, y_long_c) = encoder(x_long, (x_h, x_c))
+    onnx_y_long, onnx_y_long_h, onnx_y_long_c = session.run(output_names, {
+        'input': x_long.numpy(),
+        'input_hidden': inputs['input_hidden'],
+        'input_cell': inputs['input_cell'],
+    })
+    np.testing.assert_allclose(
+        y_long.numpy(), onnx_y_long, rtol=1e-03, atol=1e-05)
+    np.testing.assert_allclose(
+        y_long_h.numpy(), onnx_y_long_h, rtol=1e-03, atol=1e-05)
+    np.testing.assert_allclose(
+        y_long_c.numpy(), onnx_y_long_c, rtol=1e-03, atol=1e-05)
+
     print("Encoder has been exported")
     for name in input_names:
         print("%-12s : %s" % (name, str(inputs[name].shape)))
@@ -74,7 +95,58 @@ def export_encoder(transducer, input_size, vocab_size, logdir):
         print("%-12s : %s" % (name, str(value.shape)))
 
 
+def export_stateless_decoder(transducer, input_size, vocab_size, logdir):
+    print("=" * 40)
+    decoder = transducer.decoder
+    decoder.eval()
+    x = torch.randint(0, vocab_size, size=(1, 1))
+    x_context = torch.randint(
+        0, vocab_size, size=(1, 1, FLAGS.dec_context_size - 1))
+    y, (y_context,) = decoder(x, (x_context,))
+
+    input_names = ['input', 'input_context']
+    output_names = ['output', 'output_context']
+    path = os.path.join(logdir, 'decoder.onnx')
+    torch.onnx.export(
+        decoder,
+        (x, (x_context,)),
+        path,
+        export_params=True,
+        opset_version=10,
+        do_constant_folding=True,
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes={
+            'input': {0: 'batch_size'},
+            'input_context': {1: 'batch_size'},
+            'output': {0: 'batch_size'},
+            'output_context': {1: 'batch_size'},
+        },
+        verbose=True
+    )
+
+    session = onnxruntime.InferenceSession(path)
+    inputs = {
+        'input': x.numpy(),
+        'input_context': x_context.numpy(),
+    }
+    onnx_y, onnx_y_context = session.run(output_names, inputs)
+
+    np.testing.assert_allclose(
+        y.detach().numpy(), onnx_y, rtol=1e-03, atol=1e-05)
+    np.testing.assert_equal(y_context.numpy(), onnx_y_context)
+
+    print("Decoder has been exported")
+    for name in input_names:
+        print("%-12s : %s" % (name, str(inputs[name].shape)))
+    for name, value in zip(output_names, [onnx_y, onnx_y_context]):
+        print("%-12s : %s" % (name, str(value.shape)))
+
+
 def export_decoder(transducer, input_size, vocab_size, logdir):
+    if FLAGS.dec_type == 'stateless':
+        export_stateless_decoder(transducer, input_size, vocab_size, logdir)
+        return
     print("=" * 40)
     decoder = transducer.decoder
     decoder.eval()
@@ -176,6 +248,137 @@ def export_join(transducer, input_size, vocab_size, logdir):
         print("%-12s : %s" % (name, str(value.shape)))
 
 
+class DecoderStep(nn.Module):
+    """LSTM decoder with the states as separate arguments, for tracing"""
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, ys, h, c):
+        ys, (h, c) = self.decoder(ys, (h, c))
+        return ys, h, c
+
+
+class GreedyChunk(nn.Module):
+    """Greedy decoding of a whole encoder chunk, one label per frame.
+
+    The decoder is run on every frame and its new state is only kept where
+    the label is not blank, so the loop has no data dependent branch and is
+    exported as a single Loop of Where ops.
+    """
+    def __init__(self, decoder_step, joint, logit_mask):
+        super().__init__()
+        self.decoder_step = decoder_step
+        self.joint = joint
+        self.register_buffer('logit_mask', logit_mask)
+
+    def forward(self, enc_xs, dec_x, h, c):
+        length = enc_xs.shape[1]
+        tokens = torch.zeros(length, dtype=torch.long)
+        for k in range(length):
+            logits = self.joint(enc_xs[:, k], dec_x[:, 0]) + self.logit_mask
+            pred = logits.argmax(dim=-1)
+            next_dec_x, next_h, next_c = self.decoder_step(
+                pred.view(1, 1), h, c)
+            emit = (pred != NUL).view(1, 1, 1)
+            dec_x = torch.where(emit, next_dec_x, dec_x)
+            h = torch.where(emit, next_h, h)
+            c = torch.where(emit, next_c, c)
+            tokens[k] = pred[0]
+        return tokens, dec_x, h, c
+
+
+def export_greedy_chunk(transducer, input_size, vocab_size, logdir,
+                        tokenizer):
+    if FLAGS.dec_type == 'stateless':
+        print("Greedy chunk export only supports the LSTM decoder")
+        return
+    print("=" * 40)
+    decoder = transducer.decoder
+    joint = transducer.joint
+    decoder.eval()
+    joint.eval()
+    y = torch.randint(0, vocab_size, size=(1, 1))
+    h = torch.rand(FLAGS.dec_layers, 1, FLAGS.dec_hidden_size)
+    c = torch.rand(FLAGS.dec_layers, 1, FLAGS.dec_hidden_size)
+    h_enc = torch.rand(1, FLAGS.enc_proj_size)
+    h_dec = torch.rand(1, FLAGS.dec_proj_size)
+    with torch.no_grad():
+        decoder_step = torch.jit.trace(DecoderStep(decoder), (y, h, c))
+        joint_step = torch.jit.trace(joint, (h_enc, h_dec))
+    logit_mask = torch.zeros(vocab_size)
+    unk = tokenizer.tokenizer.token_to_id('<unk>')
+    if unk is not None:
+        logit_mask[unk] = float('-inf')
+    greedy_chunk = GreedyChunk(decoder_step, joint_step, logit_mask)
+    scripted = torch.jit.script(greedy_chunk)
+
+    # the length of an encoder chunk after the time reduction
+    length = FLAGS.step_n_frame // time_reduction_factor(transducer.encoder)
+    enc_xs = torch.rand(1, length, FLAGS.enc_proj_size)
+    dec_x = torch.rand(1, 1, FLAGS.dec_proj_size)
+    with torch.no_grad():
+        outputs = greedy_chunk(enc_xs, dec_x, h, c)
+
+    input_names = ['input', 'input_dec', 'input_hidden', 'input_cell']
+    output_names = ['output', 'output_dec', 'output_hidden', 'output_cell']
+    path = os.path.join(logdir, 'greedy_chunk.onnx')
+    torch.onnx.export(
+        scripted,
+        (enc_xs, dec_x, h, c),
+        path,
+        export_params=True,
+        opset_version=11,
+        do_constant_folding=True,
+        example_outputs=outputs,
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes={
+            'input': {1: 'time'},
+            'output': {0: 'time'},
+        },
+        verbose=True
+    )
+
+    session = onnxruntime.InferenceSession(path)
+    for length in [length, 4 * length]:
+        enc_xs = torch.rand(1, length, FLAGS.enc_proj_size)
+        with torch.no_grad():
+            outputs = greedy_chunk(enc_xs, dec_x, h, c)
+        inputs = {
+            'input': enc_xs.numpy(),
+            'input_dec': dec_x.numpy(),
+            'input_hidden': h.numpy(),
+            'input_cell': c.numpy(),
+        }
+        onnx_outputs = session.run(output_names, inputs)
+        np.testing.assert_equal(outputs[0].numpy(), onnx_outputs[0])
+        for x, onnx_x in zip(outputs[1:], onnx_outputs[1:]):
+            np.testing.assert_allclose(
+                x.numpy(), onnx_x, rtol=1e-03, atol=1e-05)
+
+    print("Greedy chunk has been exported")
+    for name in input_names:
+        print("%-12s : %s" % (name, str(inputs[name].shape)))
+    for name, value in zip(output_names, onnx_outputs):
+        print("%-12s : %s" % (name, str(value.shape)))
+
+
+def quantize_graphs(logdir):
+    """int8 weights for every exported graph, written next to it as
+    <name>.int8.onnx"""
+    print("=" * 40)
+    for name in ['encoder', 'decoder', 'joint', 'greedy_chunk']:
+        path = os.path.join(logdir, name + '.onnx')
+        if not os.path.exists(path):
+            continue
+        quantized_path = os.path.join(logdir, name + '.int8.onnx')
+        quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+        print("%-12s : %.2f MB -> %.2f MB" % (
+            name, os.path.getsize(path) / 2**20,
+            os.path.getsize(quantized_path) / 2**20))
+
+
 def main(argv):
     assert FLAGS.step_n_frame % 2 == 0, ("step_n_frame must be divisible by "
                                          "reduction_factor of TimeReduction")
@@ -209,13 +412,20 @@ def main(argv):
         dec_dropout=FLAGS.dec_dropout,
         dec_proj_size=FLAGS.dec_proj_size,
         joint_size=FLAGS.joint_size,
+        dec_type=FLAGS.dec_type,
+        dec_context_size=FLAGS.dec_context_size,
     )
+    factorize_transducer(transducer, checkpoint.get('ranks', {}))
     transducer.load_state_dict(checkpoint['model'])
     transducer.eval()
 
     export_encoder(transducer, input_size, tokenizer.vocab_size, logdir)
     export_decoder(transducer, input_size, tokenizer.vocab_size, logdir)
     export_join(transducer, input_size, tokenizer.vocab_size, logdir)
+    export_greedy_chunk(
+        transducer, input_size, tokenizer.vocab_size, logdir, tokenizer)
+    if FLAGS.quantize:
+        quantize_graphs(logdir)
 
 
 if __name__ == '__main__':
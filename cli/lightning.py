@@ -9,12 +9,12 @@ from apex import amp
 from tqdm import trange, tqdm
 from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
-from warprnnt_pytorch import RNNTLoss
 from rnnt.args import FLAGS
-from rnnt.dataset import seq_collate, MergedDataset, Librispeech, CommonVoice, TEDLIUM, YoutubeCaption
-from rnnt.models import Transducer
+from rnnt.dataset import SeqCollate, build_feature_dataset, BucketBatchSampler, MergedDataset, Librispeech, CommonVoice, TEDLIUM, YoutubeCaption
+from rnnt.loss import build_loss
+from rnnt.models import Transducer, time_reduction_factor
 from rnnt.tokenizer import HuggingFaceTokenizer, CharTokenizer
-from rnnt.transforms import build_transform
+from rnnt.transforms import build_transform, split_augmentation
 from rnnt.tokenizer import NUL, BOS, PAD
 import pytorch_lightning as pl
 from modules.optimizer import SM3, AdamW, Novograd
@@ -37,7 +37,7 @@ class ParallelTraining(pl.LightningModule):
             F_mask=FLAGS.F_mask, F_num_mask=FLAGS.F_num_mask
         )
         self.log_path = None
-        self.loss_fn = RNNTLoss(blank=NUL)
+        self.loss_fn = build_loss(FLAGS.loss, blank=NUL)
         
         if FLAGS.tokenizer == 'char':
             self.tokenizer = CharTokenizer(cache_dir=self.logdir)
@@ -60,8 +60,13 @@ class ParallelTraining(pl.LightningModule):
             dec_dropout=FLAGS.dec_dropout,
             dec_proj_size=FLAGS.dec_proj_size,
             joint_size=FLAGS.joint_size,
+            dec_type=FLAGS.dec_type,
+            dec_context_size=FLAGS.dec_context_size,
             module_type=FLAGS.enc_type,
-            output_loss=False,
+            output_loss=FLAGS.loss_chunk_size > 0,
+            loss_chunk_size=FLAGS.loss_chunk_size,
+            loss_type=FLAGS.loss,
+            packed_encoder=FLAGS.packed_encoder,
         )
         self.latest_alignment = None
         self.steps = 0
@@ -83,12 +88,14 @@ class ParallelTraining(pl.LightningModule):
     def training_step(self, batch, batch_nb):
         xs, ys, xlen, ylen = batch
         # xs, ys, xlen = xs.cuda(), ys, xlen.cuda()
-        if xs.shape[1] != xlen.max():
-            xs = xs[:, :xlen.max()]
-            ys = ys[:, :ylen.max()]
-        alignment = self.model(xs, ys, xlen, ylen)
-        xlen = self.model.scale_length(alignment, xlen)
-        loss = self.loss_fn(alignment, ys.int(), xlen, ylen)
+        # xs is cut by the model, down to the time reduction padding
+        ys = ys[:, :ylen.max()]
+        if self.model.output_loss:
+            loss = self.model(xs, ys, xlen, ylen)
+        else:
+            alignment = self.model(xs, ys, xlen, ylen)
+            xlen = self.model.encoder.get_lengths(xlen).int()
+            loss = self.loss_fn(alignment, ys.int(), xlen, ylen)
 
         if batch_nb % 100 == 0:
             lr_val = 0
@@ -107,7 +114,11 @@ class ParallelTraining(pl.LightningModule):
 
     def validation_step(self, batch, batch_nb):
         xs, ys, xlen, ylen = batch
-        y, nll = self.model.greedy_decode(xs, xlen)
+        if FLAGS.beam_size > 1:
+            y, nll = self.model.beam_search(
+                xs, xlen, FLAGS.beam_size, FLAGS.max_sym_per_frame)
+        else:
+            y, nll = self.model.greedy_decode(xs, xlen)
 
         hypothesis = self.tokenizer.decode_plus(y)
         ground_truth = self.tokenizer.decode_plus(ys.cpu().numpy())
@@ -223,7 +234,7 @@ class ParallelTraining(pl.LightningModule):
 
     @pl.data_loader
     def train_dataloader(self):
-        transform_train, _, _ = build_transform(
+        transform_train, transform_test, _ = build_transform(
             feature_type=FLAGS.feature, feature_size=FLAGS.feature_size,
             n_fft=FLAGS.n_fft, win_length=FLAGS.win_length,
             hop_length=FLAGS.hop_length, delta=FLAGS.delta, cmvn=FLAGS.cmvn,
@@ -232,8 +243,13 @@ class ParallelTraining(pl.LightningModule):
             F_mask=FLAGS.F_mask, F_num_mask=FLAGS.F_num_mask
         )
 
-        dataloader = DataLoader(
-            dataset=MergedDataset([
+        if FLAGS.feature_dir is not None:
+            dataset_train = build_feature_dataset(
+                FLAGS.feature_dir, self.tokenizer,
+                transform=split_augmentation(transform_train, transform_test),
+                audio_max_length=FLAGS.audio_max_length)
+        else:
+            dataset_train = MergedDataset([
                 Librispeech(
                     root=FLAGS.LibriSpeech_train_500,
                     tokenizer=self.tokenizer,
@@ -284,10 +300,22 @@ class ParallelTraining(pl.LightningModule):
                     transform=transform_train,
                     audio_max_length=FLAGS.audio_max_length,
                     audio_min_length=1),
-            ]),
-            batch_size=FLAGS.sub_batch_size, shuffle=True,
-            num_workers=FLAGS.num_workers, collate_fn=seq_collate,
-            drop_last=True)
+            ])
+        collate = SeqCollate(
+            pad_to_multiple=time_reduction_factor(self.model.encoder))
+        if FLAGS.max_batch_seconds > 0:
+            dataloader = DataLoader(
+                dataset=dataset_train,
+                batch_sampler=BucketBatchSampler(
+                    dataset_train.durations(), FLAGS.max_batch_seconds),
+                num_workers=FLAGS.num_workers, collate_fn=collate,
+                pin_memory=torch.cuda.is_available())
+        else:
+            dataloader = DataLoader(
+                dataset=dataset_train,
+                batch_size=FLAGS.sub_batch_size, shuffle=True,
+                num_workers=FLAGS.num_workers, collate_fn=collate,
+                pin_memory=torch.cuda.is_available(), drop_last=True)
         return dataloader
 
     @pl.data_loader
@@ -301,6 +329,8 @@ class ParallelTraining(pl.LightningModule):
             F_mask=FLAGS.F_mask, F_num_mask=FLAGS.F_num_mask
         )
 
+        collate = SeqCollate(
+            pad_to_multiple=time_reduction_factor(self.model.encoder))
         val_dataloader = DataLoader(
             dataset=MergedDataset([
                 Librispeech(
@@ -309,7 +339,8 @@ class ParallelTraining(pl.LightningModule):
                     transform=transform_test,
                     reverse_sorted_by_length=True)]),
             batch_size=FLAGS.eval_batch_size, shuffle=False,
-            num_workers=FLAGS.num_workers, collate_fn=seq_collate)
+            num_workers=FLAGS.num_workers, collate_fn=collate,
+            pin_memory=torch.cuda.is_available())
         return val_dataloader
 
 
@@ -1,3 +1,4 @@
+import json
 import os
 import time
 
@@ -10,13 +11,18 @@ from tqdm import tqdm
 from rnnt.args import FLAGS                             # define training FLAGS
 from rnnt.tokenizer import HuggingFaceTokenizer
 from rnnt.dataset import MergedDataset, Librispeech
-from rnnt.stream import OpenVINOStreamDecoder, PytorchStreamDecoder
+from rnnt.stream import (
+    OpenVINOStreamDecoder, OnnxRuntimeStreamDecoder, PytorchStreamDecoder)
 
 # PytorchStreamDecoder
 flags.DEFINE_string('model_name', "last.pt", help='steps of checkpoint')
 flags.DEFINE_integer('step_n_frame', 2, help='input frame(stacked)')
 
 flags.DEFINE_integer('samples', 10, help='test samples')
+flags.DEFINE_list('decoders', ['torch', 'openvino'],
+                  help='decoders to compare, any of torch, torch_int8, onnx, '
+                       'onnx_int8 and openvino')
+flags.DEFINE_string('report', None, help='write the comparison as json')
 
 
 def fullseq_decode(fullseq_decoder, waveform, verbose=0):
@@ -42,62 +48,36 @@ def stream_decode(stream_decoder, waveform, verbose=0):
         if verbose > 0:
             print(seq, end='', flush=True)
         pred_seq += seq
+    pred_seq += stream_decoder.flush()
 
     return pred_seq, total_frames
 
 
-def main(argv):
-    assert FLAGS.step_n_frame % 2 == 0, ("step_n_frame must be divisible by "
-                                         "reduction_factor of TimeReduction")
+def build_decoder(name):
+    if name == 'torch':
+        return PytorchStreamDecoder(FLAGS, quantize=False)
+    if name == 'torch_int8':
+        return PytorchStreamDecoder(FLAGS, quantize=True)
+    if name == 'onnx':
+        return OnnxRuntimeStreamDecoder(FLAGS, quantize=False)
+    if name == 'onnx_int8':
+        return OnnxRuntimeStreamDecoder(FLAGS, quantize=True)
+    if name == 'openvino':
+        return OpenVINOStreamDecoder(FLAGS)
+    raise ValueError('Unsupported decoder %s' % name)
 
-    tokenizer = HuggingFaceTokenizer(
-        cache_dir=os.path.join('logs', FLAGS.name), vocab_size=FLAGS.bpe_size)
 
-    dataloader = DataLoader(
-        dataset=MergedDataset([
-            Librispeech(
-                root=FLAGS.LibriSpeech_test,
-                tokenizer=tokenizer,
-                transform=None,
-                reverse_sorted_by_length=True)]),
-        batch_size=1, shuffle=False, num_workers=0)
-
-    pytorch_decoder = PytorchStreamDecoder(FLAGS)
-    # pytorch_decoder.reset_profile()
-    # wers = []
-    # total_time = 0
-    # total_frame = 0
-    # with tqdm(dataloader, dynamic_ncols=True) as pbar:
-    #     pbar.set_description("Pytorch full sequence decode")
-    #     for waveform, tokens in pbar:
-    #         true_seq = tokenizer.decode(tokens[0].numpy())
-    #         # pytorch: Encode waveform at a time
-    #         start = time.time()
-    #         pred_seq, frames = fullseq_decode(pytorch_decoder, waveform)
-    #         # pbar.write(true_seq)
-    #         # pbar.write(pred_seq)
-    #         elapsed = time.time() - start
-    #         total_time += elapsed
-    #         total_frame += frames
-    #         wer = jiwer.wer(true_seq, pred_seq)
-    #         wers.append(wer)
-    #         pbar.set_postfix(wer='%.3f' % wer, elapsed='%.3f' % elapsed)
-    # wer = np.mean(wers)
-    # print('Mean wer: %.3f, Frame: %d, Time: %.3f, FPS: %.3f, speed: %.3f' % (
-    #     wer, total_frame, total_time, total_frame / total_time,
-    #     total_frame / total_time / 16000))
-
-    pytorch_decoder.reset_profile()
+def evaluate(name, stream_decoder, dataloader, tokenizer):
+    stream_decoder.reset_profile()
     wers = []
     total_time = 0
     total_frame = 0
     with tqdm(dataloader, dynamic_ncols=True) as pbar:
-        pbar.set_description("Pytorch frame wise decode")
+        pbar.set_description("%s frame wise decode" % name)
         for waveform, tokens in pbar:
             true_seq = tokenizer.decode(tokens[0].numpy())
-            # pytorch: Encode waveform at a time
             start = time.time()
-            pred_seq, frames = stream_decode(pytorch_decoder, waveform)
+            pred_seq, frames = stream_decode(stream_decoder, waveform)
             elapsed = time.time() - start
             total_time += elapsed
             total_frame += frames
@@ -108,43 +88,58 @@ def main(argv):
     print('Mean wer: %.3f, Frame: %d, Time: %.3f, FPS: %.3f, speed: %.3f' % (
         wer, total_frame, total_time, total_frame / total_time,
         total_frame / total_time / 16000))
-    print("Mean encoding time: %.3f ms" % (1000 * np.mean(
-        pytorch_decoder.encoder_elapsed)))
-    print("Mean decoding time: %.3f ms" % (1000 * np.mean(
-        pytorch_decoder.decoder_elapsed)))
-    print("Mean joint time: %.3f ms" % (1000 * np.mean(
-        pytorch_decoder.joint_elapsed)))
-
-    openvino_decoder = OpenVINOStreamDecoder(FLAGS)
-    openvino_decoder.reset_profile()
-    wers = []
-    total_time = 0
-    total_frame = 0
-    with tqdm(dataloader, dynamic_ncols=True) as pbar:
-        pbar.set_description("OpenVINO frame wise decode")
-        for waveform, tokens in pbar:
-            true_seq = tokenizer.decode(tokens[0].numpy())
-            # pytorch: Encode waveform at a time
-            start = time.time()
-            pred_seq, frames = stream_decode(openvino_decoder, waveform)
-            # pbar.write(true_seq)
-            # pbar.write(pred_seq)
-            elapsed = time.time() - start
-            total_time += elapsed
-            total_frame += frames
-            wer = jiwer.wer(true_seq, pred_seq)
-            wers.append(wer)
-            pbar.set_postfix(wer='%.3f' % wer, elapsed='%.3f' % elapsed)
-    wer = np.mean(wers)
-    print('Mean wer: %.3f, Frame: %d, Time: %.3f, FPS: %.3f, speed: %.3f' % (
-        wer, total_frame, total_time, total_frame / total_time,
-        total_frame / total_time / 16000))
-    print("Mean encoding time: %.3f ms" % (1000 * np.mean(
-        openvino_decoder.encoder_elapsed)))
-    print("Mean decoding time: %.3f ms" % (1000 * np.mean(
-        openvino_decoder.decoder_elapsed)))
-    print("Mean joint time: %.3f ms" % (1000 * np.mean(
-        openvino_decoder.joint_elapsed)))
+    result = {
+        'name': name,
+        'wer': float(wer),
+        # seconds of decoding per second of audio
+        'rtf': total_time / (total_frame / 16000),
+        'encoder_ms': 1000 * float(np.mean(
+            stream_decoder.encoder_elapsed or [0])),
+        'decoder_ms': 1000 * float(np.mean(
+            stream_decoder.decoder_elapsed or [0])),
+        'joint_ms': 1000 * float(np.mean(
+            stream_decoder.joint_elapsed or [0])),
+    }
+    print("Mean encoding time: %.3f ms" % result['encoder_ms'])
+    print("Mean decoding time: %.3f ms" % result['decoder_ms'])
+    print("Mean joint time: %.3f ms" % result['joint_ms'])
+    return result
+
+
+def main(argv):
+    assert FLAGS.step_n_frame % 2 == 0, ("step_n_frame must be divisible by "
+                                         "reduction_factor of TimeReduction")
+
+    tokenizer = HuggingFaceTokenizer(
+        cache_dir=os.path.join('logs', FLAGS.name), vocab_size=FLAGS.bpe_size)
+
+    dataloader = DataLoader(
+        dataset=MergedDataset([
+            Librispeech(
+                root=FLAGS.LibriSpeech_test,
+                tokenizer=tokenizer,
+                transform=None,
+                reverse_sorted_by_length=True)]),
+        batch_size=1, shuffle=False, num_workers=0)
+
+    results = []
+    for name in FLAGS.decoders:
+        stream_decoder = build_decoder(name)
+        results.append(evaluate(name, stream_decoder, dataloader, tokenizer))
+
+    # comparison against the first decoder, usually the fp32 pytorch one
+    base = results[0]
+    print("=" * 40)
+    print("%-12s %8s %8s %10s %10s %10s" % (
+        'decoder', 'wer', 'rtf', 'speedup', 'encoder', 'joint'))
+    for result in results:
+        print("%-12s %8.3f %8.3f %9.2fx %8.3fms %8.3fms" % (
+            result['name'], result['wer'], result['rtf'],
+            base['rtf'] / result['rtf'], result['encoder_ms'],
+            result['joint_ms']))
+    if FLAGS.report is not None:
+        with open(FLAGS.report, 'w') as f:
+            json.dump(results, f, indent=2)
 
 
 if __name__ == '__main__':
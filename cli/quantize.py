@@ -0,0 +1,97 @@
+import os
+
+import torch
+from absl import app, flags
+
+from rnnt.args import FLAGS                             # define training FLAGS
+from rnnt.transforms import build_transform
+from rnnt.tokenizer import HuggingFaceTokenizer
+from rnnt.compress import encoder_latency, factorize_transducer
+from rnnt.models import Transducer, quantize_transducer
+
+
+flags.DEFINE_string('model_name', "last.pt", help='checkpoint name')
+flags.DEFINE_string('output_name', None,
+                    help='quantized checkpoint name, defaults to '
+                         '<model_name>.int8.pt')
+flags.DEFINE_integer('step_n_frame', 2, help='input frame(stacked)')
+flags.DEFINE_integer('repeat', 100, help='encoder calls timed per model')
+
+
+def main(argv):
+    logdir = os.path.join('logs', FLAGS.name)
+
+    tokenizer = HuggingFaceTokenizer(
+        cache_dir=logdir, vocab_size=FLAGS.bpe_size)
+
+    _, _, input_size = build_transform(
+        feature_type=FLAGS.feature, feature_size=FLAGS.feature_size,
+        n_fft=FLAGS.n_fft, win_length=FLAGS.win_length,
+        hop_length=FLAGS.hop_length, delta=FLAGS.delta, cmvn=FLAGS.cmvn,
+        downsample=FLAGS.downsample,
+        T_mask=FLAGS.T_mask, T_num_mask=FLAGS.T_num_mask,
+        F_mask=FLAGS.F_mask, F_num_mask=FLAGS.F_num_mask
+    )
+
+    model_path = os.path.join(logdir, 'models', FLAGS.model_name)
+    checkpoint = torch.load(model_path, lambda storage, loc: storage)
+    transducer = Transducer(
+        vocab_embed_size=FLAGS.vocab_embed_size,
+        vocab_size=tokenizer.vocab_size,
+        input_size=input_size,
+        enc_hidden_size=FLAGS.enc_hidden_size,
+        enc_layers=FLAGS.enc_layers,
+        enc_dropout=FLAGS.enc_dropout,
+        enc_proj_size=FLAGS.enc_proj_size,
+        dec_hidden_size=FLAGS.dec_hidden_size,
+        dec_layers=FLAGS.dec_layers,
+        dec_dropout=FLAGS.dec_dropout,
+        dec_proj_size=FLAGS.dec_proj_size,
+        joint_size=FLAGS.joint_size,
+        output_loss=False,
+        dec_type=FLAGS.dec_type,
+        dec_context_size=FLAGS.dec_context_size,
+    )
+    factorize_transducer(transducer, checkpoint.get('ranks', {}))
+    transducer.load_state_dict(checkpoint['model'])
+    transducer.eval()
+    quantized = quantize_transducer(transducer)
+
+    output_name = FLAGS.output_name
+    if output_name is None:
+        output_name = os.path.splitext(FLAGS.model_name)[0] + '.int8.pt'
+    output_path = os.path.join(logdir, 'models', output_name)
+    # loaded by PytorchStreamDecoder, which quantizes the model it builds
+    # before loading the int8 weights
+    torch.save({
+        'model': quantized.state_dict(),
+        'ranks': checkpoint.get('ranks', {}),
+        'quantized': True,
+    }, output_path)
+
+    fp32_path = os.path.join(logdir, 'models', 'fp32.tmp')
+    torch.save({'model': transducer.state_dict()}, fp32_path)
+    fp32_size = os.path.getsize(fp32_path)
+    os.remove(fp32_path)
+    int8_size = os.path.getsize(output_path)
+
+    # one streaming chunk at a time, like the stream decoders
+    xs = torch.rand(1, FLAGS.step_n_frame, input_size)
+    hidden = (
+        torch.zeros(FLAGS.enc_layers, 1, FLAGS.enc_hidden_size),
+        torch.zeros(FLAGS.enc_layers, 1, FLAGS.enc_hidden_size))
+    fp32_latency = encoder_latency(
+        transducer.encoder, xs, hidden, FLAGS.repeat)
+    int8_latency = encoder_latency(
+        quantized.encoder, xs, hidden, FLAGS.repeat)
+
+    print("Quantized model has been saved to %s" % output_path)
+    print("Checkpoint size : %.2f MB -> %.2f MB (%.2fx)" % (
+        fp32_size / 2**20, int8_size / 2**20, fp32_size / int8_size))
+    print("Encoder latency : %.3f ms -> %.3f ms (%.2fx)" % (
+        fp32_latency * 1000, int8_latency * 1000,
+        fp32_latency / int8_latency))
+
+
+if __name__ == '__main__':
+    app.run(main)
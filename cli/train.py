@@ -14,8 +14,9 @@ from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
 from rnnt.transforms import build_transform, TrimAudio
 from rnnt.args import FLAGS
-from rnnt.dataset import seq_collate, MergedDataset, Librispeech, CommonVoice, TEDLIUM, YoutubeCaption
-from rnnt.models import Transducer, FrontEnd
+from rnnt.cache import build_decoder_cache
+from rnnt.dataset import SeqCollate, BucketBatchSampler, MergedDataset, Librispeech, CommonVoice, TEDLIUM, YoutubeCaption
+from rnnt.models import Transducer, FrontEnd, time_reduction_factor
 from rnnt.tokenizer import HuggingFaceTokenizer, CharTokenizer
 from rnnt.transforms import build_transform
 
@@ -72,23 +73,34 @@ class Trainer:
                 cache_dir='BPE-2048', vocab_size=FLAGS.bpe_size)
 
         # Dataloader
-        self.dataloader_train = DataLoader(
-            dataset=MergedDataset([
-                Librispeech(
-                    root=FLAGS.LibriSpeech_train_100,
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-                Librispeech(
-                    root=FLAGS.LibriSpeech_dev,
-                    tokenizer=self.tokenizer,
-                    transform=transform_train,
-                    audio_max_length=FLAGS.audio_max_length),
-            ]),
-            batch_size=FLAGS.batch_size, shuffle=True,
-            num_workers=FLAGS.num_workers, collate_fn=seq_collate,
-            drop_last=True
-        )
+        dataset_train = MergedDataset([
+            Librispeech(
+                root=FLAGS.LibriSpeech_train_100,
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+            Librispeech(
+                root=FLAGS.LibriSpeech_dev,
+                tokenizer=self.tokenizer,
+                transform=transform_train,
+                audio_max_length=FLAGS.audio_max_length),
+        ])
+        # padded to the time reduction once the model is built
+        self.collate = SeqCollate()
+        if FLAGS.max_batch_seconds > 0:
+            self.dataloader_train = DataLoader(
+                dataset=dataset_train,
+                batch_sampler=BucketBatchSampler(
+                    dataset_train.durations(), FLAGS.max_batch_seconds),
+                num_workers=FLAGS.num_workers, collate_fn=self.collate,
+                pin_memory=torch.cuda.is_available())
+        else:
+            self.dataloader_train = DataLoader(
+                dataset=dataset_train,
+                batch_size=FLAGS.batch_size, shuffle=True,
+                num_workers=FLAGS.num_workers, collate_fn=self.collate,
+                pin_memory=torch.cuda.is_available(),
+                drop_last=True)
 
         self.dataloader_val = DataLoader(
             dataset=MergedDataset([
@@ -98,9 +110,12 @@ class Trainer:
                     transform=transform_test,
                     reverse_sorted_by_length=True)]),
             batch_size=FLAGS.eval_batch_size, shuffle=False,
-            num_workers=FLAGS.num_workers, collate_fn=seq_collate)
+            num_workers=FLAGS.num_workers, collate_fn=self.collate,
+            pin_memory=torch.cuda.is_available())
 
         self.tokenizer.build(self.dataloader_train.dataset.texts())
+        self.dataloader_train.dataset.cache_tokens()
+        self.dataloader_val.dataset.cache_tokens()
         self.vocab_size = self.dataloader_train.dataset.tokenizer.vocab_size
 
         # Model
@@ -123,6 +138,11 @@ class Trainer:
             dec_dropout=FLAGS.dec_dropout,
             dec_proj_size=FLAGS.dec_proj_size,
             joint_size=FLAGS.joint_size,
+            dec_type=FLAGS.dec_type,
+            dec_context_size=FLAGS.dec_context_size,
+            loss_chunk_size=FLAGS.loss_chunk_size,
+            loss_type=FLAGS.loss,
+            packed_encoder=FLAGS.packed_encoder,
         )
         if FLAGS.use_pretrained:
             self.frontend, self.model = load_pretrained_model(self.frontend, self.model)
@@ -130,6 +150,8 @@ class Trainer:
 
         self.frontend = self.frontend.to(device)
         self.model = self.model.to(device)
+        self.collate.pad_to_multiple = time_reduction_factor(
+            self.model.encoder)
 
         # Optimizer
         if FLAGS.optim == 'adam':
@@ -151,6 +173,8 @@ class Trainer:
         # Multi GPU
         if FLAGS.multi_gpu:
             self.model = torch.nn.DataParallel(self.model)
+        # built for the duration of `evaluate`
+        self.decoder_cache = None
 
     def scale_length(self, prob, xlen):
         scale = (xlen.max().float() / prob.shape[1]).ceil()
@@ -222,7 +246,7 @@ class Trainer:
 
     def train_step(self, batch):
         sub_losses = []
-        start_idxs = range(0, FLAGS.batch_size, FLAGS.sub_batch_size)
+        start_idxs = range(0, len(batch[0]), FLAGS.sub_batch_size)
         self.optim.zero_grad()
         for sub_batch_idx, start_idx in enumerate(start_idxs):
             sub_slice = slice(start_idx, start_idx + FLAGS.sub_batch_size)
@@ -239,7 +263,6 @@ class Trainer:
             #     print(xlen, xs.shape, max_length, xs_shape, xlen_, xlen.float() / ( max_length.item() / xs_shape ))
 
             xlen = xlen_
-            xs = xs[:, :xlen.max()].contiguous()
 
             loss = self.model(xs, ys, xlen, ylen)
 
@@ -276,6 +299,12 @@ class Trainer:
         losses = []
         pred_seqs = []
         true_seqs = []
+        if FLAGS.multi_gpu:
+            model = self.model.module
+        else:
+            model = self.model
+        # weights are fixed during evaluation, drop the cache afterwards
+        self.decoder_cache = build_decoder_cache(FLAGS, model.decoder_step)
         with torch.no_grad():
             with tqdm(self.dataloader_val, dynamic_ncols=True) as pbar:
                 for batch in pbar:
@@ -286,6 +315,9 @@ class Trainer:
                     pred_seqs.extend(pred_seq[:sample_nums])
                     true_seqs.extend(true_seq[:sample_nums])
                     pbar.set_description('wer: %.4f, loss: %.4f' % (wer, loss))
+        if self.decoder_cache is not None:
+            print('decoder cache: %s' % self.decoder_cache.stats())
+            self.decoder_cache = None
         loss = np.mean(losses)
         wer = np.mean(wers)
         self.model.train()
@@ -304,15 +336,20 @@ class Trainer:
         xlen = xlen_
         xs = xs[:, :xlen.max()].contiguous()
 
-        xs = xs[:, :xlen.max()]
-
         loss = self.model(xs, ys, xlen, ylen)
         if FLAGS.multi_gpu:
             loss = loss.mean()
         if FLAGS.multi_gpu:
-            ys_hat, nll = self.model.module.greedy_decode(xs, xlen)
+            model = self.model.module
+        else:
+            model = self.model
+        if FLAGS.beam_size > 1:
+            ys_hat, nll = model.beam_search(
+                xs, xlen, FLAGS.beam_size, FLAGS.max_sym_per_frame,
+                cache=self.decoder_cache)
         else:
-            ys_hat, nll = self.model.greedy_decode(xs, xlen)
+            ys_hat, nll = model.greedy_decode(
+                xs, xlen, cache=self.decoder_cache)
         pred_seq = self.tokenizer.decode_plus(ys_hat)
         true_seq = self.tokenizer.decode_plus(ys.cpu().numpy())
         wer = jiwer.wer(true_seq, pred_seq)
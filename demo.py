@@ -96,7 +96,8 @@ class OpenVINOStreamDecoder():
                 'input_h_dec': self.dec_x[:, 0]
             })
             # print(outputs.keys())
-            prob = outputs['Gemm_3']
+            # the joint has a single output, its node name depends on the export
+            prob = next(iter(outputs.values()))
             pred = prob.argmax(axis=-1).item()
 
             if pred != NUL:
@@ -29,6 +29,8 @@ python export_onnx.py \
     --model_name ${MODEL_NAME} \
     --step_n_frame ${STEP_N_FRAME}
 
+# STEP_N_FRAME is only the initial encoder shape, OpenVINOStreamDecoder
+# reshapes the network for other chunk sizes at runtime
 python3 /opt/intel/openvino/deployment_tools/model_optimizer/mo.py \
     --framework onnx \
     --input_model ${LOGDIR}/encoder.onnx \
@@ -28,12 +28,17 @@ flags.DEFINE_string('TEDLIUM_test',
                     help='TEDLIUM 1 test')
 flags.DEFINE_string('CommonVoice', "../speech_data/common_voice",
                     help='common voice')
+flags.DEFINE_string('YoutubeCaption', "../speech_data/youtube-speech-text/",
+                    help='youtube captions, one *_meta.csv per channel')
 flags.DEFINE_string('YT_bloomberg2', "../speech_data/common_voice",
                     help='common voice')
 flags.DEFINE_string('YT_life', "../speech_data/common_voice",
                     help='common voice')
 
 flags.DEFINE_integer('num_workers', 4, help='dataloader workers')
+flags.DEFINE_string('feature_dir', None,
+                    help='features of cli/dump_features.py, if set every '
+                         'dumped dataset is used for training')
 # learning
 flags.DEFINE_bool('use_pretrained', default=False, help='Use pretrained enncoder')
 flags.DEFINE_enum('optim', "adam", ['adam', 'sgd', 'sm3'], help='optimizer')
@@ -46,6 +51,9 @@ flags.DEFINE_integer('warmup_step', 10000, help='linearly warmup lr')
 flags.DEFINE_integer('epochs', 30, help='epoch')
 flags.DEFINE_integer('batch_size', 8, help='batch size')
 flags.DEFINE_integer('sub_batch_size', 8, help='accumulate batch size')
+flags.DEFINE_float('max_batch_seconds', 0,
+                   help='padded audio seconds per training batch, batches '
+                        'utterances of similar durations, 0 uses batch_size')
 flags.DEFINE_integer('eval_batch_size', 4, help='evaluation batch size')
 flags.DEFINE_float('gradclip', None, help='clip norm value')
 # encoder
@@ -54,13 +62,43 @@ flags.DEFINE_integer('enc_hidden_size', 600, help='encoder hidden dimension')
 flags.DEFINE_integer('enc_layers', 4, help='encoder layers')
 flags.DEFINE_integer('enc_proj_size', 600, help='encoder layers')
 flags.DEFINE_float('enc_dropout', 0, help='encoder dropout')
+flags.DEFINE_bool('packed_encoder', False,
+                  help='run the encoder on packed sequences in training, '
+                       'skips the padding frames')
 # decoder
 flags.DEFINE_integer('dec_hidden_size', 150, help='decoder hidden dimension')
 flags.DEFINE_integer('dec_layers', 2, help='decoder layers')
 flags.DEFINE_integer('dec_proj_size', 150, help='encoder layers')
 flags.DEFINE_float('dec_dropout', 0., help='decoder dropout')
+flags.DEFINE_enum('dec_type', 'LSTM', ['LSTM', 'stateless'],
+                  help='prediction network, stateless only sees the last '
+                       'dec_context_size tokens')
+flags.DEFINE_integer('dec_context_size', 2,
+                     help='tokens seen by the stateless decoder')
 # joint
 flags.DEFINE_integer('joint_size', 512, help='Joint hidden dimension')
+flags.DEFINE_integer('loss_chunk_size', 0,
+                     help='encoder frames per joint+loss chunk, 0 computes '
+                          'the full logits')
+flags.DEFINE_enum('loss', 'warp', ['warp', 'torch'],
+                  help='transducer loss, warp falls back to torch if '
+                       'warprnnt_pytorch is missing')
+# decoding
+flags.DEFINE_integer('beam_size', 1, help='beam size, 1 is greedy decoding')
+flags.DEFINE_integer('max_sym_per_frame', 1,
+                     help='max labels emitted per frame in beam search')
+flags.DEFINE_integer('decoder_cache_size', 0,
+                     help='cached prediction network outputs, 0 disables')
+flags.DEFINE_integer('decoder_cache_context', 0,
+                     help='tokens of history in the cache key, 0 keys on '
+                          'the full history')
+flags.DEFINE_enum('decoder_cache_policy', 'lru', ['lru', 'fifo'],
+                  help='decoder cache eviction')
+flags.DEFINE_bool('torchscript', False,
+                  help='stream with scripted encoder, decoder and joint')
+flags.DEFINE_bool('quantize', False,
+                  help='int8 weights for CPU inference, dynamic quantization '
+                       'in pytorch and the .int8.onnx graphs in onnxruntime')
 # tokenizer
 flags.DEFINE_enum('tokenizer', 'char', ['char', 'bpe'], help='tokenizer')
 flags.DEFINE_integer('bpe_size', 256, help='BPE vocabulary size')
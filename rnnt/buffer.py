@@ -0,0 +1,137 @@
+import numpy as np
+import torch
+
+
+class RingBuffer:
+    """Fixed capacity float32 audio buffer with zero-copy windows.
+
+    Samples are written twice, at `i` and `i + capacity` of a storage of
+    `2 * capacity` samples, so every window of up to `capacity` samples is
+    a contiguous slice of the storage and can be returned as a view. No
+    sample buffers are reallocated after construction, `peek` and `windows`
+    only create view objects.
+
+    Views returned by `windows` and `peek` share memory with the buffer and
+    are only valid until the next `write`.
+    """
+    def __init__(self, capacity, channels=1):
+        self.capacity = capacity
+        self.storage = np.zeros((channels, 2 * capacity), dtype=np.float32)
+        self.tensor = torch.from_numpy(self.storage)
+        # absolute positions, `end - start` samples are buffered
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def write(self, x, scale=1.):
+        """Append samples [channels, N] or [N], numpy or CPU tensor of any
+        dtype. Samples are multiplied by `scale` while they are copied, e.g.
+        1 / 32768 for int16 PCM, without a temporary array."""
+        if isinstance(x, torch.Tensor):
+            x = x.numpy()
+        if x.ndim == 1:
+            x = x[None]
+        size = x.shape[1]
+        if size > self.capacity - len(self):
+            raise OverflowError(
+                'ring buffer overflow, %d samples buffered, capacity %d' % (
+                    len(self) + size, self.capacity))
+        pos = self.end % self.capacity
+        first = min(size, self.capacity - pos)
+        for offset in [pos, pos + self.capacity]:
+            np.multiply(
+                x[:, :first], scale, out=self.storage[:, offset:offset + first],
+                casting='unsafe')
+        if size > first:
+            for offset in [0, self.capacity]:
+                np.multiply(
+                    x[:, first:], scale,
+                    out=self.storage[:, offset:offset + size - first],
+                    casting='unsafe')
+        self.end += size
+
+    def peek(self, size):
+        """View of the oldest `size` samples, [channels, size]"""
+        assert size <= len(self)
+        pos = self.start % self.capacity
+        return self.tensor[:, pos:pos + size]
+
+    def advance(self, size):
+        self.start += min(size, len(self))
+
+    def windows(self, win_size, hop_size):
+        """Yield every complete `win_size` window and advance by
+        `hop_size` after each one"""
+        while len(self) >= win_size:
+            yield self.peek(win_size)
+            self.advance(hop_size)
+
+
+if __name__ == "__main__":
+    import time
+    import tracemalloc
+    from collections import Counter
+
+    sample_rate = 16000
+    frame_size = 1152               # samples per decoded mp3 frame
+    win_size = 400 + 200 * (3 * 2 - 1)
+    hop_size = 200 * 3 * 2
+    seconds = 60
+    frames = [
+        np.random.randn(1, frame_size).astype(np.float32)
+        for _ in range(seconds * sample_rate // frame_size)]
+
+    def concat_steps():
+        # the np.concatenate / slicing pattern this buffer replaces
+        buffer = np.zeros((1, 0), dtype=np.float32)
+        for frame in frames:
+            buffer = np.concatenate([buffer, frame], axis=1)
+            while buffer.shape[1] >= win_size:
+                window = buffer[:, :win_size]
+                buffer = buffer[:, hop_size:]
+            yield
+
+    ring = RingBuffer(capacity=4 * win_size)
+
+    def ring_steps():
+        ring.reset()
+        for frame in frames:
+            ring.write(frame)
+            for window in ring.windows(win_size, hop_size):
+                pass
+            yield
+
+    def new_buffers(steps):
+        """Sample buffers allocated by each step, from tracemalloc
+        snapshots of the numpy data domain taken between the steps"""
+        traced = [tracemalloc.DomainFilter(True, np.lib.tracemalloc_domain)]
+        counts = []
+        before = None
+        tracemalloc.start()
+        for _ in steps:
+            snapshot = tracemalloc.take_snapshot().filter_traces(traced)
+            after = Counter(snapshot.traces)
+            if before is not None:
+                counts.append(sum((after - before).values()))
+            before = after
+        tracemalloc.stop()
+        return np.mean(counts)
+
+    for name, steps in [('concatenate', concat_steps), ('ring', ring_steps)]:
+        for _ in steps():                               # warm up
+            pass
+        start = time.time()
+        for _ in steps():
+            pass
+        elapsed = time.time() - start
+        allocations = new_buffers(steps())
+        print('%-12s: %7.2f ms for %ds of audio, %.2f allocations per '
+              'frame, %.1f per second of audio' % (
+                  name, elapsed * 1000, seconds, allocations,
+                  allocations * sample_rate / frame_size))
@@ -0,0 +1,158 @@
+from collections import OrderedDict
+
+import torch
+
+
+class DecoderCache:
+    """Prediction network outputs keyed by the token history.
+
+    The output and hidden state of the prediction network depend only on the
+    tokens fed so far, so every decoding path can look them up instead of
+    rerunning embed, LSTM and projection for a history it has already seen.
+
+    Args:
+        step_fn (callable): `step_fn(tokens, hidden) -> (output, hidden)`
+            runs one step of the prediction network on tokens [N, 1] and a
+            tuple of hidden states, each [L, N, H]. None if the cache is only
+            used through `lookup` and `insert`.
+        max_size (int): max number of cached histories, None is unbounded.
+        context_size (int): only the last `context_size` tokens form the
+            key, None keys on the full history. A bounded context is exact
+            for a prediction network with a finite context and an
+            approximation for the LSTM one.
+        policy (str): 'lru' or 'fifo' eviction.
+    """
+    def __init__(self, step_fn=None, max_size=1024, context_size=None,
+                 policy='lru'):
+        if policy not in ['lru', 'fifo']:
+            raise ValueError('Unsupported eviction policy')
+        self.step_fn = step_fn
+        self.max_size = max_size
+        self.context_size = context_size
+        self.policy = policy
+        self.entries = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def trim(self, prefix):
+        """Drop `prefix` from the front of every full-history key, entries
+        which do not start with it are removed"""
+        n = len(prefix)
+        self.entries = OrderedDict(
+            (key[n:], value) for key, value in self.entries.items()
+            if key[:n] == prefix)
+
+    def key(self, history):
+        history = tuple(history)
+        if self.context_size is not None:
+            history = history[len(history) - self.context_size:]
+        return history
+
+    def lookup(self, history):
+        key = self.key(history)
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.policy == 'lru':
+            self.entries.move_to_end(key)
+        return value
+
+    def insert(self, history, value):
+        key = self.key(history)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if self.max_size is not None:
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def step(self, histories, hidden, rows=None):
+        """Advance the prediction network of a batch of hypotheses.
+
+        Args:
+            histories (list): token tuple of each hypothesis after the step,
+                the last token is the one fed to the network.
+            hidden (tuple): hidden states, each [L, N, H], to start misses
+                from.
+            rows (list): row of `hidden` each history continues from,
+                defaults to one row per history.
+
+        Returns:
+            (Tensor, tuple): outputs [len(histories), H] and hidden states
+            [L, len(histories), H] after the step.
+        """
+        if rows is None:
+            rows = list(range(len(histories)))
+        values = [self.lookup(history) for history in histories]
+        misses = OrderedDict()
+        for i, (history, value) in enumerate(zip(histories, values)):
+            key = self.key(history)
+            if value is None and key not in misses:
+                misses[key] = i
+        if len(misses) > 0:
+            index = list(misses.values())
+            device = hidden[0].device
+            tokens = torch.tensor(
+                [histories[i][-1] for i in index], device=device)
+            miss_rows = torch.tensor([rows[i] for i in index], device=device)
+            outputs, new_hidden = self.step_fn(
+                tokens.unsqueeze(1), tuple(x[:, miss_rows] for x in hidden))
+            computed = {}
+            for j, i in enumerate(index):
+                value = (outputs[j], tuple(x[:, j] for x in new_hidden))
+                self.insert(histories[i], value)
+                computed[self.key(histories[i])] = value
+            values = [
+                computed[self.key(history)] if value is None else value
+                for history, value in zip(histories, values)]
+        outputs = torch.stack([value[0] for value in values])
+        hidden = tuple(
+            torch.stack([value[1][i] for value in values], dim=1)
+            for i in range(len(hidden)))
+        return outputs, hidden
+
+
+def build_decoder_cache(FLAGS, step_fn=None, bounded=False):
+    """DecoderCache configured by the decoder_cache_* flags, None if the
+    cache is disabled. A stateless prediction network is keyed exactly by
+    its own context unless a context is given. With `bounded`, e.g. for a
+    stream whose history is never trimmed, the key must have a finite
+    context."""
+    if FLAGS.decoder_cache_size <= 0:
+        return None
+    context_size = FLAGS.decoder_cache_context or None
+    if context_size is None and FLAGS.dec_type == 'stateless':
+        context_size = FLAGS.dec_context_size
+    if context_size is None and bounded:
+        raise ValueError(
+            'a full-history decoder cache grows without bound on a stream, '
+            'set --decoder_cache_context')
+    return DecoderCache(
+        step_fn, max_size=FLAGS.decoder_cache_size,
+        context_size=context_size, policy=FLAGS.decoder_cache_policy)
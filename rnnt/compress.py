@@ -0,0 +1,253 @@
+import time
+
+import torch
+from torch import nn
+
+
+def choose_rank(weight, rank=None, energy=None):
+    """Smallest rank which keeps `energy` of the squared singular values of
+    `weight`, or `rank` capped to the full rank"""
+    full_rank = min(weight.shape)
+    if rank is not None:
+        return min(rank, full_rank)
+    s = torch.svd(weight.detach().float())[1]
+    cumulative = (s ** 2).cumsum(0) / (s ** 2).sum()
+    return min(int((cumulative < energy).sum().item()) + 1, full_rank)
+
+
+def svd_factors(weight, rank):
+    """(U, V) with U @ V the best rank `rank` approximation of `weight`"""
+    u, s, v = torch.svd(weight.detach().float())
+    u = u[:, :rank] * s[:rank].sqrt()
+    v = v[:, :rank] * s[:rank].sqrt()
+    return u.contiguous(), v.t().contiguous()
+
+
+def saves_parameters(weight, rank):
+    return rank * sum(weight.shape) < weight.numel()
+
+
+class LowRankLinear(nn.Module):
+    """Linear layer with its weight factorized as `second @ first`"""
+    def __init__(self, in_features, out_features, rank, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.first = nn.Linear(in_features, rank, bias=False)
+        self.second = nn.Linear(rank, out_features, bias=bias)
+
+    @classmethod
+    def from_linear(cls, linear, rank):
+        module = cls(
+            linear.in_features, linear.out_features, rank,
+            bias=linear.bias is not None)
+        u, v = svd_factors(linear.weight, rank)
+        module.first.weight.data.copy_(v)
+        module.second.weight.data.copy_(u)
+        if linear.bias is not None:
+            module.second.bias.data.copy_(linear.bias.data)
+        return module
+
+    def forward(self, xs):
+        return self.second(self.first(xs))
+
+
+class FactorizedLSTM(nn.Module):
+    """Single layer batch first LSTM with low rank weights.
+
+    The input weight is factorized by projecting the input to `rank_ih`
+    features before a regular `nn.LSTM`, so the fused kernel is still used.
+    If `rank_hh` is given, the recurrent weight is factorized as well and the
+    cell is stepped in python, which only pays off for large hidden sizes
+    and short chunks. Called like `nn.LSTM` with states [1, B, H].
+    """
+    def __init__(self, input_size, hidden_size, rank_ih, rank_hh=None):
+        super().__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        self.rank_ih = rank_ih
+        self.rank_hh = rank_hh
+        self.input_proj = nn.Linear(input_size, rank_ih, bias=False)
+        if rank_hh is None:
+            self.lstm = nn.LSTM(rank_ih, hidden_size, 1, batch_first=True)
+        else:
+            # bias_ih + bias_hh
+            self.input_gates = nn.Linear(rank_ih, 4 * hidden_size)
+            self.recurrent = LowRankLinear(
+                hidden_size, 4 * hidden_size, rank_hh, bias=False)
+
+    @classmethod
+    def from_lstm(cls, lstm, rank_ih, rank_hh=None):
+        module = cls(lstm.input_size, lstm.hidden_size, rank_ih, rank_hh)
+        u, v = svd_factors(lstm.weight_ih_l0, rank_ih)
+        module.input_proj.weight.data.copy_(v)
+        if rank_hh is None:
+            module.lstm.weight_ih_l0.data.copy_(u)
+            module.lstm.weight_hh_l0.data.copy_(lstm.weight_hh_l0.data)
+            module.lstm.bias_ih_l0.data.copy_(lstm.bias_ih_l0.data)
+            module.lstm.bias_hh_l0.data.copy_(lstm.bias_hh_l0.data)
+        else:
+            module.input_gates.weight.data.copy_(u)
+            module.input_gates.bias.data.copy_(
+                lstm.bias_ih_l0.data + lstm.bias_hh_l0.data)
+            u, v = svd_factors(lstm.weight_hh_l0, rank_hh)
+            module.recurrent.first.weight.data.copy_(v)
+            module.recurrent.second.weight.data.copy_(u)
+        return module
+
+    def forward(self, xs, hidden):
+        xs = self.input_proj(xs)
+        if self.rank_hh is None:
+            return self.lstm(xs, hidden)
+        h, c = hidden[0][0], hidden[1][0]
+        gates_xs = self.input_gates(xs)
+        ys = []
+        for t in range(xs.shape[1]):
+            gates = gates_xs[:, t] + self.recurrent(h)
+            i, f, g, o = gates.chunk(4, dim=1)
+            c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            ys.append(h)
+        return torch.stack(ys, dim=1), (h[None], c[None])
+
+
+def compressible_modules(modules):
+    """Names of the encoder LSTMs and projection and of the joint output
+    layer in `modules`, a dict of named modules. The first Linear of the
+    joint is left out, it is applied as separate encoder and decoder
+    projections. Modules which are already factorized, or part of a
+    factorized module, are skipped."""
+    factorized = [
+        name + '.' for name, module in modules.items()
+        if isinstance(module, (LowRankLinear, FactorizedLSTM))]
+    names = []
+    for name, module in modules.items():
+        if any(name.startswith(prefix) for prefix in factorized):
+            continue
+        if name.startswith('encoder.') and isinstance(module, nn.LSTM):
+            names.append(name)
+    for name in ['encoder.proj', 'joint.joint.2']:
+        if isinstance(modules.get(name), nn.Linear):
+            names.append(name)
+    return names
+
+
+def set_module(model, name, module):
+    *path, attr = name.split('.')
+    parent = model
+    for key in path:
+        parent = getattr(parent, key)
+    setattr(parent, attr, module)
+
+
+def compress_transducer(transducer, rank=None, energy=None,
+                        recurrent=False):
+    """Replace the compressible modules of `transducer` in place by their
+    SVD factorization at `rank` or at the rank which keeps `energy`.
+    Modules which would not get smaller are kept. The recurrent LSTM
+    weights are only factorized if `recurrent`.
+
+    Returns:
+        dict: module name -> ranks, to rebuild the structure with
+        `factorize_transducer` before loading a compressed state dict.
+    """
+    ranks = {}
+    modules = dict(transducer.named_modules())
+    for name in compressible_modules(modules):
+        module = modules[name]
+        if isinstance(module, nn.Linear):
+            r = choose_rank(module.weight, rank, energy)
+            if saves_parameters(module.weight, r):
+                set_module(
+                    transducer, name, LowRankLinear.from_linear(module, r))
+                ranks[name] = (r,)
+        else:
+            r_ih = choose_rank(module.weight_ih_l0, rank, energy)
+            r_hh = None
+            if recurrent:
+                r_hh = choose_rank(module.weight_hh_l0, rank, energy)
+                if not saves_parameters(module.weight_hh_l0, r_hh):
+                    r_hh = None
+            if saves_parameters(module.weight_ih_l0, r_ih) or \
+                    r_hh is not None:
+                set_module(
+                    transducer, name,
+                    FactorizedLSTM.from_lstm(module, r_ih, r_hh))
+                ranks[name] = (r_ih, r_hh)
+    return ranks
+
+
+def factorize_transducer(transducer, ranks):
+    """Swap in untrained factorized modules with the given `ranks`"""
+    modules = dict(transducer.named_modules())
+    for name, module_ranks in ranks.items():
+        module = modules[name]
+        if isinstance(module, nn.Linear):
+            set_module(transducer, name, LowRankLinear(
+                module.in_features, module.out_features, module_ranks[0],
+                bias=module.bias is not None))
+        else:
+            set_module(transducer, name, FactorizedLSTM(
+                module.input_size, module.hidden_size, *module_ranks))
+    return transducer
+
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def count_flops(model, *inputs):
+    """Multiply-adds of the Linear and LSTM layers of one forward pass,
+    times two"""
+    macs = [0]
+
+    def linear_hook(module, args, output):
+        macs[0] += output.numel() * module.in_features
+
+    def lstm_hook(module, args, output):
+        batch_size, length = args[0].shape[:2]
+        macs[0] += batch_size * length * 4 * module.hidden_size * (
+            module.input_size + module.hidden_size)
+
+    handles = []
+    for module in model.modules():
+        if isinstance(module, nn.Linear):
+            handles.append(module.register_forward_hook(linear_hook))
+        elif isinstance(module, nn.LSTM):
+            handles.append(module.register_forward_hook(lstm_hook))
+    with torch.no_grad():
+        model(*inputs)
+    for handle in handles:
+        handle.remove()
+    return 2 * macs[0]
+
+
+def encoder_latency(encoder, xs, hidden, repeat=100):
+    """Mean seconds of one encoder call on the chunk `xs`"""
+    with torch.no_grad():
+        for _ in range(10):
+            encoder(xs, hidden)
+        start = time.time()
+        for _ in range(repeat):
+            encoder(xs, hidden)
+    return (time.time() - start) / repeat
+
+
+if __name__ == "__main__":
+    # factorized modules at full rank match the dense ones
+    lstm = nn.LSTM(32, 48, 1, batch_first=True)
+    xs = torch.randn(3, 7, 32)
+    hidden = (torch.randn(1, 3, 48), torch.randn(1, 3, 48))
+    ys, (h, c) = lstm(xs, hidden)
+    for rank_hh in [None, 48]:
+        factorized = FactorizedLSTM.from_lstm(lstm, 32, rank_hh)
+        ys_f, (h_f, c_f) = factorized(xs, hidden)
+        assert torch.allclose(ys, ys_f, atol=1e-5)
+        assert torch.allclose(h, h_f, atol=1e-5)
+        assert torch.allclose(c, c_f, atol=1e-5)
+    linear = nn.Linear(32, 48)
+    assert torch.allclose(
+        linear(xs), LowRankLinear.from_linear(linear, 32)(xs), atol=1e-5)
+    print('energy 0.9 rank: %d' % choose_rank(
+        lstm.weight_ih_l0, energy=0.9))
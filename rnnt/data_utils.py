@@ -268,6 +268,42 @@ def filter_paired_dataset_indices_by_size(src_sizes, tgt_sizes, indices, max_siz
     return indices, ignored.tolist()
 
 
+def _batch_by_size_py(indices, num_tokens_fn, max_tokens, max_sentences, bsz_mult):
+    """Python version of `data_utils_fast.batch_by_size_fast`"""
+    sample_len = 0
+    sample_lens = []
+    batch = []
+    batches = []
+    for idx in indices.tolist():
+        num_tokens = num_tokens_fn(idx)
+        sample_lens.append(num_tokens)
+        sample_len = max(sample_len, num_tokens)
+
+        assert max_tokens <= 0 or sample_len <= max_tokens, (
+            "sentence at index {} of size {} exceeds max_tokens "
+            "limit of {}!".format(idx, sample_len, max_tokens)
+        )
+        num_tokens = (len(batch) + 1) * sample_len
+
+        is_full = len(batch) > 0 and (
+            (max_sentences > 0 and len(batch) == max_sentences)
+            or (max_tokens > 0 and num_tokens > max_tokens)
+        )
+        if is_full:
+            mod_len = max(
+                bsz_mult * (len(batch) // bsz_mult),
+                len(batch) % bsz_mult,
+            )
+            batches.append(batch[:mod_len])
+            batch = batch[mod_len:]
+            sample_lens = sample_lens[mod_len:]
+            sample_len = max(sample_lens) if len(sample_lens) > 0 else 0
+        batch.append(idx)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
 def batch_by_size(
     indices,
     num_tokens_fn,
@@ -294,15 +330,23 @@ def batch_by_size(
             *required_batch_size_multiple* will be ignored (default: None).
     """
     try:
-        from fairseq.data.data_utils_fast import (
+        from rnnt.data_utils_fast import (
             batch_by_size_fast,
             batch_fixed_shapes_fast,
         )
     except ImportError:
-        raise ImportError(
-            "Please build Cython components with: `pip install --editable .` "
-            "or `python setup.py build_ext --inplace`"
-        )
+        try:
+            from fairseq.data.data_utils_fast import (
+                batch_by_size_fast,
+                batch_fixed_shapes_fast,
+            )
+        except ImportError:
+            if fixed_shapes is not None:
+                raise ImportError(
+                    "Please build Cython components with: "
+                    "`cythonize -i rnnt/data_utils_fast.pyx`"
+                )
+            batch_by_size_fast = _batch_by_size_py
 
     max_tokens = max_tokens if max_tokens is not None else -1
     max_sentences = max_sentences if max_sentences is not None else -1
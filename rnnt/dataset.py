@@ -1,14 +1,17 @@
 import glob
 import os, sys
 import pickle
+from collections import namedtuple
 
 import numpy as np
 import pandas as pd
 import torchaudio
 import torch
-from torch.utils.data import DataLoader, Dataset, ConcatDataset
+from torch.utils.data import DataLoader, Dataset, ConcatDataset, Sampler
 from tqdm import tqdm
 
+from rnnt.data_utils import batch_by_size
+from rnnt.index import UtteranceIndex, encode_flat
 from rnnt.tokenizer import PAD
 
 
@@ -27,73 +30,86 @@ class MergedDataset(ConcatDataset):
             texts.extend(dataset.texts())
         return texts
 
+    def durations(self):
+        durations = []
+        for dataset in self.datasets:
+            durations.extend(dataset.durations())
+        return durations
+
+    def cache_tokens(self):
+        for dataset in self.datasets:
+            dataset.cache_tokens()
+
 
 class AudioDataset(Dataset):
     def __init__(self, root, tokenizer, session='', desc='AudioDataset',
                  transform=None, audio_min_length=0, audio_max_length=999,
-                 sampling_rate=16000, reverse_sorted_by_length=False):
+                 sampling_rate=16000, reverse_sorted_by_length=False,
+                 num_probe_workers=None):
         self.root = root
-        processed_labels = os.path.join(
-            root, 'preprocessed_v3_%s.pkl' % session)
-
-        if os.path.exists(processed_labels):
-            data = pickle.load(open(processed_labels, 'rb'))
-        else:
-            data = []
-            paths, texts = self.build()
-            pairs = list(zip(paths, texts))
-            with tqdm(pairs, dynamic_ncols=True, desc=desc) as pbar:
-                for path, text in pbar:
-                    full_path = os.path.join(root, path)
-                    try:
-                        if os.path.exists(full_path):
-                            wave, sr = torchaudio.load(
-                                full_path, normalization=False)
-                            if sr == sampling_rate:
-                                audio_length = len(wave[0]) // sr
-                                data.append({
-                                    'path': path,
-                                    'text': text,
-                                    'audio_length': audio_length})
-                    except RuntimeError:
-                        pbar.write('Fail to load %s' % full_path)
-            pickle.dump(data, open(processed_labels, 'wb'))
-
-        # length limits and text cleaning
-        total_secs = 0
-        filtered_secs = 0
-        self.data = []
-        for x in data:
-            if audio_min_length <= x['audio_length'] <= audio_max_length:
-                self.data.append(x)
-                total_secs += x['audio_length']
+        index_dir = os.path.join(
+            root, 'index_v%d_%s' % (UtteranceIndex.version, session))
+
+        if not UtteranceIndex.exists(index_dir):
+            legacy_labels = os.path.join(
+                root, 'preprocessed_v3_%s.pkl' % session)
+            if os.path.exists(legacy_labels):
+                # keep the utterances of the old index, with exact lengths
+                data = pickle.load(open(legacy_labels, 'rb'))
+                paths = [x['path'] for x in data]
+                texts = [x['text'] for x in data]
             else:
-                filtered_secs += x['audio_length']
+                paths, texts = self.build()
+            UtteranceIndex.build(
+                index_dir, root, paths, texts, num_probe_workers, desc)
+        self.index = UtteranceIndex(index_dir)
+
+        # length limits
+        durations = self.index.durations()
+        keep = (self.index.sample_rate == sampling_rate) & \
+            (audio_min_length <= durations) & \
+            (durations <= audio_max_length)
+        self.rows = np.nonzero(keep)[0]
         print('Dataset : %s' % desc)
-        print('size    : %d' % len(self.data))
-        print('Time    : %.2f hours' % (total_secs / 3600))
-        print('Filtered: %.2f hours' % (filtered_secs / 3600))
+        print('size    : %d' % len(self.rows))
+        print('Time    : %.2f hours' % (durations[keep].sum() / 3600))
+        print('Filtered: %.2f hours' % (durations[~keep].sum() / 3600))
         print('=' * 40)
 
         if reverse_sorted_by_length:
-            self.data = sorted(
-                self.data, key=lambda x: x['audio_length'], reverse=True)
-        # print(root, data[0]['path'])
+            self.rows = self.rows[
+                np.argsort(-durations[self.rows], kind='mergesort')]
         self.transform = transform
         self.tokenizer = tokenizer
+        self.token_ids = None
+        self.token_offsets = None
+        if tokenizer is not None and tokenizer.fingerprint() is not None:
+            self.cache_tokens()
+
+    def cache_tokens(self):
+        """Serve the token ids from a cache next to the index, called once
+        the tokenizer is built"""
+        self.token_ids, self.token_offsets = self.index.cache_tokens(
+            self.tokenizer)
 
     def texts(self):
-        return [x['text'] for x in self.data]
+        return [self.index.get_text(row) for row in self.rows]
+
+    def durations(self):
+        return self.index.durations()[self.rows].tolist()
+
+    def audio_path(self, idx):
+        return os.path.join(self.root, self.index.get_path(self.rows[idx]))
 
     def build(self):
         # return paths, texts, all path in paths is relative to self.root
         raise NotImplementedError()
 
     def __len__(self):
-        return len(self.data)
+        return len(self.rows)
 
     def __getitem__(self, idx):
-        path = os.path.join(self.root, self.data[idx]['path'])
+        path = self.audio_path(idx)
         try:
             data, sr = torchaudio.load(path, normalization=True)
         except Exception:
@@ -104,8 +120,14 @@ class AudioDataset(Dataset):
         else:
             data = data[0]
 
-        texts = self.data[idx]['text']
-        tokens = torch.from_numpy(np.array(self.tokenizer.encode(texts)))
+        row = self.rows[idx]
+        if self.token_ids is not None:
+            tokens = torch.from_numpy(self.token_ids[
+                self.token_offsets[row]:self.token_offsets[row + 1]])
+        else:
+            texts = self.index.get_text(row)
+            tokens = torch.from_numpy(
+                np.array(self.tokenizer.encode(texts)))
         return data, tokens
 
 
@@ -199,45 +221,216 @@ class TEDLIUM(AudioDataset):
         return paths, texts
 
 
-def zero_pad_concat(feats):
-    # Pad audio feature sets
-    max_t = max(len(feat) for feat in feats)
-    shape = (len(feats), max_t) + feats[0].shape[1:]
+class FeatureShardDataset(Dataset):
+    """Features written by `cli/dump_features.py` for one source dataset.
 
-    input_mat = torch.zeros(shape)
-    for e, feat in enumerate(feats):
-        input_mat[e, :len(feat)] = feat
+    The fp16 frames of all utterances are stored back to back in large
+    shard files which are memory mapped, so an item is a view of the page
+    cache. If `transform`, the masking of `split_augmentation`, is given it
+    is applied to a float copy.
+    """
+    def __init__(self, root, tokenizer, transform=None, audio_min_length=0,
+                 audio_max_length=999, desc='FeatureShardDataset'):
+        self.root = root
+        with open(os.path.join(root, 'index.pkl'), 'rb') as f:
+            index = pickle.load(f)
+        self.feature_size = index['feature_size']
+        self.frame_seconds = index['frame_seconds']
+        self.shard_names = index['shards']
+
+        # length limits, like AudioDataset
+        durations = index['length'] * self.frame_seconds
+        keep = (audio_min_length <= durations) & \
+            (durations <= audio_max_length)
+        self.shard = index['shard'][keep]
+        self.offset = index['offset'][keep]
+        self.length = index['length'][keep]
+        self.data_texts = [
+            text for text, k in zip(index['texts'], keep) if k]
+        print('Dataset : %s' % desc)
+        print('size    : %d' % len(self.length))
+        print('Time    : %.2f hours' % (durations[keep].sum() / 3600))
+        print('Filtered: %.2f hours' % (durations[~keep].sum() / 3600))
+        print('=' * 40)
 
-    return input_mat
+        self.transform = transform
+        self.tokenizer = tokenizer
+        self.token_ids = None
+        self.token_offsets = None
+        if tokenizer is not None and tokenizer.fingerprint() is not None:
+            self.cache_tokens()
+        # mapped on first access, in the DataLoader worker which reads them
+        self.shards = None
+
+    def cache_tokens(self):
+        """Encode every transcript once, before the workers are forked.
+        Flat ids and offsets like `UtteranceIndex.cache_tokens`, so the
+        workers do not copy-on-write one refcounted tensor per item"""
+        self.token_ids, self.token_offsets = encode_flat(
+            self.tokenizer, lambda start, end: self.data_texts[start:end],
+            len(self.data_texts))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def open_shards(self):
+        # copy-on-write, torch needs writable arrays but nothing is written
+        self.shards = [
+            np.memmap(os.path.join(self.root, name), dtype=np.float16,
+                      mode='c')
+            for name in self.shard_names]
+
+    def texts(self):
+        return self.data_texts
+
+    def durations(self):
+        return (self.length * self.frame_seconds).tolist()
 
+    def __len__(self):
+        return len(self.length)
 
-def end_pad_concat(texts):
-    # Pad text token sets
-    max_t = max(len(text) for text in texts)
-    shape = (len(texts), max_t)
+    def __getitem__(self, idx):
+        if self.shards is None:
+            self.open_shards()
+        start = self.offset[idx] * self.feature_size
+        end = start + self.length[idx] * self.feature_size
+        data = torch.from_numpy(self.shards[self.shard[idx]][start:end])
+        data = data.view(-1, self.feature_size)
+        if self.transform is not None:
+            data = self.transform(data.float().T[None])[0].T
 
-    labels = torch.full(shape, fill_value=PAD, dtype=torch.long)
-    for e, l in enumerate(texts):
-        labels[e, :len(l)] = l
-    return labels
+        if self.token_ids is not None:
+            tokens = torch.from_numpy(self.token_ids[
+                self.token_offsets[idx]:self.token_offsets[idx + 1]])
+        else:
+            texts = self.data_texts[idx]
+            tokens = torch.from_numpy(
+                np.array(self.tokenizer.encode(texts)))
+        return data, tokens
 
 
-def seq_collate(results):
-    xs = []
-    ys = []
-    xlen = []
-    ylen = []
-    for (audio_feat, tokens) in results:
-        xs.append(audio_feat)
-        ys.append(tokens)
-        xlen.append(len(audio_feat))
-        ylen.append(len(tokens))
+def build_feature_dataset(feature_dir, tokenizer, transform=None, **kwargs):
+    """Every source dataset dumped into `feature_dir`, merged"""
+    return MergedDataset([
+        FeatureShardDataset(
+            os.path.join(feature_dir, name), tokenizer, transform,
+            desc=name, **kwargs)
+        for name in sorted(os.listdir(feature_dir))
+        if os.path.exists(os.path.join(feature_dir, name, 'index.pkl'))])
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of utterances of similar durations, bounded by the padded
+    seconds of audio in each batch instead of a fixed batch size.
+
+    Every epoch the utterances are sorted by duration with ties broken at
+    random, cut into batches by `data_utils.batch_by_size` and the batches
+    are shuffled. Only indices are yielded, the audio is still loaded by
+    the DataLoader workers.
+
+    Args:
+        durations (list): seconds of every utterance of the dataset.
+        max_batch_seconds (float): max of the number of utterances times
+            the longest duration of a batch. Longer utterances get a batch
+            of their own.
+        max_batch_size (int): max utterances per batch, None for no limit.
+    """
+    def __init__(self, durations, max_batch_seconds, max_batch_size=None,
+                 shuffle=True, seed=0):
+        self.max_tokens = int(max_batch_seconds * 1000)
+        # milliseconds, as batch_by_size counts integer tokens
+        self.lengths = np.minimum(
+            np.ceil(np.asarray(durations) * 1000), self.max_tokens
+        ).astype(np.int64)
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        # the same for any order of equal durations
+        self.num_batches = len(self.batches())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, rng=None):
+        if rng is None:
+            order = np.argsort(self.lengths, kind='mergesort')
+        else:
+            order = np.lexsort(
+                (rng.permutation(len(self.lengths)), self.lengths))
+        lengths = self.lengths
+        return batch_by_size(
+            order, lambda idx: lengths[idx], max_tokens=self.max_tokens,
+            max_sentences=self.max_batch_size)
+
+    def __iter__(self):
+        if not self.shuffle:
+            return iter(self.batches())
+        rng = np.random.RandomState(self.seed + self.epoch)
+        batches = self.batches(rng)
+        rng.shuffle(batches)
+        self.epoch += 1
+        return iter(batches)
 
-    xs = zero_pad_concat(xs)
-    ys = end_pad_concat(ys).int()
-    xlen = torch.from_numpy(np.array(xlen)).int()
-    ylen = torch.from_numpy(np.array(ylen)).int()
-    return xs, ys, xlen, ylen
+    def __len__(self):
+        return self.num_batches
+
+
+class Batch(namedtuple('Batch', ['xs', 'ys', 'xlen', 'ylen'])):
+    """Padded features, padded tokens and their lengths. Still a tuple, so
+    it unpacks like before and the trainers move it like one."""
+    __slots__ = ()
+
+    def pin_memory(self):
+        return Batch(*(x.pin_memory() for x in self))
+
+    def to(self, device, non_blocking=False):
+        return Batch(*(x.to(device, non_blocking=non_blocking) for x in self))
+
+
+class SeqCollate:
+    """Pads a list of (features, tokens) into a `Batch`.
+
+    Every field is a single allocation, each item is copied into it once
+    and only the padding after it is filled.
+
+    Args:
+        pad_to_multiple (int): round the padded length of the features up
+            to a multiple of this, e.g. the time reduction of the encoder.
+        pin_memory (bool): allocate page-locked buffers. Only when collating
+            in the main process, CUDA can not be used by forked workers;
+            `DataLoader(pin_memory=True)` pins batches of workers instead.
+    """
+    def __init__(self, pad_to_multiple=1, pin_memory=False):
+        self.pad_to_multiple = pad_to_multiple
+        self.pin_memory = pin_memory
+
+    def __call__(self, results):
+        xlen = torch.tensor(
+            [len(feat) for feat, _ in results], dtype=torch.int)
+        ylen = torch.tensor(
+            [len(tokens) for _, tokens in results], dtype=torch.int)
+        max_t = int(xlen.max())
+        max_t = -(-max_t // self.pad_to_multiple) * self.pad_to_multiple
+
+        feat = results[0][0]
+        xs = torch.empty(
+            (len(results), max_t) + feat.shape[1:], dtype=torch.float,
+            pin_memory=self.pin_memory)
+        ys = torch.empty(
+            (len(results), int(ylen.max())), dtype=torch.int,
+            pin_memory=self.pin_memory)
+        for e, (feat, tokens) in enumerate(results):
+            xs[e, :len(feat)].copy_(feat)
+            xs[e, len(feat):].fill_(0)
+            ys[e, :len(tokens)].copy_(tokens)
+            ys[e, len(tokens):].fill_(PAD)
+        return Batch(xs, ys, xlen, ylen)
+
+
+seq_collate = SeqCollate()
 
 
 if __name__ == "__main__":
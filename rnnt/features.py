@@ -107,9 +107,9 @@ class FilterbankFeatures(nn.Module):
         # dtype = x.dtype
         seq_len = self.get_seq_len(torch.tensor([x.shape[1]]))
 
-        # dither
+        # dither, out of place as `x` may be a view of a stream buffer
         if self.dither > 0:
-            x += self.dither * torch.randn_like(x)
+            x = x + self.dither * torch.randn_like(x)
 
         # do preemphasis
         if self.preemph is not None:
@@ -150,3 +150,129 @@ class FilterbankFeatures(nn.Module):
             x = nn.functional.pad(x, (0, self.pad_to - pad_amt))
 
         return x
+
+
+class StreamingFilterbank:
+    """Incremental `FilterbankFeatures` over a stream of PCM pushes.
+
+    Carries the preemphasis state, the reflect padding at both ends of the
+    stream and the samples of frames which are not complete yet, so each
+    sample is preemphasized, dithered and windowed exactly as in offline
+    extraction over the whole stream, and each frame is transformed once.
+    Without dither the concatenated output of `push` and `flush` equals
+    `features(waveform)`. Only normalize="none" and pad_to=0 are supported,
+    the other options need the whole utterance.
+    """
+    def __init__(self, features):
+        assert features.normalize == "none", "needs the whole utterance"
+        assert features.pad_to == 0, "needs the whole utterance"
+        self.features = features
+        self.pad = features.n_fft // 2
+        self.reset()
+
+    def reset(self):
+        # last input sample, for preemphasis of the next push
+        self.last_sample = None
+        # first samples of the stream, until the left padding can be built
+        self.head = None
+        # preemphasized samples of incomplete frames, left padding included
+        self.buffer = None
+        # last `pad + 1` preemphasized samples, reflected by `flush`
+        self.tail = None
+        self.num_samples = 0
+
+    def empty(self, batch_size):
+        return torch.zeros(
+            batch_size, self.features.n_filt, 0, device=self.features.fb.device)
+
+    def push(self, x):
+        """Feed waveform [B, N] and return the newly completed frames
+        [B, n_filt, T]"""
+        features = self.features
+        if features.dither > 0:
+            x = x + features.dither * torch.randn_like(x)
+        if features.preemph is not None:
+            if self.last_sample is None:
+                y = torch.cat(
+                    [x[:, :1], x[:, 1:] - features.preemph * x[:, :-1]],
+                    dim=1)
+            else:
+                y = x - features.preemph * torch.cat(
+                    [self.last_sample, x[:, :-1]], dim=1)
+            self.last_sample = x[:, -1:]
+            x = y
+        self.num_samples += x.shape[1]
+
+        if self.buffer is None:
+            # left reflect padding needs the first `pad + 1` samples
+            if self.head is not None:
+                x = torch.cat([self.head, x], dim=1)
+            if x.shape[1] <= self.pad:
+                self.head = x
+                return self.empty(x.shape[0])
+            self.head = None
+            self.buffer = x[:, 1:self.pad + 1].flip(1)
+
+        if self.tail is not None:
+            self.tail = torch.cat([self.tail, x], dim=1)
+        else:
+            self.tail = x
+        self.tail = self.tail[:, -(self.pad + 1):]
+        return self.frames(x)
+
+    def flush(self, batch_size=1):
+        """Right reflect padding, returns the last frames of the stream"""
+        if self.buffer is None:
+            return self.empty(batch_size)
+        x = self.tail.flip(1)[:, 1:self.pad + 1]
+        x = self.frames(x)
+        # same as the seq_len mask of `FilterbankFeatures`
+        if self.num_samples % self.features.hop_length == 0 and \
+                x.shape[-1] > 0:
+            x[..., -1] = 0
+        return x
+
+    def frames(self, x):
+        features = self.features
+        if x.shape[1] > 0:
+            self.buffer = torch.cat([self.buffer, x], dim=1)
+        length = self.buffer.shape[1]
+        if length < features.n_fft:
+            return self.empty(self.buffer.shape[0])
+        num_frames = 1 + (length - features.n_fft) // features.hop_length
+        x = self.buffer[
+            :, :(num_frames - 1) * features.hop_length + features.n_fft]
+        self.buffer = self.buffer[:, num_frames * features.hop_length:]
+
+        x = torch.stft(
+            x, n_fft=features.n_fft, hop_length=features.hop_length,
+            win_length=features.win_length,
+            window=features.window.to(dtype=torch.float), center=False)
+        x = x.pow(2).sum(-1)
+        x = torch.matmul(features.fb.to(x.dtype), x)
+        if features.log:
+            x = torch.log(x + 1e-20)
+        return x
+
+
+if __name__ == "__main__":
+    features = FilterbankFeatures(
+        n_fft=400, win_length=400, hop_length=200, n_filt=80, dither=0)
+    for length in [16000, 16000 + 117, 16200]:
+        waveform = torch.randn(1, length)
+        expected = features(waveform.clone())
+        streaming = StreamingFilterbank(features)
+        chunks = []
+        start = 0
+        while start < length:
+            size = torch.randint(1, 3000, (1,)).item()
+            chunks.append(streaming.push(waveform[:, start: start + size]))
+            start += size
+        chunks.append(streaming.flush())
+        output = torch.cat(chunks, dim=2)
+        assert output.shape == expected.shape, (output.shape, expected.shape)
+        # dither is off, every sample and frame goes through the same ops
+        assert torch.equal(output, expected), (
+            (output - expected).abs().max().item())
+        print('%6d samples, %3d frames, bit exact' % (
+            length, output.shape[2]))
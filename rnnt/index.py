@@ -0,0 +1,231 @@
+import hashlib
+import os
+import shutil
+from multiprocessing import Pool
+
+import numpy as np
+import torchaudio
+from tqdm import tqdm
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+def probe(path):
+    """(samples, sample rate) read from the header of `path`, None if it
+    can not be read"""
+    if soundfile is not None:
+        try:
+            info = soundfile.info(path)
+            return info.frames, info.samplerate
+        except Exception:
+            # e.g. mp3 or m4a with an older libsndfile
+            pass
+    try:
+        info = torchaudio.info(path)
+        if isinstance(info, tuple):
+            # sox backend of torchaudio < 0.7, length counts every channel
+            info = info[0]
+            return info.length // max(info.channels, 1), int(info.rate)
+        return info.num_frames, info.sample_rate
+    except Exception:
+        return None
+
+
+def save_atomic(path, array):
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path + '.tmp', path)
+
+
+def probe_all(paths, num_workers=None, desc='probe', work_dir=None,
+              part_size=8192):
+    """`probe` of every path in a process pool.
+
+    Returns:
+        array: [N, 2] samples and sample rate of every path, -1 for the
+        files which can not be read.
+
+    With `work_dir`, the results of every `part_size` paths are saved as
+    soon as they are complete and loaded instead of probed again by a later
+    call, so an interrupted build resumes where it stopped.
+    """
+    results = np.full((len(paths), 2), -1, dtype=np.int64)
+    pending = []
+    for start in range(0, len(paths), part_size):
+        end = min(start + part_size, len(paths))
+        part = None
+        if work_dir is not None:
+            part = os.path.join(work_dir, 'part_%09d.npy' % start)
+            if os.path.exists(part):
+                results[start:end] = np.load(part)
+                continue
+        pending.append((start, end, part))
+    if work_dir is not None:
+        os.makedirs(work_dir, exist_ok=True)
+
+    todo = [paths[i] for start, end, _ in pending for i in range(start, end)]
+    with Pool(num_workers) as pool, tqdm(
+            total=len(paths), initial=len(paths) - len(todo),
+            dynamic_ncols=True, desc=desc) as pbar:
+        # in order, every part is complete once its last path is returned
+        infos = pool.imap(probe, todo, chunksize=64)
+        for start, end, part in pending:
+            for i in range(start, end):
+                info = next(infos)
+                if info is not None:
+                    results[i] = info
+                pbar.update(1)
+            if part is not None:
+                save_atomic(part, results[start:end])
+    return results
+
+
+def intern(strings):
+    """uint8 blob of the distinct `strings` and the [start, end) byte range
+    of every string in it"""
+    ranges = {}
+    chunks = []
+    size = 0
+    bounds = np.empty((len(strings), 2), dtype=np.int64)
+    for i, string in enumerate(strings):
+        if string not in ranges:
+            data = string.encode('utf-8')
+            ranges[string] = (size, size + len(data))
+            chunks.append(data)
+            size += len(data)
+        bounds[i] = ranges[string]
+    blob = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+    return blob, bounds
+
+
+def encode_flat(tokenizer, get_texts, size, batch_size=10000):
+    """Token ids of `size` texts, `get_texts(start, end)` returns a list of
+    them, encoded in batches.
+
+    Returns:
+        (ids, offsets): the flat ids, int16 if the vocabulary fits, and the
+        [size + 1] offsets of every text in them.
+    """
+    if tokenizer.vocab_size <= np.iinfo(np.int16).max + 1:
+        dtype = np.int16
+    else:
+        dtype = np.int32
+    chunks = []
+    lengths = np.zeros(size, dtype=np.int64)
+    for start in range(0, size, batch_size):
+        end = min(start + batch_size, size)
+        texts = get_texts(start, end)
+        for i, ids in enumerate(tokenizer.encode_batch(texts)):
+            chunks.append(np.asarray(ids, dtype=dtype))
+            lengths[start + i] = len(ids)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    ids = np.concatenate(chunks) if chunks else np.zeros(0, dtype)
+    return ids, offsets
+
+
+class UtteranceIndex:
+    """Columnar index of a speech corpus, one row per utterance.
+
+    Stored as a directory of .npy arrays which are memory mapped, so the
+    pages are shared by forked DataLoader workers. Paths and texts are
+    utf-8 ranges of a single blob in which equal strings are stored once.
+    """
+    version = 4
+    columns = ['samples', 'sample_rate', 'path', 'text', 'strings']
+
+    def __init__(self, directory):
+        self.directory = directory
+        for name in self.columns:
+            setattr(self, name, np.load(
+                os.path.join(directory, name + '.npy'), mmap_mode='r'))
+
+    @classmethod
+    def exists(cls, directory):
+        return all(
+            os.path.exists(os.path.join(directory, name + '.npy'))
+            for name in cls.columns)
+
+    @classmethod
+    def write(cls, directory, paths, texts, samples, sample_rate):
+        os.makedirs(directory, exist_ok=True)
+        strings, bounds = intern(list(paths) + list(texts))
+        arrays = {
+            'samples': np.asarray(samples, dtype=np.int64),
+            'sample_rate': np.asarray(sample_rate, dtype=np.int32),
+            'path': bounds[:len(paths)],
+            'text': bounds[len(paths):],
+            'strings': strings,
+        }
+        # `strings` last, `exists` is false until every column is complete
+        for name in cls.columns:
+            save_atomic(os.path.join(directory, name + '.npy'), arrays[name])
+        return cls(directory)
+
+    @classmethod
+    def build(cls, directory, root, paths, texts, num_workers=None,
+              desc='index'):
+        """Index of the readable audio files among `paths`, relative to
+        `root`, with exact lengths from the file headers. The probing
+        resumes after an interruption as long as `paths` is the same."""
+        fingerprint = hashlib.sha1(
+            '\n'.join(paths).encode('utf-8')).hexdigest()[:12]
+        work_dir = '%s.probe_%s' % (directory.rstrip(os.sep), fingerprint)
+        infos = probe_all(
+            [os.path.join(root, path) for path in paths], num_workers, desc,
+            work_dir=work_dir)
+        keep = np.nonzero(infos[:, 0] >= 0)[0]
+        index = cls.write(
+            directory,
+            [paths[i] for i in keep],
+            [texts[i] for i in keep],
+            infos[keep, 0],
+            infos[keep, 1])
+        shutil.rmtree(work_dir)
+        return index
+
+    def __len__(self):
+        return len(self.samples)
+
+    def string(self, bounds):
+        start, end = bounds
+        return self.strings[start:end].tobytes().decode('utf-8')
+
+    def get_path(self, i):
+        return self.string(self.path[i])
+
+    def get_text(self, i):
+        return self.string(self.text[i])
+
+    def durations(self):
+        return self.samples / self.sample_rate
+
+    def cache_tokens(self, tokenizer, batch_size=10000):
+        """Token ids of every transcript, encoded once per tokenizer
+        fingerprint and saved next to the index.
+
+        Returns:
+            (ids, offsets): the flat ids and the [N + 1] offsets of every
+            row in them, memory mapped.
+        """
+        cache_dir = os.path.join(
+            self.directory, 'tokens_%s' % tokenizer.fingerprint())
+        ids_path = os.path.join(cache_dir, 'ids.npy')
+        offsets_path = os.path.join(cache_dir, 'offsets.npy')
+        if not os.path.exists(offsets_path):
+            ids, offsets = encode_flat(
+                tokenizer,
+                lambda start, end: [
+                    self.get_text(i) for i in range(start, end)],
+                len(self), batch_size)
+            os.makedirs(cache_dir, exist_ok=True)
+            # offsets last, they mark a complete cache
+            save_atomic(ids_path, ids)
+            save_atomic(offsets_path, offsets)
+        # copy-on-write, torch needs writable arrays but nothing is written
+        return (
+            np.load(ids_path, mmap_mode='c'),
+            np.load(offsets_path, mmap_mode='r'))
@@ -0,0 +1,329 @@
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+
+from rnnt.models import (
+    Decoder, ResLayerNormGRU, ResLayerNormLSTM, TimeReduction)
+
+
+def time_reduction(xs: Tensor, reduction_factor: int) -> Tensor:
+    batch_size = xs.shape[0]
+    xlen = xs.shape[1]
+    hidden_size = xs.shape[2]
+    pad = (reduction_factor - xlen % reduction_factor) % reduction_factor
+    xs = F.pad(xs, [0, 0, 0, pad, 0, 0])
+    xs = xs.reshape(batch_size, -1, reduction_factor, hidden_size)
+    return xs.mean(dim=-2)
+
+
+def split_proj(proj):
+    """LayerNorm and reduction factor of a layer projection, dropout is
+    dropped as the scripted modules are only used for inference"""
+    norm = None
+    reduction_factor = 1
+    for module in proj:
+        if isinstance(module, nn.LayerNorm):
+            norm = module
+        elif isinstance(module, TimeReduction):
+            reduction_factor = module.reduction_factor
+    return norm, reduction_factor
+
+
+class ScriptResLSTMLayer(nn.Module):
+    __constants__ = ['residual', 'reduction_factor']
+
+    def __init__(self, lstm, proj, residual):
+        super().__init__()
+        self.lstm = lstm
+        self.norm, self.reduction_factor = split_proj(proj)
+        self.residual = residual
+
+    def forward(self, xs: Tensor, h: Tensor,
+                c: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        ys, (h, c) = self.lstm(xs, (h, c))
+        if self.residual:
+            ys = xs + ys
+        ys = self.norm(ys)
+        if self.reduction_factor > 1:
+            ys = time_reduction(ys, self.reduction_factor)
+        return ys, h, c
+
+
+class ScriptResGRULayer(nn.Module):
+    __constants__ = ['residual', 'reduction_factor']
+
+    def __init__(self, gru, proj, residual):
+        super().__init__()
+        self.gru = gru
+        self.norm, self.reduction_factor = split_proj(proj)
+        self.residual = residual
+
+    def forward(self, xs: Tensor, h: Tensor) -> Tuple[Tensor, Tensor]:
+        ys, h = self.gru(xs, h)
+        if self.residual:
+            ys = xs + ys
+        ys = self.norm(ys)
+        if self.reduction_factor > 1:
+            ys = time_reduction(ys, self.reduction_factor)
+        return ys, h
+
+
+class ScriptResLayerNormLSTM(nn.Module):
+    """`ResLayerNormLSTM` with typed states for `torch.jit.script`, the
+    weights are shared with `module`"""
+    def __init__(self, module):
+        super().__init__()
+        layers = []
+        for i, (lstm, proj) in enumerate(zip(module.lstms, module.projs)):
+            lstm.flatten_parameters()
+            layers.append(ScriptResLSTMLayer(lstm, proj, i != 0))
+        self.layers = nn.ModuleList(layers)
+
+    def forward(self, xs: Tensor, hidden: Tuple[Tensor, Tensor],
+                out: Optional[Tuple[Tensor, Tensor]] = None
+                ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        hs, cs = hidden
+        new_hs = torch.jit.annotate(List[Tensor], [])
+        new_cs = torch.jit.annotate(List[Tensor], [])
+        i = 0
+        for layer in self.layers:
+            xs, h, c = layer(xs, hs[i:i + 1], cs[i:i + 1])
+            if out is None:
+                new_hs.append(h)
+                new_cs.append(c)
+            else:
+                out[0][i].copy_(h[0])
+                out[1][i].copy_(c[0])
+            i += 1
+        if out is not None:
+            return xs, out
+        return xs, (torch.cat(new_hs, dim=0), torch.cat(new_cs, dim=0))
+
+
+class ScriptResLayerNormGRU(nn.Module):
+    """`ResLayerNormGRU` with typed states for `torch.jit.script`"""
+    def __init__(self, module):
+        super().__init__()
+        layers = []
+        for i, (gru, proj) in enumerate(zip(module.lstms, module.projs)):
+            gru.flatten_parameters()
+            layers.append(ScriptResGRULayer(gru, proj, i != 0))
+        self.layers = nn.ModuleList(layers)
+
+    def forward(self, xs: Tensor, hidden: Tensor,
+                out: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+        new_hs = torch.jit.annotate(List[Tensor], [])
+        i = 0
+        for layer in self.layers:
+            xs, h = layer(xs, hidden[i:i + 1])
+            if out is None:
+                new_hs.append(h)
+            else:
+                out[i].copy_(h[0])
+            i += 1
+        if out is not None:
+            return xs, out
+        return xs, torch.cat(new_hs, dim=0)
+
+
+class ScriptEncoder(nn.Module):
+    """`Encoder` over a `ResLayerNormLSTM` with typed states"""
+    def __init__(self, encoder):
+        super().__init__()
+        if not isinstance(encoder.lstm, ResLayerNormLSTM):
+            raise ValueError('Only LSTM encoders keep (h, c) states')
+        self.norm = encoder.norm
+        self.lstm = ScriptResLayerNormLSTM(encoder.lstm)
+        self.proj = encoder.proj if encoder.has_proj else nn.Identity()
+
+    def forward(self, xs: Tensor, hidden: Tuple[Tensor, Tensor],
+                out: Optional[Tuple[Tensor, Tensor]] = None
+                ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        xs = self.norm(xs)
+        xs, hidden = self.lstm(xs, hidden, out)
+        return self.proj(xs), hidden
+
+
+class ScriptDecoder(nn.Module):
+    """LSTM `Decoder` which always takes a state, the initial one is zeros
+    after <bos>"""
+    def __init__(self, decoder):
+        super().__init__()
+        if not isinstance(decoder, Decoder):
+            raise ValueError('Only the LSTM decoder can be scripted')
+        decoder.lstm.flatten_parameters()
+        self.embed = decoder.embed
+        self.lstm = decoder.lstm
+        self.proj = decoder.proj
+
+    def forward(self, ys: Tensor, hidden: Tuple[Tensor, Tensor]
+                ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        ys = self.embed(ys)
+        ys, hidden = self.lstm(ys, hidden)
+        return self.proj(ys), hidden
+
+
+class ScriptJoint(nn.Module):
+    """`Joint` with the encoder and decoder halves of its first weight
+    sliced once instead of on every call. The halves and the bias are
+    copies, unlike the output layer they do not follow later updates of
+    `joint`."""
+    def __init__(self, joint):
+        super().__init__()
+        linear = joint.joint[0]
+        self.register_buffer(
+            'enc_weight', linear.weight[:, :joint.enc_size].detach().clone())
+        self.register_buffer(
+            'dec_weight', linear.weight[:, joint.enc_size:].detach().clone())
+        self.register_buffer('bias', linear.bias.detach().clone())
+        self.output = joint.joint[2]
+
+    @torch.jit.export
+    def project_enc(self, h_enc: Tensor) -> Tensor:
+        return F.linear(h_enc, self.enc_weight, self.bias)
+
+    @torch.jit.export
+    def project_dec(self, h_dec: Tensor) -> Tensor:
+        return F.linear(h_dec, self.dec_weight)
+
+    @torch.jit.export
+    def joint_from_projections(self, enc_proj: Tensor,
+                               dec_proj: Tensor) -> Tensor:
+        if enc_proj.dim() == 3 and dec_proj.dim() == 3:
+            enc_proj = enc_proj.unsqueeze(dim=2)
+            dec_proj = dec_proj.unsqueeze(dim=1)
+        return self.output(torch.tanh(enc_proj + dec_proj))
+
+    def forward(self, h_enc: Tensor, h_dec: Tensor) -> Tensor:
+        return self.joint_from_projections(
+            self.project_enc(h_enc), self.project_dec(h_dec))
+
+
+class StreamingTransducer(nn.Module):
+    """The parts of a `Transducer` used by the stream decoders. Everything
+    is reached through methods of this module, so it still works once
+    frozen."""
+    def __init__(self, transducer):
+        super().__init__()
+        self.encoder = ScriptEncoder(transducer.encoder)
+        self.decoder = ScriptDecoder(transducer.decoder)
+        self.joint = ScriptJoint(transducer.joint)
+
+    @torch.jit.export
+    def encode(self, xs: Tensor, hidden: Tuple[Tensor, Tensor],
+               out: Optional[Tuple[Tensor, Tensor]] = None
+               ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        return self.encoder(xs, hidden, out)
+
+    @torch.jit.export
+    def decoder_step(self, ys: Tensor, hidden: Tuple[Tensor, Tensor]
+                     ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        h_dec, hidden = self.decoder(ys, hidden)
+        return self.joint.project_dec(h_dec[:, 0]), hidden
+
+    @torch.jit.export
+    def project_enc(self, h_enc: Tensor) -> Tensor:
+        return self.joint.project_enc(h_enc)
+
+    @torch.jit.export
+    def project_dec(self, h_dec: Tensor) -> Tensor:
+        return self.joint.project_dec(h_dec)
+
+    @torch.jit.export
+    def joint_from_projections(self, enc_proj: Tensor,
+                               dec_proj: Tensor) -> Tensor:
+        return self.joint.joint_from_projections(enc_proj, dec_proj)
+
+    def forward(self, xs: Tensor, hidden: Tuple[Tensor, Tensor]
+                ) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        return self.encode(xs, hidden)
+
+
+def script_transducer(transducer):
+    """Scripted `StreamingTransducer` of a trained transducer in eval mode,
+    frozen when the installed torch supports it"""
+    transducer.eval()
+    scripted = torch.jit.script(StreamingTransducer(transducer).eval())
+    if hasattr(torch.jit, 'freeze'):
+        scripted = torch.jit.freeze(scripted, preserved_attrs=[
+            'encode', 'decoder_step', 'project_enc', 'project_dec',
+            'joint_from_projections'])
+    return scripted
+
+
+@torch.no_grad()
+def check_equivalence(transducer, scripted, input_size, length=4,
+                      atol=1e-5):
+    """Compare one streaming step of the scripted and the eager modules"""
+    enc_layers = len(transducer.encoder.lstm.lstms)
+    enc_hidden_size = transducer.encoder.lstm.hidden_size
+    xs = torch.randn(1, length, input_size)
+    hidden = (
+        torch.randn(enc_layers, 1, enc_hidden_size),
+        torch.randn(enc_layers, 1, enc_hidden_size))
+    eager_xs, eager_hidden = transducer.encoder(xs, hidden)
+    script_xs, script_hidden = scripted.encode(xs, hidden)
+    pairs = [(eager_xs, script_xs)] + list(zip(eager_hidden, script_hidden))
+    # states written into the input tensors, like the stream decoders do
+    state = (hidden[0].clone(), hidden[1].clone())
+    script_hidden = scripted.encode(xs, state, state)[1]
+    pairs.extend(zip(eager_hidden, script_hidden))
+
+    eager_proj = transducer.joint.project_enc(eager_xs[0])
+    script_proj = scripted.project_enc(script_xs[0])
+    pairs.append((eager_proj, script_proj))
+
+    lstm = transducer.decoder.lstm
+    ys = torch.randint(0, transducer.decoder.embed.num_embeddings, (1, 1))
+    dec_hidden = (
+        torch.randn(lstm.num_layers, 1, lstm.hidden_size),
+        torch.randn(lstm.num_layers, 1, lstm.hidden_size))
+    eager_dec, eager_dec_hidden = transducer.decoder_step(ys, dec_hidden)
+    script_dec, script_dec_hidden = scripted.decoder_step(ys, dec_hidden)
+    pairs.append((eager_dec, script_dec))
+    pairs.extend(zip(eager_dec_hidden, script_dec_hidden))
+
+    pairs.append((
+        transducer.joint.joint_from_projections(eager_proj, eager_dec),
+        scripted.joint_from_projections(script_proj, script_dec)))
+    for eager, script in pairs:
+        if not torch.allclose(eager, script, atol=atol):
+            raise RuntimeError(
+                'scripted transducer differs from eager mode by %.3e' % (
+                    (eager - script).abs().max().item()))
+
+
+if __name__ == "__main__":
+    import time
+    from rnnt.models import Transducer
+
+    input_size = 240
+    transducer = Transducer(
+        vocab_embed_size=64, vocab_size=256, input_size=input_size,
+        enc_hidden_size=256, enc_layers=4, enc_dropout=0.1,
+        enc_proj_size=320, dec_hidden_size=256, dec_layers=1,
+        dec_dropout=0.1, dec_proj_size=320, joint_size=320,
+        output_loss=False)
+    transducer.eval()
+    scripted = script_transducer(transducer)
+    check_equivalence(transducer, scripted, input_size)
+    gru = ResLayerNormGRU(input_size, 256, 2, time_reductions=[1]).eval()
+    torch.jit.script(ScriptResLayerNormGRU(gru))
+
+    # per chunk latency at small chunk sizes
+    hidden = (torch.zeros(4, 1, 256), torch.zeros(4, 1, 256))
+    with torch.no_grad():
+        for length in [2, 4, 8]:
+            xs = torch.randn(1, length, input_size)
+            for name, encode in [
+                    ('eager', transducer.encoder),
+                    ('script', scripted.encode)]:
+                for _ in range(10):
+                    encode(xs, hidden)
+                start = time.time()
+                for _ in range(200):
+                    encode(xs, hidden)
+                print('%-6s chunk %d: %.3f ms' % (
+                    name, length, (time.time() - start) / 200 * 1000))
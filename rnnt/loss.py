@@ -0,0 +1,339 @@
+import inspect
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+try:
+    from warprnnt_pytorch import RNNTLoss
+except ImportError:
+    RNNTLoss = None
+
+from rnnt.tokenizer import NUL
+
+# log(0) stand-in, finite so that differences and gradients stay finite
+LOG_ZERO = -1e30
+# torch >= 1.11 warns about, and later requires, an explicit checkpoint
+# implementation, the non-reentrant one is the recommended one
+CHECKPOINT_KWARGS = (
+    {'use_reentrant': False}
+    if 'use_reentrant' in inspect.signature(checkpoint).parameters else {})
+
+
+def _logaddexp(a, b):
+    # torch.logaddexp is not available in torch 1.4
+    return torch.logsumexp(torch.stack([a, b]), dim=0)
+
+
+def _skew(x, fill=LOG_ZERO):
+    """(B, T, U) -> (B, T + U - 1, T), out[:, n, t] = x[:, t, n - t]
+
+    Row `n` of the output is the n-th anti-diagonal of the T x U lattice,
+    cells outside the lattice are filled with `fill`.
+    """
+    _, T, U = x.shape
+    t = torch.arange(T, device=x.device)
+    n = torch.arange(T + U - 1, device=x.device)
+    u = n.unsqueeze(1) - t.unsqueeze(0)
+    valid = (u >= 0) & (u < U)
+    x = x[:, t.unsqueeze(0).expand_as(u), u.clamp(0, U - 1)]
+    return x.masked_fill(~valid, fill)
+
+
+def _unskew(x, U):
+    """Inverse of `_skew`, (B, T + U - 1, T) -> (B, T, U)"""
+    T = x.shape[2]
+    t = torch.arange(T, device=x.device).unsqueeze(1)
+    u = torch.arange(U, device=x.device).unsqueeze(0)
+    return x[:, t + u, t.expand(-1, U)]
+
+
+def _alpha(blank_skew, label_skew):
+    """Forward variables, one anti-diagonal per step.
+
+    alpha[t, u] is the log-prob of reaching lattice cell (t, u).
+    """
+    B, N, T = blank_skew.shape
+    log_zero = blank_skew.new_full((B, 1), LOG_ZERO)
+    alpha = F.pad(blank_skew.new_zeros(B, 1), [0, T - 1], value=LOG_ZERO)
+    alphas = [alpha]
+    for n in range(1, N):
+        # (t - 1, u) -> (t, u) by blank, (t, u - 1) -> (t, u) by label
+        from_blank = alpha + blank_skew[:, n - 1]
+        from_blank = torch.cat([log_zero, from_blank[:, :-1]], dim=1)
+        from_label = alpha + label_skew[:, n - 1]
+        alpha = _logaddexp(from_blank, from_label).clamp(min=LOG_ZERO)
+        alphas.append(alpha)
+    return torch.stack(alphas, dim=1)
+
+
+def _beta(blank_skew, label_skew, xlen, ylen):
+    """Backward variables, one anti-diagonal per step.
+
+    beta[t, u] is the log-prob of finishing the utterance from cell (t, u),
+    including the emission made at (t, u). Cells outside each utterance's own
+    lattice are log(0).
+    """
+    B, N, T = blank_skew.shape
+    t = torch.arange(T, device=blank_skew.device).unsqueeze(0)
+    xlen = xlen.unsqueeze(1)
+    ylen = ylen.unsqueeze(1)
+    log_zero = blank_skew.new_full((B, 1), LOG_ZERO)
+    beta = blank_skew.new_full((B, T), LOG_ZERO)
+    betas = [None] * N
+    for n in reversed(range(N)):
+        # (t, u) -> (t + 1, u) by blank, (t, u) -> (t, u + 1) by label
+        to_blank = torch.cat([beta[:, 1:], log_zero], dim=1)
+        to_blank = blank_skew[:, n] + to_blank
+        to_label = label_skew[:, n] + beta
+        beta = _logaddexp(to_blank, to_label).clamp(min=LOG_ZERO)
+
+        u = n - t
+        final = (t == xlen - 1) & (u == ylen)
+        beta = torch.where(final, blank_skew[:, n], beta)
+        valid = (t < xlen) & (u >= 0) & (u <= ylen)
+        beta = beta.masked_fill(~valid, LOG_ZERO)
+        betas[n] = beta
+    return torch.stack(betas, dim=1)
+
+
+class _RNNTLossFunction(torch.autograd.Function):
+    """Transducer loss on blank/label log-probs with closed-form gradients.
+
+    Both forward and backward variables are computed in forward, the
+    gradients w.r.t. the log-probs follow from them directly and are kept
+    until backward, so no intermediate of the recursion is stored.
+    """
+    @staticmethod
+    def forward(ctx, blank_logprobs, label_logprobs, xlen, ylen):
+        B, T, U1 = blank_logprobs.shape
+        N = T + U1 - 1
+        xlen = xlen.long()
+        ylen = ylen.long()
+
+        blank_skew = _skew(blank_logprobs)
+        label_skew = _skew(F.pad(label_logprobs, [0, 1], value=LOG_ZERO))
+        alphas = _alpha(blank_skew, label_skew)
+        betas = _beta(blank_skew, label_skew, xlen, ylen)
+        loglike = betas[:, 0, 0]
+
+        if ctx.needs_input_grad[0] or ctx.needs_input_grad[1]:
+            norm = alphas - loglike.view(B, 1, 1)
+            beta_pad = F.pad(betas, [0, 1, 0, 1], value=LOG_ZERO)
+            # blank at (t, u) continues at (t + 1, u), which is one
+            # diagonal further and one step further along t; the blank at
+            # the last cell of each utterance terminates the path
+            next_blank = beta_pad[:, 1:, 1:]
+            n = torch.arange(N, device=betas.device).view(1, N, 1)
+            t = torch.arange(T, device=betas.device).view(1, 1, T)
+            final = (
+                (n == (xlen - 1 + ylen).view(B, 1, 1)) &
+                (t == (xlen - 1).view(B, 1, 1)))
+            next_blank = next_blank.masked_fill(final, 0)
+            # label at (t, u) continues at (t, u + 1), one diagonal further
+            next_label = beta_pad[:, 1:, :-1]
+
+            grad_blank = -torch.exp(norm + blank_skew + next_blank)
+            grad_label = -torch.exp(norm + label_skew + next_label)
+            grad_blank = _unskew(grad_blank, U1)
+            grad_label = _unskew(grad_label, U1)[:, :, :-1]
+            ctx.grads = (grad_blank, grad_label)
+
+        return -loglike
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_blank, grad_label = ctx.grads
+        grad_output = grad_output.view(-1, 1, 1)
+        return grad_blank * grad_output, grad_label * grad_output, None, None
+
+
+def rnnt_loss(blank_logprobs, label_logprobs, xlen, ylen, reduction='mean'):
+    """Transducer loss from the two log-probabilities the recursion needs.
+
+    Args:
+        blank_logprobs (Tensor): (B, T, U + 1), log-prob of blank at (t, u).
+        label_logprobs (Tensor): (B, T, U), log-prob of emitting label u + 1
+            at (t, u).
+        xlen (Tensor): (B,) number of valid frames.
+        ylen (Tensor): (B,) number of valid labels.
+        reduction (str): 'mean', 'sum' or 'none' over the batch.
+
+    Returns:
+        Tensor: negative log-likelihood.
+    """
+    loss = _RNNTLossFunction.apply(
+        blank_logprobs.float(), label_logprobs.float(), xlen, ylen)
+
+    if reduction == 'mean':
+        return loss.mean()
+    if reduction == 'sum':
+        return loss.sum()
+    return loss
+
+
+def _reduce_logits(logits, ys, blank):
+    logprobs = F.log_softmax(logits.float(), dim=-1)
+    blank_logprobs = logprobs[..., blank]
+    index = ys.unsqueeze(1).expand(-1, logprobs.shape[1], -1).unsqueeze(-1)
+    label_logprobs = logprobs[:, :, :-1].gather(-1, index).squeeze(-1)
+    return blank_logprobs, label_logprobs
+
+
+class TransducerLoss(nn.Module):
+    """Pure PyTorch replacement of `warprnnt_pytorch.RNNTLoss`.
+
+    Takes the same (B, T, U + 1, V) logits, applies log_softmax and runs the
+    anti-diagonal recursion, so it works anywhere PyTorch does.
+    """
+    def __init__(self, blank=NUL, reduction='mean'):
+        super().__init__()
+        self.blank = blank
+        self.reduction = reduction
+
+    def forward(self, acts, labels, act_lens, label_lens):
+        blank_logprobs, label_logprobs = _reduce_logits(
+            acts, labels.long(), self.blank)
+        return rnnt_loss(
+            blank_logprobs, label_logprobs, act_lens, label_lens,
+            reduction=self.reduction)
+
+
+def build_loss(loss_type='warp', blank=NUL):
+    if loss_type not in ['warp', 'torch']:
+        raise ValueError('Unsupported loss type')
+    if loss_type == 'warp':
+        if RNNTLoss is not None:
+            return RNNTLoss(blank=blank)
+        print('warprnnt_pytorch is not installed, fall back to TransducerLoss')
+    return TransducerLoss(blank=blank)
+
+
+def chunked_rnnt_loss(joint, enc_proj, dec_proj, ys, xlen, ylen, chunk_size,
+                      blank=NUL, reduction='mean'):
+    """Transducer loss without materializing the B x T x U x V logits.
+
+    The joint is evaluated on `chunk_size` encoder frames at a time and each
+    chunk is reduced right away to the blank and label log-probs. In training
+    the chunks are checkpointed, so backward recomputes one chunk of logits
+    at a time instead of keeping all of them alive.
+
+    Args:
+        joint (Joint): joint network.
+        enc_proj (Tensor): (B, T, H) output of `joint.project_enc`.
+        dec_proj (Tensor): (B, U + 1, H) output of `joint.project_dec`.
+        ys (Tensor): (B, U) target labels.
+        xlen, ylen (Tensor): (B,) valid lengths of frames and labels.
+        chunk_size (int): number of encoder frames per joint call.
+    """
+    ys = ys.long()
+
+    def reduce_chunk(enc_proj, dec_proj, ys):
+        logits = joint.joint_from_projections(enc_proj, dec_proj)
+        return _reduce_logits(logits, ys, blank)
+
+    use_checkpoint = torch.is_grad_enabled() and (
+        enc_proj.requires_grad or dec_proj.requires_grad)
+    blank_logprobs = []
+    label_logprobs = []
+    for start in range(0, enc_proj.shape[1], chunk_size):
+        enc_chunk = enc_proj[:, start: start + chunk_size]
+        if use_checkpoint:
+            blank_chunk, label_chunk = checkpoint(
+                reduce_chunk, enc_chunk, dec_proj, ys, **CHECKPOINT_KWARGS)
+        else:
+            blank_chunk, label_chunk = reduce_chunk(enc_chunk, dec_proj, ys)
+        blank_logprobs.append(blank_chunk)
+        label_logprobs.append(label_chunk)
+    blank_logprobs = torch.cat(blank_logprobs, dim=1)
+    label_logprobs = torch.cat(label_logprobs, dim=1)
+
+    return rnnt_loss(
+        blank_logprobs, label_logprobs, xlen, ylen, reduction=reduction)
+
+
+def rnnt_loss_reference(logits, ys, xlen, ylen, blank=NUL):
+    """Cell by cell forward recursion in numpy, used to check `rnnt_loss`"""
+    logits = logits.detach().double().numpy()
+    logits = logits - logits.max(-1, keepdims=True)
+    logprobs = logits - np.log(np.exp(logits).sum(-1, keepdims=True))
+    costs = []
+    for b in range(logits.shape[0]):
+        T, U = int(xlen[b]), int(ylen[b])
+        alpha = np.full((T, U + 1), -np.inf)
+        alpha[0, 0] = 0
+        for t in range(T):
+            for u in range(U + 1):
+                if t == 0 and u == 0:
+                    continue
+                from_blank = -np.inf
+                from_label = -np.inf
+                if t > 0:
+                    from_blank = alpha[t - 1, u] + logprobs[b, t - 1, u, blank]
+                if u > 0:
+                    from_label = (
+                        alpha[t, u - 1] + logprobs[b, t, u - 1, ys[b, u - 1]])
+                alpha[t, u] = np.logaddexp(from_blank, from_label)
+        costs.append(-(alpha[T - 1, U] + logprobs[b, T - 1, U, blank]))
+    return np.array(costs)
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+
+    # closed-form gradients against finite differences
+    B, T, U, V = 2, 5, 3, 6
+    logits = torch.randn(B, T, U + 1, V, dtype=torch.double)
+    logprobs = F.log_softmax(logits, dim=-1)
+    ys = torch.randint(1, V, (B, U))
+    xlen = torch.tensor([T, T - 1])
+    ylen = torch.tensor([U, U - 1])
+    blank_logprobs, label_logprobs = _reduce_logits(logprobs, ys, NUL)
+    blank_logprobs = blank_logprobs.double().requires_grad_()
+    label_logprobs = label_logprobs.double().requires_grad_()
+    assert torch.autograd.gradcheck(
+        lambda b, l: _RNNTLossFunction.apply(b, l, xlen, ylen),
+        (blank_logprobs, label_logprobs))
+    print('gradcheck: ok')
+
+    # loss values and speed on a training sized batch
+    B, T, U, V = 8, 150, 40, 2048
+    logits = torch.randn(B, T, U + 1, V, requires_grad=True)
+    ys = torch.randint(1, V, (B, U)).int()
+    xlen = torch.randint(T // 2, T + 1, (B,)).int()
+    xlen[0] = T
+    ylen = torch.randint(U // 2, U + 1, (B,)).int()
+    ylen[0] = U
+
+    start = time.time()
+    expected = rnnt_loss_reference(logits, ys, xlen, ylen)
+    reference_elapsed = time.time() - start
+
+    loss_fn = TransducerLoss(reduction='none')
+    start = time.time()
+    costs = loss_fn(logits, ys, xlen, ylen)
+    costs.sum().backward()
+    torch_elapsed = time.time() - start
+
+    np.testing.assert_allclose(
+        costs.detach().numpy(), expected, rtol=1e-4, atol=1e-3)
+    print('reference loop     : %.3f s (forward)' % reference_elapsed)
+    print('TransducerLoss     : %.3f s (forward + backward)' % torch_elapsed)
+
+    if RNNTLoss is not None:
+        warp_logits = logits.detach().clone().requires_grad_()
+        start = time.time()
+        warp_costs = RNNTLoss(blank=NUL, reduction='none')(
+            warp_logits, ys, xlen, ylen)
+        warp_costs.sum().backward()
+        warp_elapsed = time.time() - start
+        np.testing.assert_allclose(
+            costs.detach().numpy(), warp_costs.detach().numpy(),
+            rtol=1e-4, atol=1e-3)
+        np.testing.assert_allclose(
+            logits.grad.numpy(), warp_logits.grad.numpy(),
+            rtol=1e-3, atol=1e-5)
+        print('warp-transducer    : %.3f s (forward + backward)' % warp_elapsed)
@@ -1,32 +1,104 @@
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import math
+import numpy as np
 from dataclasses import dataclass, field
 from typing import List, Tuple
 
-try:
-    from warprnnt_pytorch import RNNTLoss
-except:
-    pass
-
 from rnnt.tokenizer import NUL, BOS, PAD
+from rnnt.cache import DecoderCache
+from rnnt.loss import build_loss, chunked_rnnt_loss
 from modules.group_norm import Fp32GroupNorm
 
+
+@dataclass
+class BeamState:
+    """Hypotheses of a batched beam search, `beam_size` per utterance.
+
+    Row `b * beam_size + k` of `dec_proj` and of every tensor in `hidden`
+    belongs to `prefixes[b][k]`. Unused slots hold a score of -inf.
+    """
+    scores: torch.Tensor                # [B, K] log-probs
+    prefixes: List[List[Tuple[int, ...]]]
+    dec_proj: torch.Tensor              # [B * K, H]
+    hidden: Tuple[torch.Tensor, ...]    # each [L, B * K, H]
+    # prediction network outputs, keyed by `context + prefix`
+    cache: DecoderCache = None
+    # tokens before every prefix which have been trimmed off
+    context: Tuple[int, ...] = ()
+
+
 class TimeReduction(nn.Module):
     def __init__(self, reduction_factor=2):
         super().__init__()
         self.reduction_factor = reduction_factor
 
-    def forward(self, xs):
-        batch_size, xlen, hidden_size = xs.shape
-        pad = self.reduction_factor - xlen % self.reduction_factor
+    def forward(self, xs, xlen=None):
+        """If the lengths `xlen` of the padded batch `xs` are given, the
+        frames after each length are zeroed first, like the padding of a
+        single utterance"""
+        batch_size, max_len, hidden_size = xs.shape
+        pad = self.reduction_factor - max_len % self.reduction_factor
         pad = pad % self.reduction_factor
         pad_shape = [0, 0, 0, pad, 0, 0]
         xs = nn.functional.pad(xs, pad_shape)
         xs = xs.reshape(batch_size, -1, self.reduction_factor, hidden_size)
-        xs = xs.mean(dim=-2)
-        return xs
+        if xlen is None:
+            return xs.mean(dim=-2)
+        mask = torch.arange(max_len + pad, device=xs.device) < \
+            xlen.to(xs.device)[:, None]
+        mask = mask.to(xs.dtype).view(batch_size, -1, self.reduction_factor, 1)
+        return (xs * mask).mean(dim=-2)
+
+    def reduce_length(self, xlen):
+        return (xlen + self.reduction_factor - 1) // self.reduction_factor
+
+
+def time_reduction_factor(module):
+    """Input frames per output frame of every TimeReduction in `module`"""
+    factor = 1
+    for submodule in module.modules():
+        if isinstance(submodule, TimeReduction):
+            factor *= submodule.reduction_factor
+    return factor
+
+
+def packed_rnn(rnn, xs, xlen, hidden):
+    """Run `rnn` over the first `xlen` frames of every sequence of `xs`,
+    the outputs are zero after the length and the final states are the
+    ones at the length"""
+    packed = pack_padded_sequence(
+        xs, xlen.cpu(), batch_first=True, enforce_sorted=False)
+    ys, hidden = rnn(packed, hidden)
+    ys, _ = pad_packed_sequence(
+        ys, batch_first=True, total_length=xs.shape[1])
+    return ys, hidden
+
+
+def packed_proj(proj, xs, xlen):
+    """Layer projection of a padded batch, returns the reduced lengths"""
+    for module in proj:
+        if isinstance(module, TimeReduction):
+            xs = module(xs, xlen)
+            xlen = module.reduce_length(xlen)
+        else:
+            xs = module(xs)
+    return xs, xlen
+
+
+def zero_state(module, xs):
+    """Zero [L, B, H] state of `module` for the batch `xs`. It is only read,
+    so it is kept on the module and reused while the batch size, device and
+    dtype stay the same."""
+    shape = (len(module.lstms), xs.shape[0], module.hidden_size)
+    zeros = module.zero_hidden
+    if zeros is None or zeros.shape != shape or \
+            zeros.device != xs.device or zeros.dtype != xs.dtype:
+        zeros = xs.new_zeros(shape)
+        module.zero_hidden = zeros
+    return zeros
 
 
 class ResLayerNormLSTM(nn.Module):
@@ -51,29 +123,53 @@ class ResLayerNormLSTM(nn.Module):
                 proj.append(nn.Dropout(dropout))
             input_size = hidden_size
             self.projs.append(nn.Sequential(*proj))
+        self.zero_hidden = None
 
-    def forward(self, xs, hiddens=None):
+    def forward(self, xs, hiddens=None, out=None, xlen=None):
+        """If `out`, a tuple of preallocated [L, B, H] tensors, is given,
+        the new states are copied into it layer by layer and `out` is
+        returned instead of new tensors. `out` may be `hiddens` itself as
+        long as autograd is off, every layer reads its own state before
+        it is overwritten.
+
+        If the lengths `xlen` of the padded batch `xs` are given, the
+        LSTMs run on packed sequences and skip the padding frames."""
         if hiddens is None:
-            hs = xs.new_zeros(len(self.lstms), xs.shape[0], self.hidden_size)
-            cs = xs.new_zeros(len(self.lstms), xs.shape[0], self.hidden_size)
+            hs = cs = zero_state(self, xs)
         else:
             hs, cs = hiddens
         new_hs = []
         new_cs = []
         for i, (lstm, proj) in enumerate(zip(self.lstms, self.projs)):
-            lstm.flatten_parameters()
-            xs_next, (h, c) = lstm(xs, (hs[i, None], cs[i, None]))
+            if isinstance(lstm, nn.LSTM):
+                # not defined for the int8 LSTM of `quantize_transducer`
+                lstm.flatten_parameters()
+            if xlen is None:
+                xs_next, (h, c) = lstm(xs, (hs[i, None], cs[i, None]))
+            else:
+                xs_next, (h, c) = packed_rnn(
+                    lstm, xs, xlen, (hs[i, None], cs[i, None]))
             if i != 0:
                 xs = xs + xs_next
             else:
                 xs = xs_next
-            xs = proj(xs)
-            new_hs.append(h)
-            new_cs.append(c)
+            if xlen is None:
+                xs = proj(xs)
+            else:
+                xs, xlen = packed_proj(proj, xs, xlen)
+            if out is None:
+                new_hs.append(h)
+                new_cs.append(c)
+            else:
+                out[0][i].copy_(h[0])
+                out[1][i].copy_(c[0])
+        if out is not None:
+            return xs, out
         hs = torch.cat(new_hs, dim=0)
         cs = torch.cat(new_cs, dim=0)
         return xs, (hs, cs)
 
+
 class ResLayerNormGRU(nn.Module):
     def __init__(self,
                  input_size,
@@ -96,22 +192,35 @@ class ResLayerNormGRU(nn.Module):
                 proj.append(nn.Dropout(dropout))
             input_size = hidden_size
             self.projs.append(nn.Sequential(*proj))
+        self.zero_hidden = None
 
-    def forward(self, xs, hiddens=None):
+    def forward(self, xs, hiddens=None, out=None, xlen=None):
+        """Like `ResLayerNormLSTM.forward` with a single [L, B, H] state"""
         if hiddens is None:
-            hs = xs.new_zeros(len(self.lstms), xs.shape[0], self.hidden_size)
+            hs = zero_state(self, xs)
         else:
             hs = hiddens
         new_hs = []
         for i, (lstm, proj) in enumerate(zip(self.lstms, self.projs)):
             lstm.flatten_parameters()
-            xs_next, h = lstm(xs, hs[i, None])
+            if xlen is None:
+                xs_next, h = lstm(xs, hs[i, None])
+            else:
+                xs_next, h = packed_rnn(lstm, xs, xlen, hs[i, None])
             if i != 0:
                 xs = xs + xs_next
             else:
                 xs = xs_next
-            xs = proj(xs)
-            new_hs.append(h)
+            if xlen is None:
+                xs = proj(xs)
+            else:
+                xs, xlen = packed_proj(proj, xs, xlen)
+            if out is None:
+                new_hs.append(h)
+            else:
+                out[i].copy_(h[0])
+        if out is not None:
+            return xs, out
         hs = torch.cat(new_hs, dim=0)
         return xs, hs
 
@@ -128,13 +237,20 @@ class Encoder(nn.Module):
         if has_proj:
             self.proj = nn.Linear(hidden_size, proj_size)
 
-    def forward(self, xs, hiddens=None):
+    def forward(self, xs, hiddens=None, out=None, xlen=None):
         xs = self.norm(xs)
-        xs, hiddens = self.lstm(xs, hiddens)
+        xs, hiddens = self.lstm(xs, hiddens, out=out, xlen=xlen)
         if self.has_proj:
             xs = self.proj(xs)
         return xs, hiddens
 
+    def get_lengths(self, xlen):
+        """Output lengths of inputs of `xlen` frames"""
+        for module in self.modules():
+            if isinstance(module, TimeReduction):
+                xlen = module.reduce_length(xlen)
+        return xlen
+
 
 class Decoder(nn.Module):
     def __init__(self, vocab_embed_size, vocab_size, hidden_size, num_layers,
@@ -151,33 +267,86 @@ class Decoder(nn.Module):
         if hidden is None:
             ys = F.pad(ys, [1, 0, 0, 0], value=BOS).long()
         ys = self.embed(ys)
-        self.lstm.flatten_parameters()
+        if isinstance(self.lstm, nn.LSTM):
+            self.lstm.flatten_parameters()
         ys, hidden = self.lstm(ys, hidden)
         ys = self.proj(ys)
         return ys, hidden
 
 
+class StatelessDecoder(nn.Module):
+    """Prediction network which only sees the last `context_size` tokens.
+
+    The hidden state is the `context_size - 1` previous tokens, shaped
+    [1, B, context_size - 1] like the LSTM states so that decoding code can
+    index both the same way. As the output only depends on a bounded token
+    context, it can be cached exactly by that context.
+    """
+    def __init__(self, vocab_embed_size, vocab_size, hidden_size,
+                 context_size=2, dropout=0, proj_size=None):
+        super().__init__()
+        self.context_size = context_size
+        self.embed = nn.Embedding(
+            vocab_size, vocab_embed_size, padding_idx=PAD)
+        self.conv = nn.Conv1d(
+            vocab_embed_size, hidden_size, kernel_size=context_size)
+        self.dropout = nn.Dropout(dropout)
+        self.proj = nn.Linear(hidden_size, proj_size)
+
+    def forward(self, ys, hidden=None):
+        ys = ys.long()
+        if hidden is None:
+            ys = F.pad(ys, [1, 0, 0, 0], value=BOS)
+            context = ys.new_full(
+                (ys.shape[0], self.context_size - 1), PAD)
+        else:
+            context = hidden[0][0]
+        ys = torch.cat([context, ys], dim=1)
+        hidden = (ys[:, ys.shape[1] - self.context_size + 1:].unsqueeze(0),)
+        ys = self.embed(ys).transpose(1, 2)
+        ys = F.relu(self.conv(ys)).transpose(1, 2)
+        ys = self.proj(self.dropout(ys))
+        return ys, hidden
+
+
 class Joint(nn.Module):
-    def __init__(self, input_size, hidden_size, vocab_size):
+    def __init__(self, input_size, hidden_size, vocab_size, enc_size=None):
         super().__init__()
+        # `input_size` is the size of concat([h_enc, h_dec]) the first Linear
+        # was trained on. It is applied as two projections which are added,
+        # so the concatenated tensor never has to be built.
+        if enc_size is None:
+            enc_size = input_size // 2
+        self.enc_size = enc_size
         self.joint = nn.Sequential(
             nn.Linear(input_size, hidden_size),
             nn.Tanh(),
             nn.Linear(hidden_size, vocab_size),
         )
 
-    def forward(self, h_enc, h_dec):
-        if len(h_enc.shape) == 3 and len(h_dec.shape) == 3:
-            h_enc = h_enc.unsqueeze(dim=2)
-            h_dec = h_dec.unsqueeze(dim=1)
-            h_enc = h_enc.expand(-1, -1, h_dec.size(2), -1)
-            h_dec = h_dec.expand(-1, h_enc.size(1), -1, -1)
+    def project_enc(self, h_enc):
+        linear = self.joint[0]
+        return F.linear(
+            h_enc, linear.weight[:, :self.enc_size], linear.bias)
+
+    def project_dec(self, h_dec):
+        linear = self.joint[0]
+        return F.linear(h_dec, linear.weight[:, self.enc_size:])
+
+    def joint_from_projections(self, enc_proj, dec_proj):
+        if len(enc_proj.shape) == 3 and len(dec_proj.shape) == 3:
+            enc_proj = enc_proj.unsqueeze(dim=2)
+            dec_proj = dec_proj.unsqueeze(dim=1)
         else:
-            assert len(h_enc.shape) == len(h_dec.shape)
-        h = torch.cat([h_enc, h_dec], dim=-1)
-        h = self.joint(h)
+            assert len(enc_proj.shape) == len(dec_proj.shape)
+        h = self.joint[1](enc_proj + dec_proj)
+        h = self.joint[2](h)
         return h
 
+    def forward(self, h_enc, h_dec):
+        return self.joint_from_projections(
+            self.project_enc(h_enc), self.project_dec(h_dec))
+
 
 class Transducer(nn.Module):
     def __init__(self,
@@ -185,9 +354,13 @@ class Transducer(nn.Module):
                  enc_hidden_size, enc_layers, enc_dropout, enc_proj_size,
                  dec_hidden_size, dec_layers, dec_dropout, dec_proj_size,
                  joint_size, enc_time_reductions=[1],
-                 blank=NUL, module_type='LSTM', output_loss=True):
+                 blank=NUL, module_type='LSTM', output_loss=True,
+                 loss_chunk_size=0, loss_type='warp', dec_type='LSTM',
+                 dec_context_size=2, packed_encoder=False):
         super().__init__()
         self.blank = blank
+        # skip the padding frames of the encoder inputs
+        self.packed_encoder = packed_encoder
         # Encoder
         if module_type not in ['GRU', 'LSTM']:
             raise ValueError('Unsupported module type')
@@ -204,63 +377,115 @@ class Transducer(nn.Module):
             time_reductions=enc_time_reductions,
             module=module)
         # Decoder
-        self.decoder = Decoder(
-            vocab_embed_size=vocab_embed_size,
-            vocab_size=vocab_size,
-            hidden_size=dec_hidden_size,
-            num_layers=dec_layers,
-            dropout=dec_dropout,
-            proj_size=dec_proj_size)
+        if dec_type not in ['LSTM', 'stateless']:
+            raise ValueError('Unsupported decoder type')
+        if dec_type == 'stateless':
+            self.decoder = StatelessDecoder(
+                vocab_embed_size=vocab_embed_size,
+                vocab_size=vocab_size,
+                hidden_size=dec_hidden_size,
+                context_size=dec_context_size,
+                dropout=dec_dropout,
+                proj_size=dec_proj_size)
+        else:
+            self.decoder = Decoder(
+                vocab_embed_size=vocab_embed_size,
+                vocab_size=vocab_size,
+                hidden_size=dec_hidden_size,
+                num_layers=dec_layers,
+                dropout=dec_dropout,
+                proj_size=dec_proj_size)
         # Joint
         self.joint = Joint(
             input_size=enc_proj_size + dec_proj_size,
             hidden_size=joint_size,
-            vocab_size=vocab_size)
+            vocab_size=vocab_size,
+            enc_size=enc_proj_size)
         self.output_loss = output_loss
-        if output_loss:
-            self.loss_fn = RNNTLoss(blank=blank)
+        # > 0: compute joint and loss on chunks of this many encoder frames
+        self.loss_chunk_size = loss_chunk_size
+        if output_loss and loss_chunk_size == 0:
+            self.loss_fn = build_loss(loss_type, blank=blank)
 
     def scale_length(self, logits, xlen):
         scale = (xlen.max().float() / logits.shape[1]).ceil()
         xlen = (xlen / scale).ceil().int()
         return xlen
 
+    def encode(self, xs, xlen):
+        """Encoder outputs of a padded batch and their lengths"""
+        if self.packed_encoder:
+            h_enc, _ = self.encoder(xs, xlen=xlen)
+        else:
+            h_enc, _ = self.encoder(xs)
+        return h_enc, self.encoder.get_lengths(xlen).int()
+
     def forward(self, xs, ys, xlen, ylen):
-        xs = xs[:, :xlen.max()].contiguous()
+        # keep the padding which aligns the frames to the time reduction
+        reduction = time_reduction_factor(self.encoder)
+        max_t = -(-int(xlen.max()) // reduction) * reduction
+        xs = xs[:, :max_t].contiguous()
         ys = ys[:, :ylen.max()].contiguous()
 
-        h_enc, _ = self.encoder(xs)
+        h_enc, xlen = self.encode(xs, xlen)
         h_dec, _ = self.decoder(ys)
-        logits = self.joint(h_enc, h_dec)
+        enc_proj = self.joint.project_enc(h_enc)
+        dec_proj = self.joint.project_dec(h_dec)
+
+        if self.output_loss and self.loss_chunk_size > 0:
+            loss = chunked_rnnt_loss(
+                self.joint, enc_proj, dec_proj, ys, xlen, ylen,
+                self.loss_chunk_size, blank=self.blank)
+            return loss
+
+        logits = self.joint.joint_from_projections(enc_proj, dec_proj)
 
         if self.output_loss:
-            xlen = self.scale_length(logits, xlen)
             loss = self.loss_fn(logits, ys, xlen, ylen)
             return loss
 
         return logits
 
-    def greedy_decode(self, xs, xlen):
+    def decoder_step(self, ys, hidden):
+        h_dec, hidden = self.decoder(ys, hidden)
+        return self.joint.project_dec(h_dec[:, 0]), hidden
+
+    def greedy_decode(self, xs, xlen, cache=None):
         # encoder
-        h_enc, _ = self.encoder(xs)
+        h_enc, xlen = self.encode(xs, xlen)
+        enc_proj = self.joint.project_enc(h_enc)
         # decoder
-        h_dec, (h_prev, c_prev) = self.decoder(xs.new_empty(xs.shape[0], 0))
+        h_dec, hidden = self.decoder(xs.new_empty(xs.shape[0], 0))
+        dec_proj = self.joint.project_dec(h_dec[:, 0])
+        histories = [()] * xs.shape[0]
         y_seq = []
         log_p = []
         # greedy
         for i in range(h_enc.shape[1]):
             # joint
-            logits = self.joint(h_enc[:, i], h_dec[:, 0])
+            logits = self.joint.joint_from_projections(enc_proj[:, i], dec_proj)
             probs = F.log_softmax(logits, dim=1)
             prob, pred = torch.max(probs, dim=1)
             y_seq.append(pred)
             log_p.append(prob)
             # replace non blank entities with new state
-            h_dec_new, (h_next, c_next) = self.decoder(
-                pred.unsqueeze(-1), (h_prev, c_prev))
-            h_dec[pred != self.blank, ...] = h_dec_new[pred != self.blank, ...]
-            h_prev[:, pred != self.blank, :] = h_next[:, pred != self.blank, :]
-            c_prev[:, pred != self.blank, :] = c_next[:, pred != self.blank, :]
+            emit = pred != self.blank
+            if cache is None:
+                dec_proj_new, hidden_next = self.decoder_step(
+                    pred.unsqueeze(-1), hidden)
+                dec_proj[emit, ...] = dec_proj_new[emit, ...]
+                for x, x_next in zip(hidden, hidden_next):
+                    x[:, emit, :] = x_next[:, emit, :]
+            elif emit.any():
+                rows = emit.nonzero().view(-1).tolist()
+                tokens = pred.tolist()
+                for row in rows:
+                    histories[row] = histories[row] + (tokens[row],)
+                dec_proj_new, hidden_next = cache.step(
+                    [histories[row] for row in rows], hidden, rows)
+                dec_proj[rows] = dec_proj_new
+                for x, x_next in zip(hidden, hidden_next):
+                    x[:, rows] = x_next
         y_seq = torch.stack(y_seq, dim=1)
         log_p = torch.stack(log_p, dim=1).sum(dim=1)
         y_seq_truncated = []
@@ -268,6 +493,143 @@ class Transducer(nn.Module):
             y_seq_truncated.append(seq[:seq_len].cpu().numpy())
         return y_seq_truncated, -log_p
 
+    def beam_init(self, batch_size, beam_size, device=None, cache=None):
+        if cache is None:
+            cache = DecoderCache(self.decoder_step, max_size=None)
+        h_dec, hidden = self.decoder(
+            torch.zeros(batch_size, 0, dtype=torch.long, device=device))
+        dec_proj = self.joint.project_dec(h_dec[:, 0])
+        scores = dec_proj.new_full((batch_size, beam_size), float('-inf'))
+        scores[:, 0] = 0
+        return BeamState(
+            scores=scores,
+            prefixes=[[()] * beam_size for _ in range(batch_size)],
+            dec_proj=dec_proj.repeat_interleave(beam_size, dim=0),
+            hidden=tuple(
+                x.repeat_interleave(beam_size, dim=1) for x in hidden),
+            cache=cache)
+
+    def _beam_expand(self, state, prefixes, hidden, parent, token):
+        """Append `token` to hypothesis `parent` and run the prediction
+        network, only on histories which are not in the cache yet"""
+        B, K = parent.shape
+        parent = parent.tolist()
+        token = token.tolist()
+        new_prefixes = []
+        histories = []
+        rows = []
+        for b in range(B):
+            new_prefixes.append([])
+            for k in range(K):
+                prefix = prefixes[b][parent[b][k]] + (token[b][k],)
+                new_prefixes[b].append(prefix)
+                histories.append(state.context + prefix)
+                rows.append(b * K + parent[b][k])
+        dec_proj, new_hidden = state.cache.step(histories, hidden, rows)
+        return new_prefixes, dec_proj, new_hidden
+
+    def beam_step(self, state, enc_proj, active=None, max_sym_per_frame=1):
+        """Advance every hypothesis by one encoder frame.
+
+        Modified beam search: up to `max_sym_per_frame` labels are emitted
+        on a frame, a hypothesis leaves the frame either with blank or with
+        its last allowed label. Label candidates are pruned to the beam with
+        top-k over [B, K * V] and identical prefixes are merged.
+
+        Args:
+            state (BeamState): hypotheses, from `beam_init`.
+            enc_proj (Tensor): [B, H] projected encoder output of the frame.
+            active (list): per utterance, False keeps its beam unchanged,
+                e.g. past the end of a shorter utterance in the batch.
+        """
+        B, K = state.scores.shape
+        enc_proj = enc_proj.unsqueeze(1).expand(-1, K, -1)
+        # hypotheses moving on to the next frame, blank extension first
+        pool = []
+        scores, prefixes = state.scores, state.prefixes
+        dec_proj, hidden = state.dec_proj, state.hidden
+        for _ in range(max_sym_per_frame):
+            logits = self.joint.joint_from_projections(
+                enc_proj, dec_proj.reshape(B, K, -1))
+            logprobs = F.log_softmax(logits, dim=-1)
+            pool.append((
+                scores + logprobs[..., self.blank], prefixes, dec_proj,
+                hidden))
+            logprobs[..., self.blank] = float('-inf')
+            V = logprobs.shape[-1]
+            candidates = (scores.unsqueeze(-1) + logprobs).view(B, K * V)
+            scores, index = candidates.topk(K, dim=1)
+            prefixes, dec_proj, hidden = self._beam_expand(
+                state, prefixes, hidden, index // V, index % V)
+        pool.append((scores, prefixes, dec_proj, hidden))
+
+        M = len(pool)
+        pool_scores = torch.cat([p[0] for p in pool], dim=1).tolist()
+        old_scores = state.scores.tolist()
+        select = []
+        new_scores = []
+        new_prefixes = []
+        for b in range(B):
+            if active is not None and not active[b]:
+                # the blank extension holds the unchanged hypotheses
+                select.extend(b * M * K + k for k in range(K))
+                new_scores.append(old_scores[b])
+                new_prefixes.append(state.prefixes[b])
+                continue
+            merged = {}
+            for m, (_, pool_prefixes, _, _) in enumerate(pool):
+                for k, prefix in enumerate(pool_prefixes[b]):
+                    score = pool_scores[b][m * K + k]
+                    if prefix in merged:
+                        score = np.logaddexp(merged[prefix][0], score)
+                        merged[prefix] = (score, merged[prefix][1])
+                    else:
+                        merged[prefix] = (score, m * K + k)
+            best = sorted(
+                merged.items(), key=lambda item: item[1][0], reverse=True)
+            best = best[:K]
+            best += [(best[0][0], (float('-inf'), best[0][1][1]))] * (
+                K - len(best))
+            select.extend(b * M * K + index for _, (_, index) in best)
+            new_scores.append([score for _, (score, _) in best])
+            new_prefixes.append([prefix for prefix, _ in best])
+
+        # stack the pool as [B, M * K] hypotheses and gather the new beam
+        select = torch.tensor(select, device=state.dec_proj.device)
+        dec_proj = torch.cat(
+            [p[2].reshape(B, K, -1) for p in pool], dim=1)
+        dec_proj = dec_proj.reshape(B * M * K, -1)
+        hidden = []
+        for i, x in enumerate(state.hidden):
+            L, _, H = x.shape
+            x = torch.cat(
+                [p[3][i].reshape(L, B, K, H) for p in pool], dim=2)
+            hidden.append(x.reshape(L, B * M * K, H))
+        state.scores = state.scores.new_tensor(new_scores)
+        state.prefixes = new_prefixes
+        state.dec_proj = dec_proj[select]
+        state.hidden = tuple(x[:, select] for x in hidden)
+        return state
+
+    def beam_search(self, xs, xlen, beam_size=4, max_sym_per_frame=1,
+                    cache=None):
+        # encoder
+        h_enc, xlen = self.encode(xs, xlen)
+        enc_proj = self.joint.project_enc(h_enc)
+        xlen = xlen.tolist()
+        # beam search over all utterances at once
+        state = self.beam_init(
+            xs.shape[0], beam_size, device=xs.device, cache=cache)
+        for i in range(h_enc.shape[1]):
+            active = [i < seq_len for seq_len in xlen]
+            state = self.beam_step(
+                state, enc_proj[:, i], active, max_sym_per_frame)
+        log_p, best = state.scores.max(dim=1)
+        y_seq = [
+            np.array(prefixes[k], dtype=np.int64)
+            for prefixes, k in zip(state.prefixes, best.tolist())]
+        return y_seq, -log_p
+
 
 class CTCEncoder(nn.Module):
     def __init__(self, vocab_size, input_size,
@@ -365,6 +727,20 @@ class FrontEnd(nn.Module):
         return features
 
 
+def quantize_transducer(transducer):
+    """Copy of `transducer` with int8 weights for the LSTMs and Linears of
+    the encoder, the decoder and the output layer of the joint, activations
+    are quantized on the fly. The first Linear of the joint stays in fp32,
+    it is applied as separate encoder and decoder projections."""
+    qconfig = torch.quantization.default_dynamic_qconfig
+    return torch.quantization.quantize_dynamic(
+        transducer, {
+            'encoder': qconfig,
+            'decoder': qconfig,
+            'joint.joint.2': qconfig,
+        }, dtype=torch.qint8)
+
+
 def convert_lightning2normal(checkpoint):
     keys = checkpoint.keys()
 
@@ -462,6 +838,45 @@ class ConvFeatureExtractionModel(nn.Module):
 
 
 if __name__ == "__main__":
+    # the packed encoder matches the encoder on each unpadded utterance
+    encoder = Encoder(40, 32, 3, 0., 16, module=ResLayerNormLSTM).eval()
+    xlen = torch.tensor([9, 4, 7])
+    xs = torch.randn(3, 9, 40)
+    with torch.no_grad():
+        ys, (hs, cs) = encoder(xs, xlen=xlen)
+        ylen = encoder.get_lengths(xlen)
+        for i, (x_len, y_len) in enumerate(zip(xlen, ylen)):
+            y, (h, c) = encoder(xs[i:i + 1, :x_len])
+            assert y.shape[1] == y_len
+            assert torch.allclose(ys[i:i + 1, :y_len], y, atol=1e-5)
+            assert torch.allclose(hs[:, i:i + 1], h, atol=1e-5)
+            assert torch.allclose(cs[:, i:i + 1], c, atol=1e-5)
+
+    # per chunk allocations and latency of the encoder states, with new
+    # state tensors and with states written into preallocated ones
+    import time
+    from torch.autograd import profiler
+
+    encoder = Encoder(
+        240, 256, 4, 0.1, 320, module=ResLayerNormLSTM).eval()
+    xs = torch.randn(1, 2, 240)
+    hidden = (torch.zeros(4, 1, 256), torch.zeros(4, 1, 256))
+    with torch.no_grad():
+        for name, out in [('new', None), ('in place', hidden)]:
+            with profiler.profile() as prof:
+                encoder(xs, hidden, out=out)
+            allocations = sum(
+                event.name.split('::')[-1] in [
+                    'empty', 'empty_like', 'empty_strided']
+                for event in prof.function_events)
+            for _ in range(10):
+                encoder(xs, hidden, out=out)
+            start = time.time()
+            for _ in range(1000):
+                encoder(xs, hidden, out=out)
+            print('%-8s states: %d allocations, %.3f ms per chunk' % (
+                name, allocations, (time.time() - start) / 1000 * 1000))
+
     # test model
     # from warprnnt_pytorch import RNNTLoss
     # model = Transducer(
@@ -0,0 +1,241 @@
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from rnnt.buffer import RingBuffer
+
+
+class PipelineMetrics:
+    """Counters and latencies of each stage of a `StreamPipeline`"""
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.ingested_samples = 0
+        self.dropped_samples = 0
+        self.decoded_samples = 0
+        self.chunks = 0
+        self.decode_calls = 0
+        self.decode_time = 0.
+        self.max_decode_time = 0.
+        self.queue_wait = 0.
+        self.max_queue_wait = 0.
+        self.dequeued = 0
+        self.max_queue_depth = 0
+
+    def ingest(self, samples, depth):
+        with self.lock:
+            self.ingested_samples += samples
+            self.chunks += 1
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def drop(self, samples):
+        with self.lock:
+            self.dropped_samples += samples
+
+    def dequeue(self, wait):
+        with self.lock:
+            self.dequeued += 1
+            self.queue_wait += wait
+            self.max_queue_wait = max(self.max_queue_wait, wait)
+
+    def decode(self, samples, elapsed):
+        with self.lock:
+            self.decoded_samples += samples
+            self.decode_calls += 1
+            self.decode_time += elapsed
+            self.max_decode_time = max(self.max_decode_time, elapsed)
+
+    def backlog(self):
+        """Samples ingested but not decoded nor dropped yet"""
+        with self.lock:
+            return (
+                self.ingested_samples - self.dropped_samples -
+                self.decoded_samples)
+
+    def summary(self):
+        with self.lock:
+            decoded = self.decoded_samples / self.sample_rate
+            return {
+                # audio waiting in the queue or the buffer, in seconds
+                'lag': (
+                    self.ingested_samples - self.dropped_samples -
+                    self.decoded_samples) / self.sample_rate,
+                'dropped': self.dropped_samples / self.sample_rate,
+                'rtf': self.decode_time / decoded if decoded > 0 else 0.,
+                'decode_ms': 1000 * self.decode_time / max(
+                    self.decode_calls, 1),
+                'max_decode_ms': 1000 * self.max_decode_time,
+                'audio_per_call_ms': 1000 * decoded / max(
+                    self.decode_calls, 1),
+                'queue_ms': 1000 * self.queue_wait / max(self.dequeued, 1),
+                'max_queue_ms': 1000 * self.max_queue_wait,
+                'max_queue_depth': self.max_queue_depth,
+            }
+
+    def __str__(self):
+        return ', '.join(
+            '%s: %.3f' % (key, value) for key, value in self.summary().items())
+
+
+class StreamPipeline:
+    """Decouple audio ingestion from decoding.
+
+    An ingestion thread reads PCM chunks from `source` into a bounded queue
+    and the decode worker drains the queue on the calling thread. When
+    decoding falls behind:
+        'drop': the oldest queued chunk is discarded for each new one, the
+            lag stays bounded by `queue_size` chunks.
+        'coalesce': everything queued is decoded at once, up to
+            `max_coalesce` hops per encoder call, which catches up with
+            fewer and larger calls. Ingestion waits only if the queue
+            is full.
+    Hops per call are rounded down to a power of two to bound the number of
+    encoder input shapes. If the decoder has a `chunk_controller`, it picks
+    the hops of every call from the backlog instead of `max_coalesce`, and
+    `push` is fed in chunks of that many hops.
+
+    Args:
+        stream_decoder: `decode(window)` on overlapping windows, or
+            `push(pcm)` if `incremental`.
+        win_size, hop_size (int): window and hop in samples.
+        scale (float): multiplier of the source samples, e.g. 1 / 32768.
+    """
+    def __init__(self, stream_decoder, win_size, hop_size, incremental=False,
+                 queue_size=64, backpressure='coalesce', max_coalesce=8,
+                 scale=1., sample_rate=16000):
+        if backpressure not in ['drop', 'coalesce']:
+            raise ValueError('Unsupported backpressure')
+        self.stream_decoder = stream_decoder
+        self.win_size = win_size
+        self.hop_size = hop_size
+        self.incremental = incremental
+        self.backpressure = backpressure
+        self.controller = stream_decoder.chunk_controller
+        if self.controller is not None:
+            # `hop_size` is the hop of the smallest chunk
+            max_coalesce = (
+                self.controller.max_frames // self.controller.min_frames)
+        elif backpressure == 'drop':
+            max_coalesce = 1
+        self.max_coalesce = max_coalesce
+        self.scale = scale
+        self.queue = queue.Queue(maxsize=queue_size)
+        # room for the largest coalesced window plus a second of audio
+        self.buffer = RingBuffer(
+            win_size + hop_size * max_coalesce + sample_rate)
+        self.metrics = PipelineMetrics(sample_rate)
+        self.error = None
+
+    def ingest(self, source):
+        try:
+            for chunk in source:
+                self.put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            # end of stream, always delivered
+            self.queue.put((time.time(), None))
+
+    def put(self, chunk):
+        item = (time.time(), chunk)
+        if self.backpressure == 'drop':
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        _, dropped = self.queue.get_nowait()
+                        if dropped is not None:
+                            self.metrics.drop(dropped.shape[-1])
+                    except queue.Empty:
+                        pass
+        else:
+            self.queue.put(item)
+        self.metrics.ingest(chunk.shape[-1], self.queue.qsize())
+
+    def get(self, block):
+        queued_time, chunk = self.queue.get(block=block)
+        self.metrics.dequeue(time.time() - queued_time)
+        return chunk
+
+    def run(self, source, on_text):
+        """Decode `source` until it is exhausted, `on_text(text, samples)`
+        is called with the text and the samples decoded by every call"""
+        thread = threading.Thread(
+            target=self.ingest, args=(source,), daemon=True)
+        thread.start()
+        finished = False
+        while not finished:
+            chunks = [self.get(block=True)]
+            if self.backpressure == 'coalesce':
+                # everything that arrived while the last call was running
+                while True:
+                    try:
+                        chunks.append(self.get(block=False))
+                    except queue.Empty:
+                        break
+            if chunks[-1] is None:
+                finished = True
+                chunks = chunks[:-1]
+            if len(chunks) == 0:
+                continue
+            if self.incremental:
+                self.decode_pcm(chunks, on_text)
+            else:
+                for chunk in chunks:
+                    if len(self.buffer) + chunk.shape[-1] > \
+                            self.buffer.capacity:
+                        self.decode_windows(on_text)
+                    self.buffer.write(chunk, scale=self.scale)
+                self.decode_windows(on_text)
+        # tail held back by the decoder
+        on_text(self.stream_decoder.flush(), 0)
+        thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def decode_pcm(self, chunks, on_text):
+        if self.backpressure == 'coalesce':
+            chunks = [np.concatenate(chunks, axis=-1)]
+        for chunk in chunks:
+            pcm = torch.from_numpy(
+                np.asarray(chunk, dtype=np.float32) * self.scale).view(1, -1)
+            while pcm.shape[-1] > 0:
+                size = pcm.shape[-1]
+                if self.controller is not None:
+                    # pushed in hops of the controller's chunk size
+                    backlog = self.metrics.backlog() // self.hop_size
+                    frames = self.controller.update(
+                        backlog * self.controller.min_frames)
+                    size = min(
+                        size,
+                        frames // self.controller.min_frames * self.hop_size)
+                start = time.time()
+                text = self.stream_decoder.push(pcm[:, :size])
+                self.metrics.decode(size, time.time() - start)
+                pcm = pcm[:, size:]
+                on_text(text, size)
+
+    def decode_windows(self, on_text):
+        while len(self.buffer) >= self.win_size:
+            hops = 1 + (len(self.buffer) - self.win_size) // self.hop_size
+            if self.controller is not None:
+                # queued and buffered audio, in hops of the smallest chunk
+                backlog = self.metrics.backlog() // self.hop_size
+                frames = self.controller.update(
+                    backlog * self.controller.min_frames)
+                hops = min(hops, frames // self.controller.min_frames)
+            else:
+                hops = min(hops, self.max_coalesce)
+            hops = 2 ** (hops.bit_length() - 1)
+            window = self.buffer.peek(
+                self.win_size + (hops - 1) * self.hop_size)
+            start = time.time()
+            text = self.stream_decoder.decode(window)
+            self.metrics.decode(hops * self.hop_size, time.time() - start)
+            self.buffer.advance(hops * self.hop_size)
+            on_text(text, hops * self.hop_size)
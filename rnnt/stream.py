@@ -7,12 +7,63 @@ try:
     from openvino.inference_engine import IECore
 except:
     pass
-from rnnt.models import Transducer, convert_lightning2normal
-from rnnt.transforms import build_transform
-from rnnt.tokenizer import HuggingFaceTokenizer, BOS, NUL
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+from rnnt.cache import build_decoder_cache
+from rnnt.compress import factorize_transducer
+from rnnt.jit import check_equivalence, script_transducer
+from rnnt.models import (
+    Transducer, convert_lightning2normal, quantize_transducer,
+    time_reduction_factor)
+from rnnt.transforms import build_transform, build_streaming_transform
+from rnnt.tokenizer import HuggingFaceTokenizer, BOS, NUL, PAD
+
+
+class AdaptiveChunkController:
+    """Encoder frames (step_n_frame) per call, grown while decoding lags
+    behind and shrunk once it has caught up.
+
+    Chunks are `min_frames` times a power of two, so an encoder with a fixed
+    input shape per chunk size only needs a few of them. The chunk doubles
+    when at least `grow` chunks are waiting and halves when less than
+    `shrink` of one is.
+    """
+    def __init__(self, min_frames, max_frames, grow=2., shrink=0.5):
+        assert min_frames <= max_frames
+        self.min_frames = min_frames
+        self.max_frames = min_frames
+        while self.max_frames * 2 <= max_frames:
+            self.max_frames *= 2
+        self.grow = grow
+        self.shrink = shrink
+        self.reset()
+
+    def reset(self):
+        self.frames = self.min_frames
+
+    def update(self, backlog):
+        """Chunk of the next call given `backlog` frames waiting"""
+        if backlog >= self.grow * self.frames:
+            self.frames = min(self.frames * 2, self.max_frames)
+        elif backlog < self.shrink * self.frames:
+            self.frames = max(self.frames // 2, self.min_frames)
+        return self.frames
+
+
+def build_chunk_controller(FLAGS):
+    """AdaptiveChunkController from step_n_frame up to max_step_n_frame,
+    None if the chunk size is fixed"""
+    if FLAGS.max_step_n_frame <= FLAGS.step_n_frame:
+        return None
+    return AdaptiveChunkController(FLAGS.step_n_frame, FLAGS.max_step_n_frame)
 
 
 class StreamTransducerDecoder:
+    # set to an AdaptiveChunkController to decode windows of varying size
+    chunk_controller = None
+
     def reset_profile(self):
         self.encoder_elapsed = []
         self.decoder_elapsed = []
@@ -24,11 +75,23 @@ class StreamTransducerDecoder:
     def decode(self, frame):
         raise NotImplementedError()
 
+    def flush(self):
+        """Text still held back at the end of a stream, call before
+        `reset` so it is not lost"""
+        return ""
+
 
 class PytorchStreamDecoder(StreamTransducerDecoder):
-    def __init__(self, FLAGS):
+    # number of frames scored per joint call while no token is emitted
+    lookahead = 16
+    # decodes greedily whatever the beam size
+    greedy_only = False
+
+    def __init__(self, FLAGS, quantize=None):
         self.FLAGS = FLAGS
         logdir = os.path.join('logs', FLAGS.name)
+        if quantize is None:
+            quantize = FLAGS.quantize
 
         self.tokenizer = HuggingFaceTokenizer(
             cache_dir='BPE-'+str(FLAGS.bpe_size), vocab_size=FLAGS.bpe_size)
@@ -64,13 +127,64 @@ class PytorchStreamDecoder(StreamTransducerDecoder):
             dec_proj_size=FLAGS.dec_proj_size,
             joint_size=FLAGS.joint_size,
             output_loss=False,
+            dec_type=FLAGS.dec_type,
+            dec_context_size=FLAGS.dec_context_size,
         )
 
-        transducer.load_state_dict(convert_lightning2normal(checkpoint)['model'])
+        checkpoint = convert_lightning2normal(checkpoint)
+        if FLAGS.torchscript and (
+                quantize or checkpoint.get('quantized', False) or
+                checkpoint.get('ranks')):
+            raise ValueError(
+                '--torchscript needs a dense float checkpoint, quantized '
+                '(cli/quantize.py) and factorized (cli/compress.py) models '
+                'are not scriptable')
+        # written by cli/compress.py
+        factorize_transducer(transducer, checkpoint.get('ranks', {}))
+        if checkpoint.get('quantized', False):
+            # written by cli/quantize.py
+            transducer = quantize_transducer(transducer)
+            transducer.load_state_dict(checkpoint['model'])
+        else:
+            transducer.load_state_dict(checkpoint['model'])
+            if quantize:
+                transducer = quantize_transducer(transducer)
         transducer.eval()
+        self.model = transducer
         self.encoder = transducer.encoder
         self.decoder = transducer.decoder
         self.joint = transducer.joint
+        self.decoder_step = transducer.decoder_step
+        # incremental features for `push`, only available for logfbank
+        self.stream_transform = build_streaming_transform(
+            self.transform, step=time_reduction_factor(self.encoder))
+        self.scripted = None
+        if FLAGS.torchscript:
+            assert FLAGS.dec_type == 'LSTM', (
+                "TorchScript streaming only supports the LSTM decoder")
+            # the beam search keeps using the eager modules
+            self.scripted = script_transducer(transducer)
+            check_equivalence(transducer, self.scripted, input_size)
+            self.encoder = self.scripted.encode
+            self.joint = self.scripted
+            self.decoder_step = self.scripted.decoder_step
+
+        vocab_size = self.tokenizer.vocab_size
+        self.id2token = [
+            self.tokenizer.tokenizer.id_to_token(idx) or ''
+            for idx in range(vocab_size)]
+        self.id2token = [seq.replace('</w>', ' ') for seq in self.id2token]
+        # additive mask which keeps <unk> from ever being emitted
+        self.logit_mask = torch.zeros(vocab_size)
+        unk = self.tokenizer.tokenizer.token_to_id('<unk>')
+        if unk is not None:
+            self.logit_mask[unk] = float('-inf')
+        self.dec_token = torch.ones(1, 1).long() * BOS
+        # kept across `reset` unless the beam trims full-history keys, the
+        # greedy history is never trimmed and needs a bounded key
+        self.cache = build_decoder_cache(
+            FLAGS, self.decoder_step,
+            bounded=self.greedy_only or FLAGS.beam_size <= 1)
 
         self.reset_profile()
         self.reset()
@@ -82,46 +196,299 @@ class PytorchStreamDecoder(StreamTransducerDecoder):
         self.enc_c = torch.zeros(
             self.FLAGS.enc_layers, 1, self.FLAGS.enc_hidden_size)
 
-        dec_x = torch.ones(1, 1).long() * BOS
-        dec_h = torch.zeros(
-            self.FLAGS.dec_layers, 1, self.FLAGS.dec_hidden_size)
-        dec_c = torch.zeros(
-            self.FLAGS.dec_layers, 1, self.FLAGS.dec_hidden_size)
-        self.dec_x, (self.dec_h, self.dec_c) = self.decoder(
-            dec_x, (dec_h, dec_c))
+        # decoder output after <bos>, the hidden state is a tuple of
+        # [L, 1, H] tensors for both the LSTM and the stateless decoder
+        dec_x, self.dec_hidden = self.decoder(torch.zeros(1, 0).long())
+        self.dec_proj = self.joint.project_dec(dec_x[0])
+        self.history = ()
+        if self.FLAGS.beam_size > 1:
+            if self.cache is not None and self.cache.context_size is None:
+                # `beam_decode` trimmed the keys to the old utterance
+                self.cache.clear()
+            self.beam = self.model.beam_init(
+                1, self.FLAGS.beam_size, cache=self.cache)
+        if self.stream_transform is not None:
+            self.stream_transform.reset()
+
+    def beam_decode(self, enc_proj):
+        """Run the beam over the frames of one window and return the tokens
+        every hypothesis agrees on, those can not change any more"""
+        start = time.time()
+        for k in range(enc_proj.shape[0]):
+            self.beam = self.model.beam_step(
+                self.beam, enc_proj[k:k + 1],
+                max_sym_per_frame=self.FLAGS.max_sym_per_frame)
+        alive = [
+            prefix for prefix, score in zip(
+                self.beam.prefixes[0], self.beam.scores[0].tolist())
+            if score > float('-inf')]
+        committed = os.path.commonprefix(alive)
+        self.beam_commit(committed)
+        self.joint_elapsed.append(time.time() - start)
+        return "".join(self.id2token[token] for token in committed)
+
+    def beam_finish(self):
+        """Commit the best hypothesis and return its tokens which are not
+        emitted yet, the other hypotheses are dropped"""
+        scores = self.beam.scores[0]
+        best = scores.argmax().item()
+        tail = self.beam.prefixes[0][best]
+        alive = torch.full_like(scores, float('-inf'))
+        alive[best] = 0
+        self.beam.scores = (scores + alive).unsqueeze(0)
+        self.beam_commit(tail)
+        return "".join(self.id2token[token] for token in tail)
+
+    def beam_commit(self, committed):
+        """Drop the `committed` prefix of every alive hypothesis so
+        prefixes and cache keys stay short"""
+        n = len(committed)
+        if n > 0:
+            self.beam.prefixes = [
+                [prefix[n:] for prefix in self.beam.prefixes[0]]]
+            context_size = self.beam.cache.context_size
+            if context_size is None:
+                self.beam.cache.trim(committed)
+            else:
+                context = self.beam.context + committed
+                self.beam.context = context[len(context) - context_size:]
 
     @torch.no_grad()
     def decode(self, frame):
+        """Decode one overlapping window of `win_size` samples"""
         start = time.time()
         xs = self.transform(frame).transpose(1, 2)
-        enc_xs, (self.enc_h, self.enc_c) = self.encoder(
-            xs, (self.enc_h, self.enc_c))
+        return self._decode_features(xs, start)
+
+    @torch.no_grad()
+    def push(self, pcm):
+        """Decode PCM of any length, features are extracted incrementally
+        so consecutive pushes do not have to overlap"""
+        if self.stream_transform is None:
+            raise ValueError(
+                'push needs logfbank features, use decode on windows')
+        start = time.time()
+        xs = self.stream_transform.push(pcm).transpose(1, 2)
+        return self._decode_features(xs, start)
+
+    @torch.no_grad()
+    def flush(self):
+        """Decode the frames held back by `push` and, with beam search, the
+        undecided tail of the best hypothesis at the end of a stream"""
+        text = ""
+        if self.stream_transform is not None:
+            start = time.time()
+            xs = self.stream_transform.flush().transpose(1, 2)
+            text = self._decode_features(xs, start)
+        if self.FLAGS.beam_size > 1:
+            text += self.beam_finish()
+        return text
+
+    def _decode_features(self, xs, start):
+        if xs.shape[1] == 0:
+            return ""
+        # the new states overwrite the old ones in place
+        enc_xs, _ = self.encoder(
+            xs, (self.enc_h, self.enc_c), out=(self.enc_h, self.enc_c))
         self.encoder_elapsed.append(time.time() - start)
 
+        # encoder half of the joint for every frame of the chunk at once
+        enc_proj = self.joint.project_enc(enc_xs[0])
+        if self.FLAGS.beam_size > 1:
+            return self.beam_decode(enc_proj)
+
         tokens = []
+        k = 0
+        while k < enc_proj.shape[0]:
+            # the decoder half only changes after a non-blank emission, so
+            # score the next frames against it in one go and jump to the
+            # first frame which emits
+            start = time.time()
+            prob = self.joint.joint_from_projections(
+                enc_proj[k:k + self.lookahead], self.dec_proj)
+            prob = prob + self.logit_mask
+            preds = prob.argmax(dim=-1)
+            emits = (preds != NUL).nonzero()
+            self.joint_elapsed.append(time.time() - start)
+            if len(emits) == 0:
+                k += self.lookahead
+                continue
+
+            offset = emits[0].item()
+            pred = preds[offset].item()
+            k += offset + 1
+
+            start = time.time()
+            if self.cache is not None:
+                self.history = self.cache.key(self.history + (pred,))
+                self.dec_proj, self.dec_hidden = self.cache.step(
+                    [self.history], self.dec_hidden)
+            else:
+                self.dec_token.fill_(pred)
+                self.dec_proj, self.dec_hidden = self.decoder_step(
+                    self.dec_token, self.dec_hidden)
+            self.decoder_elapsed.append(time.time() - start)
+            tokens.append(self.id2token[pred])
+        return "".join(tokens)
+
+
+class PytorchMultiStreamDecoder(PytorchStreamDecoder):
+    """Serve many live streams with one batched model call per tick.
+
+    Encoder and decoder states of all attached sessions are stacked along the
+    batch dimension, row `i` of every state belongs to `self.sessions[i]`.
+    Sessions can be attached and detached between any two `decode` calls.
+    """
+    greedy_only = True
+
+    @torch.no_grad()
+    def reset(self):
+        self.sessions = []
+        self.rows = {}
+        self.next_session_id = 0
+
+        self.enc_h = torch.zeros(
+            self.FLAGS.enc_layers, 0, self.FLAGS.enc_hidden_size)
+        self.enc_c = torch.zeros(
+            self.FLAGS.enc_layers, 0, self.FLAGS.enc_hidden_size)
+
+        # decoder output after <bos>, shared by every new session
+        init_dec_x, self.init_dec_hidden = self.decoder(
+            torch.zeros(1, 0).long())
+        self.init_dec_proj = self.joint.project_dec(init_dec_x[:, 0])
+        self.dec_proj = self.init_dec_proj[:0]
+        self.dec_hidden = tuple(x[:, :0] for x in self.init_dec_hidden)
+        self.histories = {}
+
+    def attach(self):
+        """Allocate states for a new session and return its id"""
+        session_id = self.next_session_id
+        self.next_session_id += 1
+        self.rows[session_id] = len(self.sessions)
+        self.sessions.append(session_id)
+
+        self.enc_h = torch.cat([
+            self.enc_h,
+            self.enc_h.new_zeros(
+                self.FLAGS.enc_layers, 1, self.FLAGS.enc_hidden_size)], dim=1)
+        self.enc_c = torch.cat([
+            self.enc_c,
+            self.enc_c.new_zeros(
+                self.FLAGS.enc_layers, 1, self.FLAGS.enc_hidden_size)], dim=1)
+        self.dec_proj = torch.cat([self.dec_proj, self.init_dec_proj], dim=0)
+        self.dec_hidden = tuple(
+            torch.cat([x, x_init], dim=1)
+            for x, x_init in zip(self.dec_hidden, self.init_dec_hidden))
+        self.histories[session_id] = ()
+        return session_id
+
+    def detach(self, session_id):
+        """Drop the states of a finished session"""
+        keep = torch.tensor(
+            [row for row, sid in enumerate(self.sessions) if sid != session_id],
+            dtype=torch.long)
+        self.sessions.remove(session_id)
+        self.rows = {sid: row for row, sid in enumerate(self.sessions)}
+        del self.histories[session_id]
+
+        self.enc_h = self.enc_h.index_select(1, keep)
+        self.enc_c = self.enc_c.index_select(1, keep)
+        self.dec_proj = self.dec_proj.index_select(0, keep)
+        self.dec_hidden = tuple(
+            x.index_select(1, keep) for x in self.dec_hidden)
+
+    def reset_session(self, session_id):
+        """Clear the hidden states of one session, e.g. after long silence"""
+        row = self.rows[session_id]
+        self.enc_h[:, row] = 0
+        self.enc_c[:, row] = 0
+        self.dec_proj[row] = self.init_dec_proj[0]
+        for x, x_init in zip(self.dec_hidden, self.init_dec_hidden):
+            x[:, row] = x_init[:, 0]
+        self.histories[session_id] = ()
+
+    def push(self, pcm):
+        raise ValueError(
+            'sessions are decoded on windows, use decode({session_id: '
+            'window})')
+
+    def flush(self):
+        raise ValueError(
+            'sessions are decoded on windows, use decode({session_id: '
+            'window})')
+
+    @torch.no_grad()
+    def decode(self, frames):
+        """Decode one window for every session in `frames`.
+
+        Args:
+            frames (dict): session id -> waveform of shape (1, win_size). All
+                waveforms must have the same length, sessions without a new
+                window this tick are simply left out.
+
+        Returns:
+            dict: session id -> decoded text of this window.
+        """
+        if len(frames) == 0:
+            return {}
+        session_ids = list(frames.keys())
+        rows = torch.tensor(
+            [self.rows[sid] for sid in session_ids], dtype=torch.long)
+
+        start = time.time()
+        waveform = torch.cat([frames[sid] for sid in session_ids], dim=0)
+        xs = self.transform(waveform).transpose(1, 2)
+        enc_h = self.enc_h.index_select(1, rows)
+        enc_c = self.enc_c.index_select(1, rows)
+        enc_xs, _ = self.encoder(xs, (enc_h, enc_c), out=(enc_h, enc_c))
+        self.enc_h.index_copy_(1, rows, enc_h)
+        self.enc_c.index_copy_(1, rows, enc_c)
+        self.encoder_elapsed.append(time.time() - start)
+
+        enc_proj = self.joint.project_enc(enc_xs)
+        dec_proj = self.dec_proj.index_select(0, rows)
+        dec_hidden = tuple(x.index_select(1, rows) for x in self.dec_hidden)
+        tokens = [[] for _ in session_ids]
         for k in range(enc_xs.shape[1]):
             start = time.time()
-            prob = self.joint(enc_xs[:, k], self.dec_x[:, 0])
-            pred = prob.argmax(dim=-1).item()
-            if self.tokenizer.tokenizer.id_to_token(pred) == '<unk>':
-                prob[:, pred] = 0
-                pred = prob.argmax(dim=-1).item()
+            prob = self.joint.joint_from_projections(enc_proj[:, k], dec_proj)
+            prob = prob + self.logit_mask
+            pred = prob.argmax(dim=-1)
+            emit = (pred != NUL).nonzero().view(-1)
             self.joint_elapsed.append(time.time() - start)
 
-            if pred != NUL:
-                dec_x = torch.ones(1, 1).long() * pred
+            if len(emit) > 0:
                 start = time.time()
-                self.dec_x, (self.dec_h, self.dec_c) = self.decoder(
-                    dec_x, (self.dec_h, self.dec_c))
+                if self.cache is not None:
+                    histories = []
+                    for i in emit.tolist():
+                        sid = session_ids[i]
+                        self.histories[sid] = self.cache.key(
+                            self.histories[sid] + (pred[i].item(),))
+                        histories.append(self.histories[sid])
+                    dec_proj_next, dec_hidden_next = self.cache.step(
+                        histories, dec_hidden, emit.tolist())
+                else:
+                    dec_proj_next, dec_hidden_next = self.decoder_step(
+                        pred[emit].unsqueeze(1),
+                        tuple(x[:, emit] for x in dec_hidden))
+                dec_proj[emit] = dec_proj_next
+                for x, x_next in zip(dec_hidden, dec_hidden_next):
+                    x[:, emit] = x_next
                 self.decoder_elapsed.append(time.time() - start)
-                seq = self.tokenizer.tokenizer.id_to_token(pred)
-                seq = seq.replace('</w>', ' ')
-                tokens.append(seq)
-        return "".join(tokens)
+                for i in emit.tolist():
+                    tokens[i].append(self.id2token[pred[i].item()])
+        self.dec_proj.index_copy_(0, rows, dec_proj)
+        for x, x_rows in zip(self.dec_hidden, dec_hidden):
+            x.index_copy_(1, rows, x_rows)
+
+        return {sid: "".join(seq) for sid, seq in zip(session_ids, tokens)}
 
 
 class OpenVINOStreamDecoder(StreamTransducerDecoder):
     def __init__(self, FLAGS):
+        assert FLAGS.dec_type == 'LSTM', (
+            "OpenVINO decoding only supports the LSTM decoder")
         self.FLAGS = FLAGS
         logdir = os.path.join('logs', FLAGS.name)
 
@@ -137,10 +504,16 @@ class OpenVINOStreamDecoder(StreamTransducerDecoder):
             F_mask=FLAGS.F_mask, F_num_mask=FLAGS.F_num_mask)
 
         ie = IECore()
-        encoder_net = ie.read_network(
+        self.ie = ie
+        self.encoder_net = ie.read_network(
             model=os.path.join(logdir, 'encoder.xml'),
             weights=os.path.join(logdir, 'encoder.bin'))
-        self.encoder = ie.load_network(network=encoder_net, device_name='CPU')
+        # one executable encoder per chunk length, the exported length is
+        # loaded as is and the network is reshaped for the other ones
+        self.encoder_shape = list(self.encoder_net.inputs['input'].shape)
+        self.encoders = {
+            self.encoder_shape[1]: ie.load_network(
+                network=self.encoder_net, device_name='CPU')}
 
         decoder_net = ie.read_network(
             model=os.path.join(logdir, 'decoder.xml'),
@@ -152,6 +525,8 @@ class OpenVINOStreamDecoder(StreamTransducerDecoder):
             weights=os.path.join(logdir, 'joint.bin'))
         self.joint = ie.load_network(network=joint_net, device_name='CPU')
 
+        self.cache = build_decoder_cache(FLAGS, bounded=True)
+
         self.reset_profile()
         self.reset()
 
@@ -179,11 +554,22 @@ class OpenVINOStreamDecoder(StreamTransducerDecoder):
         self.dec_x = outputs['Add_26']
         self.dec_h = outputs['Concat_23']
         self.dec_c = outputs['Concat_24']
+        self.history = ()
+
+    def get_encoder(self, length):
+        if length not in self.encoders:
+            shape = list(self.encoder_shape)
+            shape[1] = length
+            self.encoder_net.reshape({'input': shape})
+            self.encoders[length] = self.ie.load_network(
+                network=self.encoder_net, device_name='CPU')
+        return self.encoders[length]
 
     def decode(self, frame):
         start = time.time()
         xs = self.transform(frame).transpose(1, 2).numpy()
-        outputs = self.encoder.infer(inputs={
+        encoder = self.get_encoder(xs.shape[1])
+        outputs = encoder.infer(inputs={
             'input': xs,
             'input_hidden': self.enc_h,
             'input_cell': self.enc_c,
@@ -200,24 +586,299 @@ class OpenVINOStreamDecoder(StreamTransducerDecoder):
                 'input_h_enc': enc_xs[:, k],
                 'input_h_dec': self.dec_x[:, 0]
             })
-            prob = outputs['Gemm_3']
+            # the joint has a single output, its node name depends on the export
+            prob = next(iter(outputs.values()))
             pred = prob.argmax(axis=-1).item()
             self.joint_elapsed.append(time.time() - start)
 
             if pred != NUL:
-                dec_x = np.ones((1, 1), dtype=np.long) * pred
                 start = time.time()
-                outputs = self.decoder.infer({
-                    'input': dec_x,
-                    'input_hidden': self.dec_h,
-                    'input_cell': self.dec_c,
-                })
-                # print(outputs.keys())
-                self.dec_x = outputs['Add_26']
-                self.dec_h = outputs['Concat_23']
-                self.dec_c = outputs['Concat_24']
+                cached = None
+                if self.cache is not None:
+                    self.history = self.cache.key(self.history + (pred,))
+                    cached = self.cache.lookup(self.history)
+                if cached is not None:
+                    self.dec_x, self.dec_h, self.dec_c = cached
+                else:
+                    dec_x = np.ones((1, 1), dtype=np.long) * pred
+                    outputs = self.decoder.infer({
+                        'input': dec_x,
+                        'input_hidden': self.dec_h,
+                        'input_cell': self.dec_c,
+                    })
+                    # print(outputs.keys())
+                    self.dec_x = outputs['Add_26']
+                    self.dec_h = outputs['Concat_23']
+                    self.dec_c = outputs['Concat_24']
+                    if self.cache is not None:
+                        # output blobs are reused by the next request
+                        self.cache.insert(self.history, (
+                            self.dec_x.copy(), self.dec_h.copy(),
+                            self.dec_c.copy()))
                 self.decoder_elapsed.append(time.time() - start)
                 seq = self.tokenizer.tokenizer.id_to_token(pred)
                 seq = seq.replace('</w>', ' ')
                 tokens.append(seq)
         return "".join(tokens)
+
+
+class OnnxRuntimeStreamDecoder(StreamTransducerDecoder):
+    """Decode with the encoder.onnx, decoder.onnx and joint.onnx written by
+    cli/export_onnx.py.
+
+    Every input and output is bound by name to a preallocated array through
+    IOBinding, so steady state decoding does not allocate. Recurrent states
+    alternate between two sets of arrays, a call reads one set and writes
+    the other.
+
+    If greedy_chunk.onnx was exported for the LSTM decoder and the decoder
+    cache is off, the labels of a whole chunk are decoded by one call of that graph instead of
+    separate joint and decoder calls.
+    """
+    # number of frames scored per joint call while no token is emitted
+    lookahead = 16
+
+    def __init__(self, FLAGS, quantize=None):
+        if onnxruntime is None:
+            raise ImportError('OnnxRuntimeStreamDecoder needs onnxruntime')
+        self.FLAGS = FLAGS
+        logdir = os.path.join('logs', FLAGS.name)
+        if quantize is None:
+            quantize = FLAGS.quantize
+        # int8 graphs are written by `cli/export_onnx.py --quantize`
+        suffix = '.int8.onnx' if quantize else '.onnx'
+
+        self.tokenizer = HuggingFaceTokenizer(
+            cache_dir=logdir, vocab_size=FLAGS.bpe_size)
+
+        _, self.transform, input_size = build_transform(
+            feature_type=FLAGS.feature, feature_size=FLAGS.feature_size,
+            n_fft=FLAGS.n_fft, win_length=FLAGS.win_length,
+            hop_length=FLAGS.hop_length, delta=FLAGS.delta, cmvn=FLAGS.cmvn,
+            downsample=FLAGS.downsample, pad_to_divisible=False,
+            T_mask=FLAGS.T_mask, T_num_mask=FLAGS.T_num_mask,
+            F_mask=FLAGS.F_mask, F_num_mask=FLAGS.F_num_mask)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL)
+        self.encoder = onnxruntime.InferenceSession(
+            os.path.join(logdir, 'encoder' + suffix), options)
+        self.decoder = onnxruntime.InferenceSession(
+            os.path.join(logdir, 'decoder' + suffix), options)
+        self.joint = onnxruntime.InferenceSession(
+            os.path.join(logdir, 'joint' + suffix), options)
+
+        vocab_size = self.tokenizer.vocab_size
+        self.id2token = [
+            self.tokenizer.tokenizer.id_to_token(idx) or ''
+            for idx in range(vocab_size)]
+        self.id2token = [seq.replace('</w>', ' ') for seq in self.id2token]
+        self.logit_mask = np.zeros(vocab_size, dtype=np.float32)
+        unk = self.tokenizer.tokenizer.token_to_id('<unk>')
+        if unk is not None:
+            self.logit_mask[unk] = float('-inf')
+
+        # encoder, the input and output arrays depend on the chunk length
+        enc_shape = (FLAGS.enc_layers, 1, FLAGS.enc_hidden_size)
+        self.enc_states = [
+            (np.zeros(enc_shape, dtype=np.float32),
+             np.zeros(enc_shape, dtype=np.float32)) for _ in range(2)]
+        self.enc_input_size = input_size
+        self.enc_buffers = {}
+        self.enc_bindings = {}
+
+        # decoder, the stateless one keeps the last tokens as its state
+        if FLAGS.dec_type == 'stateless':
+            self.dec_state_names = [('input_context', 'output_context')]
+            dec_states = [np.full(
+                (1, 1, FLAGS.dec_context_size - 1), PAD, dtype=np.int64)]
+        else:
+            self.dec_state_names = [
+                ('input_hidden', 'output_hidden'),
+                ('input_cell', 'output_cell')]
+            dec_shape = (FLAGS.dec_layers, 1, FLAGS.dec_hidden_size)
+            dec_states = [
+                np.zeros(dec_shape, dtype=np.float32) for _ in range(2)]
+        self.dec_init_states = dec_states
+        self.dec_states = [
+            [np.copy(x) for x in dec_states] for _ in range(2)]
+        self.dec_input = np.zeros((1, 1), dtype=np.int64)
+        self.dec_outputs = [
+            np.zeros((1, 1, FLAGS.dec_proj_size), dtype=np.float32)
+            for _ in range(2)]
+        self.dec_bindings = []
+        for i in range(2):
+            inputs = {'input': self.dec_input}
+            outputs = {'output': self.dec_outputs[1 - i]}
+            for (name_in, name_out), x_in, x_out in zip(
+                    self.dec_state_names, self.dec_states[i],
+                    self.dec_states[1 - i]):
+                inputs[name_in] = x_in
+                outputs[name_out] = x_out
+            self.dec_bindings.append(
+                self.bind(self.decoder, inputs, outputs))
+
+        # joint, always run on `lookahead` rows, the unused ones are ignored
+        self.joint_enc = np.zeros(
+            (self.lookahead, FLAGS.enc_proj_size), dtype=np.float32)
+        self.joint_dec = np.zeros(
+            (self.lookahead, FLAGS.dec_proj_size), dtype=np.float32)
+        self.joint_output = np.zeros(
+            (self.lookahead, vocab_size), dtype=np.float32)
+        self.joint_binding = self.bind(
+            self.joint,
+            {'input_h_enc': self.joint_enc, 'input_h_dec': self.joint_dec},
+            {'output': self.joint_output})
+
+        self.cache = build_decoder_cache(FLAGS, bounded=True)
+
+        greedy_path = os.path.join(logdir, 'greedy_chunk' + suffix)
+        if os.path.exists(greedy_path) and self.cache is None and \
+                FLAGS.dec_type == 'LSTM':
+            self.greedy_chunk = onnxruntime.InferenceSession(
+                greedy_path, options)
+        else:
+            self.greedy_chunk = None
+        self.greedy_buffers = {}
+        self.greedy_bindings = {}
+
+        self.reset_profile()
+        self.reset()
+
+    @staticmethod
+    def bind(session, inputs, outputs):
+        """IOBinding of arrays, they are referenced and not copied so they
+        can be updated in place between runs"""
+        binding = session.io_binding()
+        for name, x in inputs.items():
+            binding.bind_ortvalue_input(
+                name, onnxruntime.OrtValue.ortvalue_from_numpy(x))
+        for name, x in outputs.items():
+            binding.bind_ortvalue_output(
+                name, onnxruntime.OrtValue.ortvalue_from_numpy(x))
+        return binding
+
+    def get_encoder_binding(self, length):
+        if length not in self.enc_buffers:
+            xs = np.zeros(
+                (1, length, self.enc_input_size), dtype=np.float32)
+            # the time reduction of the encoder is applied by the graph
+            ys = self.encoder.run(None, {
+                'input': xs,
+                'input_hidden': self.enc_states[0][0],
+                'input_cell': self.enc_states[0][1],
+            })[0]
+            ys = np.zeros_like(ys)
+            self.enc_buffers[length] = (xs, ys)
+            for i in range(2):
+                (h_in, c_in), (h_out, c_out) = (
+                    self.enc_states[i], self.enc_states[1 - i])
+                self.enc_bindings[length, i] = self.bind(
+                    self.encoder,
+                    {'input': xs, 'input_hidden': h_in, 'input_cell': c_in},
+                    {'output': ys, 'output_hidden': h_out,
+                     'output_cell': c_out})
+        return self.enc_buffers[length], self.enc_bindings[length, self.enc_i]
+
+    def get_greedy_binding(self, length):
+        key = (length, self.dec_i)
+        if key not in self.greedy_bindings:
+            _, enc_output = self.enc_buffers[length]
+            if length not in self.greedy_buffers:
+                self.greedy_buffers[length] = np.zeros(
+                    enc_output.shape[1], dtype=np.int64)
+            (h_in, c_in), (h_out, c_out) = (
+                self.dec_states[self.dec_i], self.dec_states[1 - self.dec_i])
+            self.greedy_bindings[key] = self.bind(
+                self.greedy_chunk,
+                {'input': enc_output,
+                 'input_dec': self.dec_outputs[self.dec_i],
+                 'input_hidden': h_in, 'input_cell': c_in},
+                {'output': self.greedy_buffers[length],
+                 'output_dec': self.dec_outputs[1 - self.dec_i],
+                 'output_hidden': h_out, 'output_cell': c_out})
+        return self.greedy_buffers[length], self.greedy_bindings[key]
+
+    def reset(self):
+        self.enc_i = 0
+        for x in self.enc_states[0]:
+            x.fill(0)
+        self.dec_i = 0
+        for x, x_init in zip(self.dec_states[0], self.dec_init_states):
+            np.copyto(x, x_init)
+        self.decoder_step(BOS)
+        self.history = ()
+        if self.chunk_controller is not None:
+            self.chunk_controller.reset()
+
+    def decoder_step(self, token):
+        self.dec_input.fill(token)
+        self.decoder.run_with_iobinding(self.dec_bindings[self.dec_i])
+        self.dec_i = 1 - self.dec_i
+        self.joint_dec[:] = self.dec_outputs[self.dec_i][0]
+
+    def decode(self, frame):
+        start = time.time()
+        xs = self.transform(frame).transpose(1, 2).numpy()
+        (enc_input, enc_output), binding = self.get_encoder_binding(
+            xs.shape[1])
+        np.copyto(enc_input, xs)
+        self.encoder.run_with_iobinding(binding)
+        self.enc_i = 1 - self.enc_i
+        self.encoder_elapsed.append(time.time() - start)
+
+        if self.greedy_chunk is not None:
+            start = time.time()
+            preds, binding = self.get_greedy_binding(xs.shape[1])
+            self.greedy_chunk.run_with_iobinding(binding)
+            self.dec_i = 1 - self.dec_i
+            self.joint_dec[:] = self.dec_outputs[self.dec_i][0]
+            self.joint_elapsed.append(time.time() - start)
+            return "".join(
+                self.id2token[pred] for pred in preds.tolist() if pred != NUL)
+
+        tokens = []
+        k = 0
+        length = enc_output.shape[1]
+        while k < length:
+            # the decoder output only changes after a non-blank emission,
+            # so score the next frames against it in one call
+            start = time.time()
+            n = min(self.lookahead, length - k)
+            self.joint_enc[:n] = enc_output[0, k:k + n]
+            self.joint.run_with_iobinding(self.joint_binding)
+            preds = (self.joint_output[:n] + self.logit_mask).argmax(axis=-1)
+            emits = np.flatnonzero(preds != NUL)
+            self.joint_elapsed.append(time.time() - start)
+            if len(emits) == 0:
+                k += n
+                continue
+
+            offset = emits[0]
+            pred = int(preds[offset])
+            k += offset + 1
+
+            start = time.time()
+            cached = None
+            if self.cache is not None:
+                self.history = self.cache.key(self.history + (pred,))
+                cached = self.cache.lookup(self.history)
+            if cached is not None:
+                # copied into the bound arrays, their addresses must not
+                # change
+                dec_output, dec_states = cached
+                np.copyto(self.dec_outputs[self.dec_i], dec_output)
+                for x, x_cached in zip(
+                        self.dec_states[self.dec_i], dec_states):
+                    np.copyto(x, x_cached)
+                self.joint_dec[:] = dec_output[0]
+            else:
+                self.decoder_step(pred)
+                if self.cache is not None:
+                    self.cache.insert(self.history, (
+                        self.dec_outputs[self.dec_i].copy(),
+                        [x.copy() for x in self.dec_states[self.dec_i]]))
+            self.decoder_elapsed.append(time.time() - start)
+            tokens.append(self.id2token[pred])
+        return "".join(tokens)
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import tempfile
 import pickle
@@ -53,6 +54,16 @@ class CharTokenizer:
         text = [self.token2id.get(char, UNK) for char in text]
         return text
 
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+    def fingerprint(self):
+        """Changes with the vocabulary, None until it is built or loaded"""
+        if getattr(self, 'token2id', None) is None:
+            return None
+        data = pickle.dumps(sorted(self.token2id.items()))
+        return hashlib.sha1(b'char' + data).hexdigest()[:12]
+
     def decode(self, tokens):
         text = ''.join([self.id2token[token] for token in tokens])
         for token in DEFAULT_TOKEN2ID.keys():
@@ -109,6 +120,23 @@ class HuggingFaceTokenizer:
 
         return token_ids
 
+    def encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(
+            [text.lower() for text in texts])
+        return [encoding.ids[:self.max_length] for encoding in encodings]
+
+    def fingerprint(self):
+        """Hash of the vocab and merges files and of the truncation, None
+        until they are built"""
+        if self.tokenizer is None:
+            return None
+        sha1 = hashlib.sha1(str(self.max_length).encode('utf-8'))
+        for suffix in ['-vocab.json', '-merges.txt']:
+            path = os.path.join(self.cache_dir, self.name + suffix)
+            with open(path, 'rb') as f:
+                sha1.update(f.read())
+        return sha1.hexdigest()[:12]
+
     def decode(self, tokens, skip_special_tokens=True):
         text = self.tokenizer.decode(                   # My special tokens
             [token for token in tokens if token > 3],   # aren't skipped
@@ -4,7 +4,7 @@ import torch
 import torchaudio
 from torchaudio.transforms import MFCC, MelSpectrogram
 
-from rnnt.features import FilterbankFeatures
+from rnnt.features import FilterbankFeatures, StreamingFilterbank
 
 
 class CatDeltas(torch.nn.Module):
@@ -162,6 +162,58 @@ class TrimAudio(torch.nn.Module):
             return x[:, :self.max_length]
         return x[:, -self.max_length:]
 
+class StreamingTransform:
+    """Streaming counterpart of the test transform built by
+    `build_transform` for logfbank features.
+
+    `push` takes PCM of any length and returns only the new stacked frames,
+    in multiples of `step` so that the TimeReduction of the encoder never
+    pads in the middle of the stream.
+    """
+    def __init__(self, features, downsample=1, step=1):
+        self.filterbank = StreamingFilterbank(features)
+        self.downsample = Downsample(downsample, pad_to_divisible=False)
+        self.n_frame = downsample * step
+        self.reset()
+
+    def reset(self):
+        self.filterbank.reset()
+        self.frames = None
+
+    def stack(self, feat):
+        if self.frames is not None:
+            feat = torch.cat([self.frames, feat], dim=2)
+        length = feat.shape[2] - feat.shape[2] % self.n_frame
+        self.frames = feat[:, :, length:]
+        return self.downsample(feat[:, :, :length])
+
+    def push(self, waveform):
+        return self.stack(self.filterbank.push(waveform))
+
+    def flush(self):
+        batch_size = 1 if self.frames is None else self.frames.shape[0]
+        return self.stack(self.filterbank.flush(batch_size))
+
+
+def build_streaming_transform(transform, step=1):
+    """StreamingTransform equivalent to a test transform of
+    `build_transform`, None if one of its features needs the whole
+    utterance"""
+    features = None
+    downsample = 1
+    for module in transform:
+        if isinstance(module, FilterbankFeatures):
+            features = module
+        elif isinstance(module, Downsample):
+            downsample = module.n_frame
+        else:
+            return None
+    if features is None or features.normalize != "none" or \
+            features.pad_to != 0:
+        return None
+    return StreamingTransform(features, downsample, step)
+
+
 def build_transform(feature_type, feature_size, n_fft=512, win_length=400,
                     hop_length=200, delta=False, cmvn=False, downsample=1,
                     T_mask=0, T_num_mask=0, F_mask=0, F_num_mask=0,
@@ -201,3 +253,9 @@ def build_transform(feature_type, feature_size, n_fft=512, win_length=400,
     transform_train = torch.nn.Sequential(*transform)
 
     return transform_train, transform_test, input_size
+
+
+def split_augmentation(transform_train, transform_test):
+    """The SpecAugment masking which `transform_train` adds after
+    `transform_test`, for precomputed test features"""
+    return torch.nn.Sequential(*list(transform_train)[len(transform_test):])
@@ -1,9 +1,7 @@
-import torch
 import os
 import time
 import random
 import argparse
-import numpy as np
 import torch.nn.functional as F
 import torchaudio
 import json
@@ -14,12 +12,13 @@ from datetime import datetime
 from absl import app, flags
 
 import av
-import torch
 import torchaudio
 from absl import app, flags
 
 from rnnt.args import FLAGS
-from rnnt.stream import PytorchStreamDecoder, OpenVINOStreamDecoder
+from rnnt.buffer import RingBuffer
+from rnnt.stream import (
+    PytorchStreamDecoder, OpenVINOStreamDecoder, OnnxRuntimeStreamDecoder)
 
 import tempfile
 import queue
@@ -31,7 +30,7 @@ av.logging.set_level(av.logging.ERROR)
 flags.DEFINE_string('model_name', "last.pt", help='steps of checkpoint')
 flags.DEFINE_integer('step_n_frame', 2, help='input frame(stacked)')
 
-flags.DEFINE_enum('stream_decoder', 'torch', ['torch', 'openvino'],
+flags.DEFINE_enum('stream_decoder', 'torch', ['torch', 'openvino', 'onnx'],
                   help='stream decoder implementation')
 flags.DEFINE_string('url', 'https://www.youtube.com/watch?v=2EppLNonncc',
                     help='youtube live link')
@@ -55,7 +54,7 @@ rust:   AudioPreprocessing(
 '''
 global blank_counter
 blank_counter = 0
-buffer = []
+buffer = None
 
 
 
@@ -69,34 +68,24 @@ A NEW RANGE OF WALLS AND FLOORS ANOTHER HOME THAN THIS
 '''
 
 def callback(raw_indata, outdata,frames, time, status):
-    global buffer
     global encoder_h
     global blank_counter
 
     if status: # usually something bad
         print("X", flush=True, end=" ")
     else:
-        indata = raw_indata.copy()
-
-        buffer.append(indata)
-        buffer = buffer[-2:]
-
-        indata = np.concatenate(buffer[-2:], axis=0)
-
-        # print(indata.shape)
-        indata = indata / (1<<16)
-        waveform = torch.from_numpy(indata.flatten()).float()
-        waveform = waveform.unsqueeze(0)
-
-        seq = stream_decoder.decode(waveform)
-        if seq == "":
-            blank_counter += 1
-            if blank_counter == 35:
-                print(' [Background]')
-                stream_decoder.reset()
-        else:
-            blank_counter = 0
-            print(seq, end='', flush=True)
+        # window of the last two blocks, advanced by one block
+        buffer.write(raw_indata.T, scale=1 / (1<<16))
+        for waveform in buffer.windows(2 * frames, frames):
+            seq = stream_decoder.decode(waveform)
+            if seq == "":
+                blank_counter += 1
+                if blank_counter == 35:
+                    print(stream_decoder.flush() + ' [Background]')
+                    stream_decoder.reset()
+            else:
+                blank_counter = 0
+                print(seq, end='', flush=True)
 
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
@@ -119,13 +108,21 @@ def test_wav(wav_file):
 
 def main(argv):
     global stream_decoder
-    stream_decoder = PytorchStreamDecoder(FLAGS)
+    global buffer
+    if FLAGS.stream_decoder == 'onnx':
+        stream_decoder = OnnxRuntimeStreamDecoder(FLAGS)
+    elif FLAGS.stream_decoder == 'openvino':
+        stream_decoder = OpenVINOStreamDecoder(FLAGS)
+    else:
+        stream_decoder = PytorchStreamDecoder(FLAGS)
     duration = 80
     if FLAGS.path is not None:
         test_wav(FLAGS.path)
     else:
+        blocksize = FLAGS.win_length*FLAGS.step_n_frame+ (FLAGS.step_n_frame-1)
+        buffer = RingBuffer(capacity=4 * blocksize)
         with sd.Stream(channels=1,dtype='float32', samplerate=16000, 
-            blocksize=FLAGS.win_length*FLAGS.step_n_frame+ (FLAGS.step_n_frame-1), callback=callback, 
+            blocksize=blocksize, callback=callback, 
             latency='high'):
 
             sd.sleep(duration * 1000)
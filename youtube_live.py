@@ -1,4 +1,5 @@
 import subprocess
+import time
 from datetime import datetime
 
 import av
@@ -7,19 +8,36 @@ import torchaudio
 from absl import app, flags
 
 from rnnt.args import FLAGS
-from rnnt.stream import PytorchStreamDecoder, OpenVINOStreamDecoder
+from rnnt.buffer import RingBuffer
+from rnnt.pipeline import StreamPipeline
+from rnnt.stream import (
+    PytorchStreamDecoder, OpenVINOStreamDecoder, OnnxRuntimeStreamDecoder,
+    build_chunk_controller)
 av.logging.set_level(av.logging.ERROR)
 
 # PytorchStreamDecoder
 flags.DEFINE_string('model_name', "last.pt", help='steps of checkpoint')
 flags.DEFINE_integer('step_n_frame', 2, help='input frame(stacked)')
 
-flags.DEFINE_enum('stream_decoder', 'torch', ['torch', 'openvino'],
+flags.DEFINE_enum('stream_decoder', 'torch', ['torch', 'openvino', 'onnx'],
                   help='stream decoder implementation')
 flags.DEFINE_string('url', 'https://www.youtube.com/watch?v=2EppLNonncc',
                     help='youtube live link')
 flags.DEFINE_integer('reset_step', 500, help='reset hidden state')
 flags.DEFINE_string('path', None, help='path to .wav')
+# pipelined live mode
+flags.DEFINE_bool('pipeline', False,
+                  help='read audio and decode on separate threads')
+flags.DEFINE_integer('queue_size', 64, help='max queued audio frames')
+flags.DEFINE_enum('backpressure', 'coalesce', ['drop', 'coalesce'],
+                  help='drop old audio or decode queued hops at once when '
+                       'decoding falls behind')
+flags.DEFINE_integer('max_coalesce', 8, help='max hops per encoder call')
+flags.DEFINE_integer('max_step_n_frame', 0,
+                     help='grow the chunk up to this many frames while '
+                          'decoding lags behind, 0 keeps step_n_frame')
+flags.DEFINE_float('metrics_step', 10, help='seconds between pipeline '
+                   'metrics, 0 disables')
 
 
 def stream_decode(stream_decoder, waveform, verbose=0):
@@ -32,12 +50,17 @@ def stream_decode(stream_decoder, waveform, verbose=0):
     pred_seq = ""
     total_frames = FLAGS.win_length
     stream_decoder.reset()
-    for start in range(0, waveform.shape[1] - win_size, hop_size):
-        total_frames += hop_size
-        seq = stream_decoder.decode(waveform[:, start: start + win_size])
-        if verbose > 0:
-            print(seq, end='', flush=True)
-        pred_seq += seq
+    # feed the file in hops, the same way live audio arrives
+    buffer = RingBuffer(capacity=win_size + hop_size)
+    for start in range(0, waveform.shape[1], hop_size):
+        buffer.write(waveform[:1, start: start + hop_size])
+        for window in buffer.windows(win_size, hop_size):
+            total_frames += hop_size
+            seq = stream_decoder.decode(window)
+            if verbose > 0:
+                print(seq, end='', flush=True)
+            pred_seq += seq
+    pred_seq += stream_decoder.flush()
 
     return pred_seq, total_frames
 
@@ -54,8 +77,12 @@ def wav():
     seq = stream_decoder.decode(waveform[:1])
     print(seq)
 
-    stream_decoder = OpenVINOStreamDecoder(FLAGS)
-    print("OpenVINO: ")
+    if FLAGS.stream_decoder == 'onnx':
+        stream_decoder = OnnxRuntimeStreamDecoder(FLAGS)
+        print("ONNX Runtime: ")
+    else:
+        stream_decoder = OpenVINOStreamDecoder(FLAGS)
+        print("OpenVINO: ")
     seq, _ = stream_decode(stream_decoder, waveform[:1])
     print(seq)
 
@@ -78,13 +105,6 @@ def live():
     videolink = out.decode("utf-8").strip()
     resampler = av.AudioResampler("s16p", layout=1, rate=16 * 1000)
 
-    if not infinite and save_strean:
-        output_container = av.open(filepath, 'w')
-        output_stream = output_container.add_stream('mp3')
-
-    input_container = av.open(videolink)
-    input_stream = input_container.streams.get(audio=0)[0]
-
     win_size = (
         FLAGS.win_length +
         FLAGS.hop_length * (FLAGS.downsample * FLAGS.step_n_frame - 1))
@@ -93,55 +113,95 @@ def live():
 
     if FLAGS.stream_decoder == 'torch':
         stream_decoder = PytorchStreamDecoder(FLAGS)
+        # no overlapping windows, features are extracted incrementally
+        incremental = stream_decoder.stream_transform is not None
+    elif FLAGS.stream_decoder == 'onnx':
+        stream_decoder = OnnxRuntimeStreamDecoder(FLAGS)
+        incremental = False
     else:
         stream_decoder = OpenVINOStreamDecoder(FLAGS)
+        incremental = False
 
-    # track_counter = 0
-    begin_time = datetime.now()
-    buffer = torch.empty(1, 0)
-    blank_counter = 0
-    for frame in input_container.decode(input_stream):
-        frame.pts = None
-        resample_frame = resampler.resample(frame)
+    def read_audio():
+        # int16 PCM of every resampled frame
+        if not infinite and save_strean:
+            output_container = av.open(filepath, 'w')
+            output_stream = output_container.add_stream('mp3')
 
-        waveform = resample_frame.to_ndarray()
-        waveform = torch.tensor(waveform.copy())
-        waveform = waveform.float() / 32768
+        input_container = av.open(videolink)
+        input_stream = input_container.streams.get(audio=0)[0]
 
-        if torch.isnan(waveform).any():
-            print("[NAN]", flush=True, end=" ")
+        begin_time = datetime.now()
+        for frame in input_container.decode(input_stream):
+            frame.pts = None
+            resample_frame = resampler.resample(frame)
+            yield resample_frame.to_ndarray()
 
-        if buffer.shape[1] < win_size:
-            buffer = torch.cat([buffer, waveform], dim=-1)
+            if not infinite and save_strean:
+                for packet in output_stream.encode(resample_frame):
+                    output_container.mux(packet)
 
-        while buffer.shape[1] >= win_size:
-            waveform = buffer[:, :win_size]
-            buffer = buffer[:, hop_size:]
-            if torch.isnan(waveform).any():
-                print("[NAN] waveform", flush=True, end=" ")
-                continue
-            seq = stream_decoder.decode(waveform)
-            if seq == "":
-                blank_counter += 1
-                if blank_counter == 35:
-                    print(' [Background]')
-                    stream_decoder.reset()
-            else:
-                blank_counter = 0
-                print(seq, end='', flush=True)
+            if not infinite:
+                if (datetime.now() - begin_time).total_seconds() > duration:
+                    break
 
         if not infinite and save_strean:
-            for packet in output_stream.encode(resample_frame):
+            for packet in output_stream.encode(None):
                 output_container.mux(packet)
+            output_container.close()
+
+    # samples decoded since the last token, counted in audio rather than
+    # calls since a call covers anything from one av frame to many hops
+    blank_samples = 0
+    reset_samples = 35 * hop_size
+
+    def on_text(seq, samples):
+        nonlocal blank_samples
+        if seq == "":
+            # once per stretch of silence
+            if blank_samples < reset_samples <= blank_samples + samples:
+                print(stream_decoder.flush() + ' [Background]')
+                stream_decoder.reset()
+            blank_samples += samples
+        else:
+            blank_samples = 0
+            print(seq, end='', flush=True)
 
-        if not infinite:
-            if (datetime.now() - begin_time).total_seconds() > duration:
-                break
-
-    if not infinite and save_strean:
-        for packet in output_stream.encode(None):
-            output_container.mux(packet)
-        output_container.close()
+    if FLAGS.pipeline:
+        stream_decoder.chunk_controller = build_chunk_controller(FLAGS)
+        pipeline = StreamPipeline(
+            stream_decoder, win_size, hop_size, incremental=incremental,
+            queue_size=FLAGS.queue_size, backpressure=FLAGS.backpressure,
+            max_coalesce=FLAGS.max_coalesce, scale=1 / 32768)
+        last_report = time.time()
+
+        def on_pipeline_text(seq, samples):
+            nonlocal last_report
+            on_text(seq, samples)
+            if FLAGS.metrics_step > 0 and \
+                    time.time() - last_report > FLAGS.metrics_step:
+                last_report = time.time()
+                print('\n[%s]' % pipeline.metrics, flush=True)
+
+        pipeline.run(read_audio(), on_pipeline_text)
+        return
+
+    buffer = RingBuffer(capacity=4 * win_size)
+    for waveform in read_audio():
+        if incremental:
+            waveform = torch.tensor(waveform.copy())
+            waveform = waveform.float() / 32768
+            if torch.isnan(waveform).any():
+                print("[NAN]", flush=True, end=" ")
+            on_text(stream_decoder.push(waveform), waveform.shape[1])
+        else:
+            # int16 samples are scaled while copied into the buffer
+            buffer.write(waveform, scale=1 / 32768)
+            for waveform in buffer.windows(win_size, hop_size):
+                if torch.isnan(waveform).any():
+                    print("[NAN] waveform", flush=True, end=" ")
+                    continue
+                on_text(stream_decoder.decode(waveform), hop_size)
 
 
 def main(argv):